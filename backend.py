@@ -5,15 +5,36 @@ Flask 后端 API - 视频上传管理系统
 """
 
 import os
-import shutil
+import re
+import atexit
+import contextlib
+import json
+import time
+import base64
+import hashlib
+import secrets
+import mimetypes
 import sqlite3
+import threading
 from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory, session, send_file, g
+from flask import Flask, request, jsonify, send_from_directory, session, send_file, g, Response, stream_with_context
 from flask_cors import CORS
+from urllib.parse import quote
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.security import safe_join
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, File, Data, Epilogue
 from multiprocessing import Process
 from webrtc_server import start_webrtc_server
 from functools import wraps
-from db_manage import init_db as init_db_tool
+from db_manage import init_db as init_db_tool, reconcile_uploads, upsert_video
+import thumbs
+import jobs
+import serve
+import presence
+import database
+import retention
+import purge
+import recorder
 
 # ------------- 基础配置 -------------
 app = Flask(__name__)
@@ -25,6 +46,45 @@ FRONTEND_ROOT = os.path.join(os.path.dirname(__file__), "frontend")
 DB_PATH = os.path.join(os.path.dirname(__file__), "database.db")
 os.makedirs(UPLOAD_ROOT, exist_ok=True)
 
+# 在线判定窗口（秒）：folders.updated_at 在此时间内视为在线（环境变量 ONLINE_WINDOW）
+ONLINE_WINDOW = presence.ONLINE_WINDOW
+
+# 列表分页：默认/最大每页条数
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 500
+
+# 上传：按块写盘的块大小、单个文件最大字节数（可用环境变量 MAX_UPLOAD_BYTES 覆盖）
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 4 * 1024 * 1024 * 1024))
+# 请求体总上限（在文件上限之外留出 multipart 头部余量），由 WSGI 层在读取前拦截
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES + 1024 * 1024
+
+# 断点续传：会话分块临时文件目录（与 uploads 同一文件系统，完成时原子重命名）、
+# 建议分块大小、会话闲置多久后回收（秒）、回收线程扫描间隔（秒）
+UPLOAD_SESSION_DIR = ".sessions"
+UPLOAD_SESSION_CHUNK = 8 * 1024 * 1024
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", 24 * 3600))
+UPLOAD_SESSION_GC_INTERVAL = 10 * 60
+
+# 视频播放：各容器的 MIME、浏览器缓存时长（秒，录像文件名唯一且上传后不再修改）
+VIDEO_MIMETYPES = {
+    ".mp4": "video/mp4",
+    ".webm": "video/webm",
+    ".mkv": "video/x-matroska",
+    ".mov": "video/quicktime",
+    ".avi": "video/x-msvideo",
+}
+VIDEO_MAX_AGE = 24 * 3600
+# 缩略图浏览器缓存时长（秒）：缩略图按内容寻址，可长期缓存
+THUMB_MAX_AGE = 30 * 24 * 3600
+
+# 视频发送交给反向代理：""（由本进程发送）、"x-accel"（Nginx X-Accel-Redirect）、
+# "x-sendfile"（Apache/lighttpd X-Sendfile）。x-accel 时 X_ACCEL_PREFIX 对应 Nginx 中
+# 指向 uploads/ 的 internal location。
+VIDEO_OFFLOAD = os.environ.get("VIDEO_OFFLOAD", "").lower()
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "/protected_uploads").rstrip("/")
+app.config["USE_X_SENDFILE"] = VIDEO_OFFLOAD == "x-sendfile"
+
 # 管理员账号（可改）
 ADMIN_USER = "admin"
 ADMIN_PASS = "123456"
@@ -33,37 +93,319 @@ ADMIN_PASS = "123456"
 
 # ---------------- 数据库管理 ----------------
 def get_db():
-    """获取数据库连接"""
+    """获取数据库连接（当前线程复用的共享连接，见 database.py）"""
     if 'db' not in g:
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
+        g.db = database.get(DB_PATH)
     return g.db
 
 
 def close_db(e=None):
-    """关闭数据库连接"""
+    """请求结束：回滚未提交的事务，连接留给本线程后续请求复用"""
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        database.release(db)
 
 
 def init_db():
-    """初始化数据库表（委托 db_manage）"""
+    """初始化数据库表（委托 db_manage），并把磁盘上尚未入库的目录/视频补录进数据库"""
     init_db_tool()
+    reconcile_uploads(UPLOAD_ROOT)
 
 
 # 注册关闭回调
 app.teardown_appcontext(close_db)
 
+# 文件夹汇总：统计列由 videos 上的触发器维护，读取时无需聚合；已删除（后台清除中）的文件夹不返回
+FOLDER_SUMMARY_SQL = '''
+    SELECT f.ip, f.remark, f.upload_enabled, f.webrtc_direct, f.updated_at,
+           f.video_count, f.total_bytes, f.last_upload_at,
+           COALESCE(f.updated_at >= datetime('now', ?), 0) AS online
+    FROM folders f
+    WHERE f.deleted_at IS NULL
+'''
+
+
+def folder_summary(row):
+    """把 FOLDER_SUMMARY_SQL 的一行转换为接口返回的字典"""
+    return {
+        "ip": row['ip'],
+        "video_count": row['video_count'],
+        "total_bytes": row['total_bytes'],
+        "remark": row['remark'] or "",
+        "last_upload_at": row['last_upload_at'],
+        # 在线状态索引运行时以其为准（包含尚未写入数据库的心跳）
+        "online": presence.is_online(row['ip']) if presence.started() else bool(row['online']),
+        "upload_enabled": bool(row['upload_enabled']) if row['upload_enabled'] is not None else True,
+        "webrtc_direct": bool(row['webrtc_direct']) if row['webrtc_direct'] is not None else False,
+    }
+
+
 # ---------------- 工具函数 ----------------
+class BadRequest(ValueError):
+    """查询参数不合法（返回 400）"""
+
+
+def check_ip(ip: str):
+    """IP（文件夹名）不合法时抛出 BadRequest：规则同 recorder.valid_name，
+    不能以点开头（.. 会逃出 uploads/，.sessions / .trash / .recording 为内部目录）"""
+    if not recorder.valid_name(ip):
+        raise BadRequest("invalid ip")
+
+
+def folder_dir(ip: str):
+    """根据 IP 返回对应上传文件夹的路径（不创建，读取路径用：不会为已删除的文件夹重新建出空目录）"""
+    check_ip(ip)
+    return os.path.join(UPLOAD_ROOT, ip)
+
+
 def folder_path(ip: str):
-    """根据 IP 返回对应上传文件夹"""
-    safe_ip = ip.replace("/", "_")
-    path = os.path.join(UPLOAD_ROOT, safe_ip)
+    """根据 IP 返回对应上传文件夹（不存在时创建，写入路径用）"""
+    path = folder_dir(ip)
     os.makedirs(path, exist_ok=True)
     return path
 
 
+class UploadTooLarge(Exception):
+    """上传超过 MAX_UPLOAD_BYTES"""
+
+
+def video_mimetype(filename):
+    """按容器格式返回视频 MIME 类型"""
+    ext = os.path.splitext(filename)[1].lower()
+    return VIDEO_MIMETYPES.get(ext) or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def video_ext(original_name):
+    """从客户端原文件名取扩展名，非法或缺失时默认 .mp4"""
+    ext = os.path.splitext(original_name or "")[1].lower()
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,8}", ext) else ".mp4"
+
+
+_filename_lock = threading.Lock()
+_filename_state = {"stamp": "", "seq": 0}
+
+
+def new_video_filename(original_name):
+    """生成单调递增的视频文件名：毫秒级时间戳，同一毫秒内追加序号（_1、_2 ...）。
+
+    扩展名沿用客户端原文件名。时钟回拨时沿用上一个时间戳继续递增序号，保证同进程内不重名。
+    """
+    now = datetime.now()
+    stamp = now.strftime("%Y%m%d_%H%M%S_") + f"{now.microsecond // 1000:03d}"
+    with _filename_lock:
+        if stamp > _filename_state["stamp"]:
+            _filename_state["stamp"], _filename_state["seq"] = stamp, 0
+        else:
+            _filename_state["seq"] += 1
+        stamp, seq = _filename_state["stamp"], _filename_state["seq"]
+    suffix = f"_{seq}" if seq else ""
+    return f"{stamp}{suffix}{video_ext(original_name)}"
+
+
+def reserve_video_path(folder, original_name):
+    """在 folder 下独占创建一个新的空视频文件（O_EXCL），返回 (文件名, 路径)。
+
+    多进程同时上传时，撞名的一方会换一个名字重试，绝不会覆盖已有文件。
+    """
+    while True:
+        filename = new_video_filename(original_name)
+        path = os.path.join(folder, filename)
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return filename, path
+        except FileExistsError:
+            continue
+
+
+def find_duplicate(db, ip, sha256=None, idempotency_key=None):
+    """按幂等键或内容哈希查找该 IP 已登记的视频，不存在（或文件已丢失）时返回 None"""
+    if idempotency_key:
+        row = db.execute(
+            'SELECT filename, file_size, sha256 FROM videos WHERE ip = ? AND idempotency_key = ?',
+            (ip, idempotency_key)
+        ).fetchone()
+        if row:
+            return row
+    if sha256:
+        for row in db.execute(
+            'SELECT filename, file_size, sha256 FROM videos WHERE ip = ? AND sha256 = ?', (ip, sha256)
+        ):
+            if os.path.exists(os.path.join(folder_dir(ip), row['filename'])):
+                return row
+    return None
+
+
+def duplicate_response(ip, row):
+    """重复上传时返回已有视频的信息"""
+    return jsonify({
+        "filename": row['filename'],
+        "ip": ip,
+        "size": row['file_size'],
+        "sha256": row['sha256'],
+        "duplicate": True,
+    })
+
+
+def purging_response(db, ip):
+    """文件夹已删除、正在后台清除时返回 409，否则返回 None"""
+    if purge.is_deleted(db, ip):
+        return jsonify({"error": "folder is being deleted"}), 409
+    return None
+
+
+def record_video(db, ip, filename, file_size, sha256=None, idempotency_key=None):
+    """登记视频记录并提交。幂等键冲突（并发重试）时返回已有记录，否则返回 None"""
+    try:
+        upsert_video(db.cursor(), ip, filename, file_size, sha256=sha256, idempotency_key=idempotency_key)
+        db.commit()
+    except sqlite3.IntegrityError:
+        db.rollback()
+        return find_duplicate(db, ip, idempotency_key=idempotency_key)
+    return None
+
+
+def multipart_file_stream(stream, boundary, field="file"):
+    """流式解析 multipart 请求体，定位到名为 field 的文件字段。
+
+    返回 (原文件名, 数据块迭代器)；请求中没有该字段时返回 (None, None)。
+    迭代器按 UPLOAD_CHUNK_SIZE 从 stream 读取，不会把整个文件读入内存或落临时文件。
+    """
+    decoder = MultipartDecoder(boundary.encode("latin-1"))
+
+    def next_event():
+        while True:
+            event = decoder.next_event()
+            if not isinstance(event, NeedData):
+                return event
+            if decoder.complete:
+                raise ValueError("multipart body truncated")
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            decoder.receive_data(chunk or None)
+
+    while True:
+        event = next_event()
+        if isinstance(event, Epilogue):
+            return None, None
+        if isinstance(event, File) and event.name == field and event.filename:
+            break
+
+    def chunks():
+        while True:
+            event = next_event()
+            if not isinstance(event, Data):
+                return
+            if event.data:
+                yield event.data
+            if not event.more_data:
+                return
+
+    return event.filename, chunks()
+
+
+def write_chunks(chunks, save_path):
+    """把数据块依次写入 save_path，边写边计算大小与 sha256。
+
+    超过 MAX_UPLOAD_BYTES 抛出 UploadTooLarge；任何异常都会删除写了一半的文件。
+    返回 (字节数, sha256 十六进制, 耗时秒)。
+    """
+    start = time.perf_counter()
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(save_path, "wb") as out:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise UploadTooLarge()
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        try:
+            os.remove(save_path)
+        except OSError:
+            pass
+        raise
+    return size, digest.hexdigest(), time.perf_counter() - start
+
+
+def encode_cursor(values):
+    """把游标值列表编码为不透明字符串"""
+    raw = json.dumps(values, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """解码 encode_cursor 生成的游标，非法时抛出 BadRequest"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw.decode("utf-8"))
+    except Exception:
+        raise BadRequest("invalid cursor")
+    if not isinstance(values, list) or len(values) != 2:
+        raise BadRequest("invalid cursor")
+    return values
+
+
+def like_pattern(text, prefix_only=False):
+    """构造转义后的 LIKE 模式（配合 ESCAPE '\\'）"""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{escaped}%" if prefix_only else f"%{escaped}%"
+
+
+def parse_time_arg(name, end_of_day=False):
+    """解析日期/时间查询参数（YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS），返回与数据库一致的字符串"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace("T", " "))
+    except ValueError:
+        raise BadRequest(f"invalid {name}")
+    if end_of_day and len(value) == 10:
+        dt = dt.replace(hour=23, minute=59, second=59)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def page_args(sorts, default_sort, default_order):
+    """解析通用的分页/排序参数，返回 (排序表达式, 是否倒序, 游标, 每页条数)"""
+    sort = request.args.get("sort", default_sort)
+    if sort not in sorts:
+        raise BadRequest(f"invalid sort, expected one of: {', '.join(sorts)}")
+    order = request.args.get("order", default_order).lower()
+    if order not in ("asc", "desc"):
+        raise BadRequest("invalid order")
+    try:
+        limit = int(request.args.get("limit", PAGE_SIZE_DEFAULT))
+    except ValueError:
+        raise BadRequest("invalid limit")
+    limit = max(1, min(limit, PAGE_SIZE_MAX))
+    cursor = request.args.get("cursor")
+    return sorts[sort], order == "desc", decode_cursor(cursor) if cursor else None, limit
+
+
+def keyset_page(db, base_sql, params, where, sort_expr, tie_expr, descending, cursor, limit):
+    """键集（keyset）分页：按 (sort_expr, tie_expr) 排序，从游标之后取 limit 条。
+
+    返回 (rows, next_cursor)，没有下一页时 next_cursor 为 None。
+    """
+    where = list(where)
+    params = list(params)
+    if cursor is not None:
+        where.append(f'({sort_expr}, {tie_expr}) {"<" if descending else ">"} (?, ?)')
+        params.extend(cursor)
+    direction = "DESC" if descending else "ASC"
+    sql = f'SELECT s.*, {sort_expr} AS sort_key, {tie_expr} AS tie_key FROM ({base_sql}) AS s'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += f' ORDER BY {sort_expr} {direction}, {tie_expr} {direction} LIMIT ?'
+    rows = db.execute(sql, params + [limit + 1]).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1]['sort_key'], rows[-1]['tie_key']])
+    return rows, next_cursor
+
+
 def login_required(func):
     """简单的登录保护装饰器"""
     @wraps(func)
@@ -73,6 +415,16 @@ def login_required(func):
         return func(*args, **kwargs)
     return wrapper
 
+@app.errorhandler(413)
+def handle_too_large(err):
+    return jsonify({"error": "file too large", "max_bytes": MAX_UPLOAD_BYTES}), 413
+
+
+@app.errorhandler(BadRequest)
+def handle_bad_request(err):
+    return jsonify({"error": str(err)}), 400
+
+
 @app.route("/.well-known/appspecific/com.chrome.devtools.json")
 def devtools_probe():
     return ("", 204)  # 或返回 {} / 你自定义的配置
@@ -106,57 +458,64 @@ def check_login():
 
 
 # ---------------- 文件夹管理 API ----------------
+# 文件夹列表可用的排序字段 -> 排序表达式（作用于 FOLDER_SUMMARY_SQL 的结果列）
+FOLDER_SORTS = {
+    "ip": "s.ip",
+    "last_upload_at": "COALESCE(s.last_upload_at, '')",
+    "video_count": "s.video_count",
+    "updated_at": "COALESCE(s.updated_at, '')",
+}
+
+# 视频列表可用的排序字段
+VIDEO_SORTS = {
+    "uploaded_at": "s.uploaded_at",
+    "file_size": "COALESCE(s.file_size, 0)",
+    "filename": "s.filename",
+}
+
+
 @app.route("/api/folders", methods=["GET"])
 @login_required
 def list_folders():
-    """获取所有文件夹列表"""
+    """获取文件夹列表（键集分页）
+
+    查询参数：limit、cursor、sort(ip|last_upload_at|video_count|updated_at)、order(asc|desc)、
+    status(online|offline)、q(备注包含)、ip_prefix(IP 前缀)、since/until(最近上传时间范围)
+    """
+    sort_expr, descending, cursor, limit = page_args(FOLDER_SORTS, "ip", "asc")
+    where, params = [], [f'-{ONLINE_WINDOW} seconds']
+
+    status = request.args.get("status")
+    if status not in (None, "", "online", "offline"):
+        raise BadRequest("invalid status")
+    if status and presence.started():
+        # 与返回的 online 字段同源：按在线状态索引筛选
+        where.append(f"s.ip {'IN' if status == 'online' else 'NOT IN'} (SELECT value FROM json_each(?))")
+        params.append(json.dumps(presence.online_ips()))
+    elif status:
+        where.append(f"s.online = {1 if status == 'online' else 0}")
+    q = request.args.get("q", "").strip()
+    if q:
+        where.append("s.remark LIKE ? ESCAPE '\\'")
+        params.append(like_pattern(q))
+    ip_prefix = request.args.get("ip_prefix", "").strip()
+    if ip_prefix:
+        where.append("s.ip LIKE ? ESCAPE '\\'")
+        params.append(like_pattern(ip_prefix, prefix_only=True))
+    since = parse_time_arg("since")
+    if since:
+        where.append('s.last_upload_at >= ?')
+        params.append(since)
+    until = parse_time_arg("until", end_of_day=True)
+    if until:
+        where.append('s.last_upload_at <= ?')
+        params.append(until)
+
     db = get_db()
-    folders = []
-    
-    for folder_name in sorted(os.listdir(UPLOAD_ROOT)):
-        folder_path_ = os.path.join(UPLOAD_ROOT, folder_name)
-        if os.path.isdir(folder_path_):
-            videos = [
-                v for v in os.listdir(folder_path_)
-                if v.lower().endswith((".mp4", ".avi", ".mov", ".webm", ".mkv"))
-            ]
-            
-            # 从数据库获取备注与配置
-            cursor = db.execute('SELECT remark, upload_enabled, webrtc_direct FROM folders WHERE ip = ?', (folder_name,))
-            row = cursor.fetchone()
-            remark = row['remark'] if row else ""
-            upload_enabled = int(row['upload_enabled']) if row and row['upload_enabled'] is not None else 1
-            webrtc_direct = int(row['webrtc_direct']) if row and row['webrtc_direct'] is not None else 0
-
-            # 最近上传时间（用于展示）
-            last_row = db.execute(
-                'SELECT uploaded_at FROM videos WHERE ip = ? ORDER BY uploaded_at DESC LIMIT 1',
-                (folder_name,)
-            ).fetchone()
-            last_upload_at = last_row['uploaded_at'] if last_row else None
-
-            # 在线状态：基于 folders.updated_at（由心跳接口维护），5 分钟内视为在线
-            upd_row = db.execute('SELECT updated_at FROM folders WHERE ip = ?', (folder_name,)).fetchone()
-            updated_at = upd_row['updated_at'] if upd_row else None
-            online = False
-            if updated_at:
-                try:
-                    upd_dt = datetime.strptime(updated_at, "%Y-%m-%d %H:%M:%S")
-                    online = (datetime.utcnow() - upd_dt).total_seconds() <= 5 * 60
-                except Exception:
-                    online = False
-            
-            folders.append({
-                "ip": folder_name,
-                "video_count": len(videos),
-                "remark": remark,
-                "last_upload_at": last_upload_at,
-                "online": online,
-                "upload_enabled": bool(upload_enabled),
-                "webrtc_direct": bool(webrtc_direct)
-            })
-    
-    return jsonify({"folders": folders})
+    rows, next_cursor = keyset_page(
+        db, FOLDER_SUMMARY_SQL, params, where, sort_expr, "s.ip", descending, cursor, limit
+    )
+    return jsonify({"folders": [folder_summary(row) for row in rows], "next_cursor": next_cursor})
 
 
 @app.route("/api/folders", methods=["POST"])
@@ -168,22 +527,19 @@ def create_folder():
     remark = data.get("remark", "")
     if not ip:
         return jsonify({"error": "ip required"}), 400
-    
+    check_ip(ip)
+
     db = get_db()
-    try:
-        # 插入数据库
+    rejected = purging_response(db, ip)
+    if rejected:
+        return rejected
+    # 插入数据库，如果已存在则更新备注
+    with database.transaction(db):
         db.execute(
-            'INSERT INTO folders (ip, remark, upload_enabled, webrtc_direct) VALUES (?, ?, ?, ?)',
+            'INSERT INTO folders (ip, remark, upload_enabled, webrtc_direct) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(ip) DO UPDATE SET remark = excluded.remark',
             (ip, remark, 1, 0)
         )
-        db.commit()
-    except sqlite3.IntegrityError:
-        # 如果已存在，则更新
-        db.execute(
-            'UPDATE folders SET remark = ? WHERE ip = ?',
-            (remark, ip)
-        )
-        db.commit()
     
     folder_path(ip)
     return jsonify({"msg": "created"})
@@ -192,51 +548,117 @@ def create_folder():
 @app.route("/api/folders/<ip>", methods=["GET"])
 @login_required
 def get_folder_detail(ip):
-    """获取文件夹详情和视频列表"""
-    path = folder_path(ip)
-    if not os.path.exists(path):
+    """获取文件夹详情和视频列表（键集分页）
+
+    查询参数：limit、cursor、sort(uploaded_at|file_size|filename)、order(asc|desc)、
+    q(文件名包含)、since/until(上传时间范围)
+    """
+    path = folder_dir(ip)
+    if not os.path.exists(path) or purge.is_deleted(get_db(), ip):
         return jsonify({"error": "文件夹不存在"}), 404
-    
+
+    sort_expr, descending, cursor, limit = page_args(VIDEO_SORTS, "uploaded_at", "desc")
+    where, params = [], [ip]
+    q = request.args.get("q", "").strip()
+    if q:
+        where.append("s.filename LIKE ? ESCAPE '\\'")
+        params.append(like_pattern(q))
+    since = parse_time_arg("since")
+    if since:
+        where.append('s.uploaded_at >= ?')
+        params.append(since)
+    until = parse_time_arg("until", end_of_day=True)
+    if until:
+        where.append('s.uploaded_at <= ?')
+        params.append(until)
+
+    # 视频列表来自 videos 表（按 uploaded_at 倒序），不再逐个 getmtime
+    db = get_db()
+    rows, next_cursor = keyset_page(
+        db, 'SELECT id, filename, file_size, uploaded_at, duration, video_codec, width, height, processed_at '
+            'FROM videos WHERE ip = ?',
+        params, where, sort_expr, "s.id", descending, cursor, limit
+    )
     videos = [
-        v for v in os.listdir(path)
-        if v.lower().endswith((".mp4", ".avi", ".mov", ".webm", ".mkv"))
+        {"id": r['id'], "filename": r['filename'], "file_size": r['file_size'], "uploaded_at": r['uploaded_at'],
+         "duration": r['duration'], "video_codec": r['video_codec'], "width": r['width'], "height": r['height'],
+         "processed": r['processed_at'] is not None}
+        for r in rows
     ]
-    # 按修改时间倒序排序
-    videos = sorted(videos, key=lambda v: os.path.getmtime(os.path.join(path, v)), reverse=True)
-    
+
     # 从数据库获取备注、配置、最近上传与在线状态
-    db = get_db()
-    cursor = db.execute('SELECT remark, upload_enabled, webrtc_direct FROM folders WHERE ip = ?', (ip,))
-    row = cursor.fetchone()
-    remark = row['remark'] if row else ""
-    upload_enabled = int(row['upload_enabled']) if row and row['upload_enabled'] is not None else 1
-    webrtc_direct = int(row['webrtc_direct']) if row and row['webrtc_direct'] is not None else 0
-
-    last_row = db.execute(
-        'SELECT uploaded_at FROM videos WHERE ip = ? ORDER BY uploaded_at DESC LIMIT 1',
-        (ip,)
+    row = db.execute(
+        FOLDER_SUMMARY_SQL + ' AND f.ip = ?',
+        (f'-{ONLINE_WINDOW} seconds', ip)
     ).fetchone()
-    last_upload_at = last_row['uploaded_at'] if last_row else None
+    summary = folder_summary(row) if row else {
+        "ip": ip, "remark": "", "video_count": 0, "last_upload_at": None, "online": False,
+        "upload_enabled": True, "webrtc_direct": False,
+    }
 
-    # 在线状态：基于 folders.updated_at（5 分钟内在线）
-    upd_row = db.execute('SELECT updated_at FROM folders WHERE ip = ?', (ip,)).fetchone()
-    updated_at = upd_row['updated_at'] if upd_row else None
-    online = False
-    if updated_at:
-        try:
-            upd_dt = datetime.strptime(updated_at, "%Y-%m-%d %H:%M:%S")
-            online = (datetime.utcnow() - upd_dt).total_seconds() <= 5 * 60
-        except Exception:
-            online = False
-    
     return jsonify({
         "ip": ip,
-        "remark": remark,
+        "remark": summary["remark"],
+        "video_count": summary["video_count"],
         "videos": videos,
-        "last_upload_at": last_upload_at,
-        "online": online,
-        "upload_enabled": bool(upload_enabled),
-        "webrtc_direct": bool(webrtc_direct)
+        "next_cursor": next_cursor,
+        "last_upload_at": summary["last_upload_at"],
+        "online": summary["online"],
+        "upload_enabled": summary["upload_enabled"],
+        "webrtc_direct": summary["webrtc_direct"],
+        "retention": folder_retention(db, ip),
+    })
+
+
+def folder_retention(db, ip):
+    """文件夹的保留策略：overrides 为单独设置的值（null 使用默认），effective 为生效值"""
+    row = db.execute('SELECT retention_days, retention_bytes, retention_count FROM folders WHERE ip = ?', (ip,)).fetchone()
+    if row is None:
+        return {"overrides": dict.fromkeys(retention.POLICY_FIELDS), "effective": retention.defaults()}
+    return {"overrides": {k: row[k] for k in retention.POLICY_FIELDS}, "effective": retention.effective_policy(row)}
+
+
+@app.route("/api/folders/<ip>/retention", methods=["PUT"])
+@login_required
+def update_retention(ip):
+    """设置文件夹保留策略：retention_days / retention_bytes / retention_count，
+    null 使用全局默认值，0 不限制；未传的字段保持不变"""
+    data = request.json or {}
+    values = {}
+    for field in retention.POLICY_FIELDS:
+        if field not in data:
+            continue
+        value = data[field]
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+            return jsonify({"error": f"invalid {field}"}), 400
+        values[field] = value
+    db = get_db()
+    rejected = purging_response(db, ip)
+    if rejected:
+        return rejected
+    with database.transaction(db):
+        if not db.execute('SELECT 1 FROM folders WHERE ip = ?', (ip,)).fetchone():
+            return jsonify({"error": "not found"}), 404
+        for field, value in values.items():
+            db.execute(f'UPDATE folders SET {field} = ? WHERE ip = ?', (value, ip))
+    return jsonify({"msg": "ok", "retention": folder_retention(db, ip)})
+
+
+@app.route("/api/retention", methods=["GET"])
+@login_required
+def retention_status():
+    """全局保留策略，以及按当前策略下一轮会删除的录像数量与字节数（预览，不删除）"""
+    report = retention.summarize(get_db())
+    return jsonify({
+        "defaults": retention.defaults(),
+        "total_bytes_limit": retention.RETENTION_TOTAL_BYTES,
+        "interval": retention.RETENTION_INTERVAL,
+        "pending": {
+            "count": report["count"],
+            "bytes": report["bytes"],
+            "by_reason": report["by_reason"],
+            "folders": report["folders"],
+        },
     })
 
 
@@ -251,10 +673,13 @@ def update_remark(ip):
     cursor = db.execute('SELECT ip FROM folders WHERE ip = ?', (ip,))
     if not cursor.fetchone():
         return jsonify({"error": "not found"}), 404
+    rejected = purging_response(db, ip)
+    if rejected:
+        return rejected
     
     # 更新备注
     db.execute(
-        'UPDATE folders SET remark = ?, updated_at = CURRENT_TIMESTAMP WHERE ip = ?',
+        'UPDATE folders SET remark = ? WHERE ip = ?',
         (data.get("remark", ""), ip)
     )
     db.commit()
@@ -265,129 +690,694 @@ def update_remark(ip):
 @app.route("/api/folders/<ip>", methods=["DELETE"])
 @login_required
 def delete_folder(ip):
-    """删除文件夹"""
+    """删除文件夹：目录移入回收站并标记墓碑后立即返回 202，文件与视频记录由后台清除（见 purge.py），
+    进度通过 /api/purges/<id> 查询"""
     db = get_db()
-    
-    # 从数据库删除
-    db.execute('DELETE FROM folders WHERE ip = ?', (ip,))
+    folder = folder_dir(ip)
+    try:
+        purge_id = purge.create(db, UPLOAD_ROOT, ip, folder)
+    except OSError as e:
+        # 例如 Windows 下目录中的文件正被占用，文件夹保持原样
+        return jsonify({"error": f"delete failed: {e}"}), 409
+    presence.forget(ip)
+    row = db.execute(PURGE_SQL + ' WHERE id = ?', (purge_id,)).fetchone()
+    return jsonify({"msg": "deleted", "purge": purge_dict(row)}), 202
+
+
+# ---------------- 后台清除进度 API ----------------
+PURGE_SQL = '''
+    SELECT id, ip, status, files_total, bytes_total, files_deleted, bytes_deleted, error,
+        created_at, started_at, finished_at
+    FROM purges
+'''
+
+
+def purge_dict(row):
+    item = {k: row[k] for k in (
+        "id", "ip", "status", "files_total", "bytes_total", "files_deleted", "bytes_deleted", "error",
+        "created_at", "started_at", "finished_at"
+    )}
+    # 进度按字节计算（统计列记录的是删除时的总量）
+    total = row['bytes_total'] or 0
+    item["progress"] = 1.0 if row['status'] == 'done' else (
+        min(row['bytes_deleted'] / total, 1.0) if total else 0.0
+    )
+    return item
+
+
+@app.route("/api/purges", methods=["GET"])
+@login_required
+def list_purges():
+    """清除任务列表（按 id 倒序键集分页）。查询参数：status、ip、limit、cursor"""
+    sort_expr, descending, cursor, limit = page_args({"id": "s.id"}, "id", "desc")
+    where, params = [], []
+    status = request.args.get("status")
+    if status:
+        if status not in purge.STATUSES:
+            raise BadRequest(f"invalid status, expected one of: {', '.join(purge.STATUSES)}")
+        where.append('s.status = ?')
+        params.append(status)
+    if request.args.get("ip"):
+        where.append('s.ip = ?')
+        params.append(request.args["ip"])
+    rows, next_cursor = keyset_page(get_db(), PURGE_SQL, params, where, sort_expr, "s.id", descending, cursor, limit)
+    return jsonify({"purges": [purge_dict(r) for r in rows], "next_cursor": next_cursor})
+
+
+@app.route("/api/purges/<int:purge_id>", methods=["GET"])
+@login_required
+def get_purge(purge_id):
+    row = get_db().execute(PURGE_SQL + ' WHERE id = ?', (purge_id,)).fetchone()
+    if row is None:
+        return jsonify({"error": "not found"}), 404
+    return jsonify(purge_dict(row))
+
+
+# ---------------- 后台处理任务 API ----------------
+JOB_SQL = '''
+    SELECT j.id, j.video_id, v.ip, v.filename, j.status, j.action, j.attempts, j.progress, j.error,
+        j.created_at, j.started_at, j.finished_at
+    FROM jobs j LEFT JOIN videos v ON v.id = j.video_id
+'''
+
+
+def job_dict(row):
+    return {k: row[k] for k in (
+        "id", "video_id", "ip", "filename", "status", "action", "attempts", "progress", "error",
+        "created_at", "started_at", "finished_at"
+    )}
+
+
+@app.route("/api/jobs", methods=["GET"])
+@login_required
+def list_jobs():
+    """任务列表（按 id 倒序键集分页）及各状态计数。查询参数：status、ip、video_id、limit、cursor"""
+    sort_expr, descending, cursor, limit = page_args({"id": "s.id"}, "id", "desc")
+    where, params = [], []
+    status = request.args.get("status")
+    if status:
+        if status not in jobs.STATUSES:
+            raise BadRequest(f"invalid status, expected one of: {', '.join(jobs.STATUSES)}")
+        where.append('s.status = ?')
+        params.append(status)
+    if request.args.get("ip"):
+        where.append('s.ip = ?')
+        params.append(request.args["ip"])
+    if request.args.get("video_id"):
+        where.append('s.video_id = ?')
+        params.append(request.args.get("video_id", type=int))
+
+    db = get_db()
+    rows, next_cursor = keyset_page(db, JOB_SQL, params, where, sort_expr, "s.id", descending, cursor, limit)
+    counts = {st: 0 for st in jobs.STATUSES}
+    counts.update({r['status']: r['n'] for r in db.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status')})
+    return jsonify({"jobs": [job_dict(r) for r in rows], "counts": counts, "next_cursor": next_cursor})
+
+
+@app.route("/api/jobs/<int:job_id>", methods=["GET"])
+@login_required
+def get_job(job_id):
+    row = get_db().execute(JOB_SQL + ' WHERE j.id = ?', (job_id,)).fetchone()
+    if row is None:
+        return jsonify({"error": "not found"}), 404
+    return jsonify(job_dict(row))
+
+
+@app.route("/api/jobs/<int:job_id>/retry", methods=["POST"])
+@login_required
+def retry_job(job_id):
+    """失败（或已完成）的任务重新排队"""
+    db = get_db()
+    cur = db.execute(
+        "UPDATE jobs SET status = 'queued', attempts = 0, progress = 0, error = NULL, finished_at = NULL "
+        "WHERE id = ? AND status IN ('failed', 'done')", (job_id,)
+    )
     db.commit()
-    
-    # 删除物理文件夹
-    path = folder_path(ip)
-    if os.path.exists(path):
-        shutil.rmtree(path)
-    
-    return jsonify({"msg": "deleted"})
+    row = db.execute(JOB_SQL + ' WHERE j.id = ?', (job_id,)).fetchone()
+    if row is None:
+        return jsonify({"error": "not found"}), 404
+    if cur.rowcount == 0:
+        return jsonify({"error": "job is not finished", "job": job_dict(row)}), 409
+    return jsonify(job_dict(row))
 
 
 # ---------------- 视频管理 API ----------------
 @app.route("/uploads/<ip>/<filename>")
 @login_required
 def serve_video(ip, filename):
-    """提供视频文件访问"""
-    path = folder_path(ip)
-    return send_from_directory(path, filename, mimetype="video/mp4")
+    """提供视频文件访问
+
+    支持 Range/206 断点拖动、ETag/Last-Modified 与 304；按容器格式返回正确的 MIME。
+    在 WSGI 服务器提供 wsgi.file_wrapper 时（如 gunicorn）走 sendfile 零拷贝；
+    VIDEO_OFFLOAD=x-accel / x-sendfile 时交给前置的 Nginx / Apache 发送文件。
+    """
+    path = safe_join(folder_dir(ip), filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "not found"}), 404
+    mimetype = video_mimetype(filename)
+
+    if VIDEO_OFFLOAD == "x-accel":
+        # Nginx 内部跳转：由 Nginx 处理 Range / 缓存头并直接发送文件
+        resp = app.response_class(status=200, mimetype=mimetype)
+        resp.headers["X-Accel-Redirect"] = f"{X_ACCEL_PREFIX}/{quote(os.path.basename(os.path.dirname(path)))}/{quote(filename)}"
+        resp.headers["Cache-Control"] = f"private, max-age={VIDEO_MAX_AGE}"
+        return resp
+
+    # X-Sendfile 模式由 app.config["USE_X_SENDFILE"] 交给 send_file 处理
+    resp = send_file(path, mimetype=mimetype, conditional=True, etag=True, max_age=VIDEO_MAX_AGE)
+    resp.headers["Accept-Ranges"] = "bytes"
+    resp.cache_control.private = True
+    resp.cache_control.public = False
+    return resp
+
+
+@app.route("/api/thumbs/<ip>/<filename>")
+@login_required
+def serve_thumb(ip, filename):
+    """视频封面（?kind=sprite 为横向预览条）。缓存未命中时现场生成"""
+    kind = request.args.get("kind", "poster")
+    if kind not in thumbs.KINDS:
+        return jsonify({"error": "invalid kind"}), 400
+    path = safe_join(folder_dir(ip), filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "not found"}), 404
+
+    row = get_db().execute('SELECT sha256 FROM videos WHERE ip = ? AND filename = ?', (ip, filename)).fetchone()
+    sha256 = row['sha256'] if row else None
+    thumb = thumbs.get(path, sha256, kind)
+    if thumb is None:
+        return jsonify({"error": "thumbnail unavailable"}), 404
+
+    # ETag 用缓存键，Last-Modified 用视频本身的修改时间：LRU 刷新缓存文件时间不影响 304
+    resp = send_file(
+        thumb, mimetype="image/jpeg", conditional=True,
+        etag=os.path.basename(thumb), last_modified=os.path.getmtime(path), max_age=THUMB_MAX_AGE
+    )
+    resp.cache_control.private = True
+    resp.cache_control.public = False
+    return resp
 
 
 @app.route("/api/upload/<ip>", methods=["POST"])
 def upload_video(ip):
-    """上传视频（不需登录，文件名为时间）"""
-    folder = folder_path(ip)
-    if "file" not in request.files:
-        return jsonify({"error": "no file"}), 400
-    
-    f = request.files["file"]
-    if f.filename == "":
+    """上传视频（不需登录，文件名为时间）
+
+    请求体按块直接写入 uploads/<ip>/ 下的最终文件，不经过临时文件，内存占用固定：
+    - multipart/form-data：字段名 file
+    - application/octet-stream：原始字节，原文件名（用于取扩展名）取自 ?filename= 或 X-Filename 头
+
+    幂等：带 Idempotency-Key 头，或用 X-Content-SHA256 头 / ?sha256= 预先声明内容哈希时，
+    已上传过的视频直接返回原记录（duplicate=true），不再写盘；内容与已有视频相同时也不会重复保存。
+    """
+    check_ip(ip)
+    db = get_db()
+    rejected = purging_response(db, ip)
+    if rejected:
+        return rejected
+    idempotency_key = request.headers.get("Idempotency-Key") or None
+    declared_sha256 = (request.headers.get("X-Content-SHA256") or request.args.get("sha256") or "").lower() or None
+    existing = find_duplicate(db, ip, declared_sha256, idempotency_key)
+    if existing:
+        return duplicate_response(ip, existing)
+
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        return jsonify({"error": "file too large", "max_bytes": MAX_UPLOAD_BYTES}), 413
+
+    if request.mimetype == "multipart/form-data":
+        boundary = request.mimetype_params.get("boundary")
+        if not boundary:
+            return jsonify({"error": "no file"}), 400
+        try:
+            original_name, chunks = multipart_file_stream(request.stream, boundary)
+        except (ClientDisconnected, ValueError) as e:
+            # 查找文件字段时请求体已格式错误或被截断
+            print(f"[UPLOAD] {request.remote_addr} 上传中断: {e}")
+            return jsonify({"error": "upload incomplete"}), 400
+    elif request.mimetype == "application/octet-stream":
+        original_name = request.args.get("filename") or request.headers.get("X-Filename", "")
+        chunks = iter(lambda: request.stream.read(UPLOAD_CHUNK_SIZE), b"")
+    else:
+        return jsonify({"error": "unsupported content type"}), 415
+    if chunks is None:
         return jsonify({"error": "no file"}), 400
 
-    # 用时间生成文件名
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    ext = os.path.splitext(f.filename)[1] or ".mp4"
-    filename = f"{timestamp}{ext}"
+    folder = folder_path(ip)
+    filename, save_path = reserve_video_path(folder, original_name)
+
+    try:
+        file_size, sha256, elapsed = write_chunks(chunks, save_path)
+    except UploadTooLarge:
+        return jsonify({"error": "file too large", "max_bytes": MAX_UPLOAD_BYTES}), 413
+    except (ClientDisconnected, ValueError) as e:
+        print(f"[UPLOAD] {request.remote_addr} 上传中断: {e}")
+        return jsonify({"error": "upload incomplete"}), 400
+
+    # 上传期间文件夹被删除：文件已随目录移入回收站，不再登记
+    rejected = purging_response(db, ip)
+    if rejected:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(save_path)
+        return rejected
+
+    # 内容与已有视频相同：丢弃新文件，返回原记录
+    existing = find_duplicate(db, ip, sha256)
+    if existing is None:
+        # 记录到数据库（不在上传时更新在线状态，改由心跳接口维护）
+        existing = record_video(db, ip, filename, file_size, sha256, idempotency_key)
+    if existing:
+        os.remove(save_path)
+        print(f"[UPLOAD] {request.remote_addr} 重复上传，沿用 {existing['filename']}")
+        return duplicate_response(ip, existing)
+
+    thumbs.submit_all(save_path, sha256)
+    throughput = file_size / elapsed / (1024 * 1024) if elapsed > 0 else 0.0
+    print(f"[UPLOAD] {request.remote_addr} 上传 {filename} -> {folder} ({file_size} 字节, {throughput:.1f} MB/s)")
+    return jsonify({
+        "filename": filename,
+        "ip": ip,
+        "size": file_size,
+        "sha256": sha256,
+        "duplicate": False,
+        "elapsed": round(elapsed, 3),
+        "throughput_mbps": round(throughput, 2),
+    })
+
+
+# ---------------- 断点续传 API ----------------
+def session_root():
+    """分块临时文件目录（uploads/.sessions）"""
+    return os.path.join(UPLOAD_ROOT, UPLOAD_SESSION_DIR)
+
+
+def session_part_path(upload_id):
+    """会话对应的分块临时文件"""
+    return os.path.join(session_root(), f"{upload_id}.part")
+
+
+def merge_ranges(chunks):
+    """把 (offset, length) 列表合并为按起点排序的 [start, end) 区间列表"""
+    merged = []
+    for offset, length in sorted((offset, length) for offset, length in chunks):
+        end = offset + length
+        if merged and offset <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([offset, end])
+    return merged
+
+
+def missing_ranges(received, size):
+    """received 为已合并区间，返回 [0, size) 内尚未收到的区间"""
+    missing, pos = [], 0
+    for start, end in received:
+        if start > pos:
+            missing.append([pos, start])
+        pos = max(pos, end)
+    if pos < size:
+        missing.append([pos, size])
+    return missing
+
+
+def load_session(db, ip, upload_id):
+    """读取属于该 IP 的上传会话，不存在时返回 None"""
+    return db.execute(
+        'SELECT id, ip, filename, size, sha256, idempotency_key FROM upload_sessions WHERE id = ? AND ip = ?',
+        (upload_id, ip)
+    ).fetchone()
+
+
+def session_status(db, row):
+    """会话的接收进度"""
+    received = merge_ranges(db.execute(
+        'SELECT offset, length FROM upload_chunks WHERE upload_id = ?', (row['id'],)
+    ).fetchall())
+    missing = missing_ranges(received, row['size'])
+    return {
+        "upload_id": row['id'],
+        "ip": row['ip'],
+        "size": row['size'],
+        "received": received,
+        "received_bytes": sum(end - start for start, end in received),
+        "missing": missing,
+        "complete": not missing,
+    }
+
+
+def drop_session(db, upload_id):
+    """删除会话记录及其分块文件（调用方负责 commit）"""
+    db.execute('DELETE FROM upload_chunks WHERE upload_id = ?', (upload_id,))
+    db.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+    try:
+        os.remove(session_part_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+
+@app.route("/api/upload/<ip>/sessions", methods=["POST"])
+def create_upload_session(ip):
+    """创建断点续传会话（不需登录）
+
+    请求 JSON：{"filename": 原文件名, "size": 总字节数, "sha256": 可选，完成时校验}
+    """
+    check_ip(ip)
+    data = request.json or {}
+    try:
+        size = int(data.get("size"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "size required"}), 400
+    if size <= 0:
+        return jsonify({"error": "size required"}), 400
+    if size > MAX_UPLOAD_BYTES:
+        return jsonify({"error": "file too large", "max_bytes": MAX_UPLOAD_BYTES}), 413
 
-    save_path = os.path.join(folder, filename)
-    f.save(save_path)
-    
-    # 记录到数据库
     db = get_db()
+    rejected = purging_response(db, ip)
+    if rejected:
+        return rejected
+    # 已上传过相同内容：无需建立会话
+    sha256 = (data.get("sha256") or "").lower() or None
+    existing = find_duplicate(db, ip, sha256, request.headers.get("Idempotency-Key") or None)
+    if existing:
+        return duplicate_response(ip, existing)
+
+    upload_id = secrets.token_hex(16)
+    os.makedirs(session_root(), exist_ok=True)
+    # 预先设定文件长度（稀疏文件），各分块可按偏移乱序/并行写入
+    with open(session_part_path(upload_id), "wb") as f:
+        f.truncate(size)
+
+    db.execute(
+        'INSERT INTO upload_sessions (id, ip, filename, size, sha256, idempotency_key) VALUES (?, ?, ?, ?, ?, ?)',
+        (upload_id, ip, data.get("filename") or "", size, sha256, request.headers.get("Idempotency-Key") or None)
+    )
+    db.commit()
+    return jsonify({"upload_id": upload_id, "ip": ip, "size": size, "chunk_size": UPLOAD_SESSION_CHUNK}), 201
+
+
+@app.route("/api/upload/<ip>/sessions/<upload_id>", methods=["PUT"])
+def put_upload_chunk(ip, upload_id):
+    """上传一个分块：请求体为原始字节，写入位置由 ?offset= 或 Content-Range: bytes a-b/total 指定
+
+    分块可乱序、并行发送；中途断开时已写入的部分同样会被记录。
+    """
+    db = get_db()
+    row = load_session(db, ip, upload_id)
+    if not row:
+        return jsonify({"error": "session not found"}), 404
+
+    content_range = request.headers.get("Content-Range", "")
+    match = re.fullmatch(r"bytes (\d+)-(\d+)/(\d+|\*)", content_range.strip())
+    try:
+        offset = int(match.group(1)) if match else int(request.args.get("offset", ""))
+    except ValueError:
+        return jsonify({"error": "offset required"}), 400
+    length = request.content_length
+    if length is None and match:
+        length = int(match.group(2)) - offset + 1
+    if length is None or offset < 0 or offset + length > row['size']:
+        return jsonify({"error": "chunk out of range", "size": row['size']}), 416
+
+    written = 0
+    error = None
     try:
-        # 记录视频文件
-        file_size = os.path.getsize(save_path)
+        with open(session_part_path(upload_id), "r+b") as f:
+            f.seek(offset)
+            while written < length:
+                chunk = request.stream.read(min(UPLOAD_CHUNK_SIZE, length - written))
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+    except FileNotFoundError:
+        return jsonify({"error": "session not found"}), 404
+    except ClientDisconnected as e:
+        error = e
+
+    if written:
         db.execute(
-            'INSERT INTO videos (ip, filename, file_size) VALUES (?, ?, ?)',
-            (ip, filename, file_size)
+            'INSERT OR REPLACE INTO upload_chunks (upload_id, offset, length) VALUES (?, ?, ?)',
+            (upload_id, offset, written)
         )
-        # 不在上传时更新在线状态，改由心跳接口维护
+    db.execute('UPDATE upload_sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?', (upload_id,))
+    db.commit()
+    if error is not None or written < length:
+        return jsonify({"error": "chunk incomplete", "written": written}), 400
+    return jsonify(session_status(db, row))
+
+
+@app.route("/api/upload/<ip>/sessions/<upload_id>", methods=["GET"])
+def get_upload_session(ip, upload_id):
+    """查询会话进度：已收到 / 仍缺失的字节区间"""
+    db = get_db()
+    row = load_session(db, ip, upload_id)
+    if not row:
+        return jsonify({"error": "session not found"}), 404
+    return jsonify(session_status(db, row))
+
+
+@app.route("/api/upload/<ip>/sessions/<upload_id>/complete", methods=["POST"])
+def complete_upload_session(ip, upload_id):
+    """完成上传：校验完整性后原子重命名到 uploads/<ip>/ 并登记 videos"""
+    db = get_db()
+    row = load_session(db, ip, upload_id)
+    if not row:
+        return jsonify({"error": "session not found"}), 404
+    status = session_status(db, row)
+    if not status["complete"]:
+        return jsonify({"error": "upload incomplete", "missing": status["missing"]}), 409
+
+    part_path = session_part_path(upload_id)
+    digest = hashlib.sha256()
+    with open(part_path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    sha256 = digest.hexdigest()
+    if row['sha256'] and row['sha256'] != sha256:
+        return jsonify({"error": "checksum mismatch", "sha256": sha256}), 422
+    rejected = purging_response(db, ip)
+    if rejected:
+        return rejected
+
+    existing = find_duplicate(db, ip, sha256, row['idempotency_key'])
+    if existing:
+        drop_session(db, upload_id)
         db.commit()
-    except Exception as e:
-        print(f"数据库记录失败: {e}")
+        return duplicate_response(ip, existing)
+
+    filename, save_path = reserve_video_path(folder_path(ip), row['filename'])
+    try:
+        os.replace(part_path, save_path)
+    except FileNotFoundError:
+        # 并发的另一次 complete 已经完成
+        os.remove(save_path)
+        return jsonify({"error": "session not found"}), 404
+    # 先登记再删除会话：登记失败回滚时不会连带撤销会话的删除，文件放回原处，会话仍可重试
+    try:
+        existing = record_video(db, ip, filename, row['size'], sha256, row['idempotency_key'])
+    except Exception:
+        os.replace(save_path, part_path)
+        raise
+    drop_session(db, upload_id)
+    db.commit()
+    if existing:
+        os.remove(save_path)
+        return duplicate_response(ip, existing)
+    thumbs.submit_all(save_path, sha256)
+
+    print(f"[UPLOAD] {request.remote_addr} 断点续传完成 {filename} -> {ip} ({row['size']} 字节)")
+    return jsonify({"filename": filename, "ip": ip, "size": row['size'], "sha256": sha256, "duplicate": False})
+
+
+@app.route("/api/upload/<ip>/sessions/<upload_id>", methods=["DELETE"])
+def abort_upload_session(ip, upload_id):
+    """放弃上传会话"""
+    db = get_db()
+    if not load_session(db, ip, upload_id):
+        return jsonify({"error": "session not found"}), 404
+    drop_session(db, upload_id)
+    db.commit()
+    return jsonify({"msg": "aborted"})
+
+
+def gc_upload_sessions():
+    """回收闲置超过 UPLOAD_SESSION_TTL 的会话，以及没有会话记录的孤立分块文件"""
+    db = database.get(DB_PATH)
+    try:
+        with database.transaction(db):
+            expired = [r[0] for r in db.execute(
+                "SELECT id FROM upload_sessions WHERE updated_at < datetime('now', ?)",
+                (f'-{UPLOAD_SESSION_TTL} seconds',)
+            )]
+            for upload_id in expired:
+                drop_session(db, upload_id)
+
+        if os.path.isdir(session_root()):
+            alive = {r[0] for r in db.execute('SELECT id FROM upload_sessions')}
+            cutoff = time.time() - UPLOAD_SESSION_TTL
+            for entry in os.scandir(session_root()):
+                upload_id = entry.name[:-len(".part")]
+                if entry.name.endswith(".part") and upload_id not in alive and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+        if expired:
+            print(f"[UPLOAD] 回收过期上传会话 {len(expired)} 个")
+        return len(expired)
+    finally:
+        database.release(db)
+
+
+def start_upload_session_gc():
+    """后台线程定期回收过期的上传会话"""
+    def loop():
+        while True:
+            try:
+                gc_upload_sessions()
+            except Exception as e:
+                print(f"[UPLOAD] 回收上传会话失败: {e}")
+            time.sleep(UPLOAD_SESSION_GC_INTERVAL)
 
-    print(f"[UPLOAD] {request.remote_addr} 上传 {filename} -> {folder}")
-    return jsonify({"filename": filename, "ip": ip})
+    threading.Thread(target=loop, name="upload-session-gc", daemon=True).start()
 
 
 # ---------------- 心跳/在线状态 API ----------------
+# 心跳只写内存，由后台线程每隔 HEARTBEAT_FLUSH_INTERVAL 秒批量写入 folders.updated_at
+# （一次事务一次 fsync），进程退出时再写一次。客户端配置也从内存返回，
+# 每次写入后从数据库刷新，多进程部署时其他进程的修改最多延迟一个间隔可见。
+HEARTBEAT_FLUSH_INTERVAL = 3
+
+_heartbeat_lock = threading.Lock()
+_heartbeat_pending = {}   # ip -> 最近心跳时间（UTC，与 CURRENT_TIMESTAMP 同格式），尚未写入数据库
+_folder_config = {}       # ip -> (upload_enabled, webrtc_direct)
+
+
+def utc_now():
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+
+def load_folder_config(db):
+    """从数据库重新加载全部客户端配置"""
+    rows = db.execute('SELECT ip, upload_enabled, webrtc_direct FROM folders').fetchall()
+    config = {
+        r[0]: (bool(r[1]) if r[1] is not None else True, bool(r[2]))
+        for r in rows
+    }
+    with _heartbeat_lock:
+        _folder_config.clear()
+        _folder_config.update(config)
+
+
+def set_folder_config(ip, upload_enabled=None, webrtc_direct=None):
+    """本进程内修改配置后同步更新内存"""
+    with _heartbeat_lock:
+        old_upload, old_direct = _folder_config.get(ip, (True, False))
+        _folder_config[ip] = (
+            old_upload if upload_enabled is None else bool(upload_enabled),
+            old_direct if webrtc_direct is None else bool(webrtc_direct),
+        )
+
+
+def flush_heartbeats():
+    """把内存中的心跳批量写入数据库，返回写入条数。写入失败时放回内存，下次重试"""
+    global _heartbeat_pending
+    with _heartbeat_lock:
+        pending, _heartbeat_pending = _heartbeat_pending, {}
+    db = database.get(DB_PATH)
+    try:
+        if pending:
+            try:
+                with database.transaction(db):
+                    # 新 IP 直接建档；乱序到达时保留较新的时间
+                    db.executemany('''
+                        INSERT INTO folders (ip, updated_at) VALUES (?, ?)
+                        ON CONFLICT(ip) DO UPDATE SET updated_at = excluded.updated_at
+                        WHERE folders.updated_at IS NULL OR excluded.updated_at > folders.updated_at
+                    ''', list(pending.items()))
+            except sqlite3.Error:
+                with _heartbeat_lock:
+                    for ip, seen in pending.items():
+                        if seen > _heartbeat_pending.get(ip, ""):
+                            _heartbeat_pending[ip] = seen
+                raise
+        load_folder_config(db)
+        presence.sync_from_db(db)
+    finally:
+        database.release(db)
+    return len(pending)
+
+
+def start_heartbeat_flusher():
+    """后台线程定期写入心跳；进程正常退出时补写最后一批"""
+    def loop():
+        while True:
+            time.sleep(HEARTBEAT_FLUSH_INTERVAL)
+            try:
+                flush_heartbeats()
+            except Exception as e:
+                print(f"[HEARTBEAT] 写入心跳失败: {e}")
+
+    db = database.get(DB_PATH)
+    try:
+        load_folder_config(db)
+    finally:
+        database.release(db)
+    atexit.register(flush_heartbeats)
+    threading.Thread(target=loop, name="heartbeat-flush", daemon=True).start()
+
+
 @app.route("/api/heartbeat/<ip>", methods=["GET"])
 def heartbeat(ip):
-    """心跳：更新 folders.updated_at，并可同时上报配置（upload_enabled、webrtc_direct）。
+    """心跳：记录在线时间（批量写入 folders.updated_at），返回该客户端的配置（upload_enabled、webrtc_direct）。
     无需登录。客户端可周期性调用（例如每 60 秒）。
     """
-    print(f"[HEARTBEAT] {ip} 心跳")
-    db = get_db()
-    try:
-        # 确保文件夹记录存在
-        cursor = db.execute('SELECT ip FROM folders WHERE ip = ?', (ip,))
-        if not cursor.fetchone():
-            db.execute('INSERT INTO folders (ip) VALUES (?)', (ip,))
-        
-        # 不在上传时更新在线状态，改由心跳接口维护
-        db.commit()
-    except Exception as e:
-        print(f"数据库记录失败: {e}")
-    # # 确保文件夹记录存在 todo
-    # cursor = db.execute('SELECT ip FROM folders WHERE ip = ?', (ip,))
-    # if not cursor.fetchone():
-    #     db.execute('INSERT INTO folders (ip, upload_enabled, webrtc_direct) VALUES (?, ?, ?)', (ip, 1, 0))
-    # # 更新心跳时间
-    # payload = request.json or {}
-    # # 仅当提供时才更新配置
-    # if 'upload_enabled' in payload or 'webrtc_direct' in payload:
-    #     upload_enabled = payload.get('upload_enabled')
-    #     webrtc_direct = payload.get('webrtc_direct')
-    #     if upload_enabled is not None and webrtc_direct is not None:
-    #         db.execute('UPDATE folders SET updated_at = CURRENT_TIMESTAMP, upload_enabled = ?, webrtc_direct = ? WHERE ip = ?', (1 if upload_enabled else 0, 1 if webrtc_direct else 0, ip))
-    #     elif upload_enabled is not None:
-    #         db.execute('UPDATE folders SET updated_at = CURRENT_TIMESTAMP, upload_enabled = ? WHERE ip = ?', (1 if upload_enabled else 0, ip))
-    #     elif webrtc_direct is not None:
-    #         db.execute('UPDATE folders SET updated_at = CURRENT_TIMESTAMP, webrtc_direct = ? WHERE ip = ?', (1 if webrtc_direct else 0, ip))
-    # else:
-    #     db.execute('UPDATE folders SET updated_at = CURRENT_TIMESTAMP WHERE ip = ?', (ip,))
-    # db.commit()
-    # 返回当前状态
-    row = db.execute('SELECT updated_at, upload_enabled, webrtc_direct FROM folders WHERE ip = ?', (ip,)).fetchone()
+    now = utc_now()
+    with _heartbeat_lock:
+        _heartbeat_pending[ip] = now
+        upload_enabled, webrtc_direct = _folder_config.get(ip, (True, False))
+    presence.seen(ip)
     return jsonify({
         "msg": "ok",
         "ip": ip,
-        "updated_at": row['updated_at'] if row else None,
-        "upload_enabled": bool(row['upload_enabled']) if row else True,
-        "webrtc_direct": bool(row['webrtc_direct']) if row else False,
+        "updated_at": now,
+        "upload_enabled": upload_enabled,
+        "webrtc_direct": webrtc_direct,
     })
 
 
+@app.route("/api/presence", methods=["GET"])
+@login_required
+def get_presence():
+    """当前在线的客户端"""
+    return jsonify({"online": presence.online_ips(), "window": ONLINE_WINDOW})
+
+
+@app.route("/api/presence/stream", methods=["GET"])
+@login_required
+def presence_stream():
+    """在线状态推送（Server-Sent Events）：连接时发送 snapshot 事件（当前在线列表），之后逐条推送上线 / 下线"""
+    q = presence.subscribe()
+    if q is None:
+        return jsonify({"error": "too many presence streams"}), 503
+    resp = Response(stream_with_context(presence.sse_stream(q)), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    # 禁止 Nginx 缓冲，事件才能即时到达
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
 @app.route("/api/folders/<ip>/webrtc_direct", methods=["PATCH"])
 def update_webrtc_direct(ip):
-    """更新 WebRTC 直连状态（无需登录，供 webrtc_server 调用）"""
+    """更新 WebRTC 直连状态（无需登录，webrtc_server 无法直接写数据库时调用）"""
     data = request.json or {}
     webrtc_direct = data.get("webrtc_direct", False)
     db = get_db()
     try:
-        # 确保文件夹记录存在
-        cursor = db.execute('SELECT ip FROM folders WHERE ip = ?', (ip,))
-        if not cursor.fetchone():
-            db.execute('INSERT INTO folders (ip, upload_enabled, webrtc_direct) VALUES (?, ?, ?)', (ip, 1, 0))
-        # 更新 webrtc_direct
-        db.execute('UPDATE folders SET webrtc_direct = ? WHERE ip = ?', (1 if webrtc_direct else 0, ip))
-        db.commit()
+        # 确保文件夹记录存在，并更新 webrtc_direct
+        with database.transaction(db):
+            db.execute(
+                'INSERT INTO folders (ip, upload_enabled, webrtc_direct) VALUES (?, 1, ?) '
+                'ON CONFLICT(ip) DO UPDATE SET webrtc_direct = excluded.webrtc_direct',
+                (ip, 1 if webrtc_direct else 0)
+            )
+        set_folder_config(ip, webrtc_direct=webrtc_direct)
         return jsonify({"msg": "ok", "ip": ip, "webrtc_direct": bool(webrtc_direct)})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -411,20 +1401,31 @@ def frontend_index():
 
 
 # ---------------- 启动 ----------------
+def start_background():
+    """启动每个服务进程内的后台线程（生产模式下每个 gunicorn 工作进程各调用一次）"""
+    start_upload_session_gc()
+    presence.start(database.get(DB_PATH))
+    start_heartbeat_flusher()
+
+
 if __name__ == "__main__":
     from multiprocessing import freeze_support
     freeze_support()
     # 初始化数据库
     init_db()
-    
+    # 启动上传后处理工作进程（数量由 JOB_WORKERS 控制）
+    jobs.start_workers(DB_PATH, UPLOAD_ROOT)
+    # 启动录像保留策略清理进程
+    retention.start(DB_PATH, UPLOAD_ROOT)
+    # 启动已删除文件夹的后台清除进程（继续上次未完成的清除）
+    purge.start(DB_PATH, UPLOAD_ROOT)
+
     # 启动 WebRTC 子进程
     p = Process(target=start_webrtc_server, daemon=True)
     p.start()
-    
+
     print("✅ WebRTC 服务已启动 (port 8080)")
-    print("✅ 数据库初始化完成")
     print("✅ 后端 API 服务启动 (port 5000)")
     print("📝 访问: http://127.0.0.1:5000/frontend/login.html")
-    # 重要：Windows 下禁用 reloader，避免重复启动子进程导致套接字异常
-    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
-
+    # 默认生产模式（gunicorn / waitress），--dev 或 SERVE_MODE=dev 使用 Flask 开发服务器
+    serve.run(app, 5000, on_start=start_background, name="backend")
@@ -0,0 +1,1472 @@
+"""
+性能基准工具
+------------
+在临时目录中构造数据，对关键接口做延迟测量（不会触碰正式的 database.db / uploads）
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+
+
+def percentile(samples, pct):
+    """简单百分位（最近秩法）"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[k]
+
+
+def report(name, samples):
+    """打印一组延迟样本（秒）的 p50 / p99"""
+    print(f"{name:<28} n={len(samples):<5} "
+          f"p50={percentile(samples, 50) * 1000:8.2f}ms  p99={percentile(samples, 99) * 1000:8.2f}ms")
+
+
+def setup_sandbox(tmp=None):
+    """把 backend / db_manage 指向一个临时目录（默认新建），返回 (backend 模块, 临时目录)"""
+    tmp = tmp or tempfile.mkdtemp(prefix="catchscreen_bench_")
+    import db_manage
+    db_manage.DB_PATH = os.path.join(tmp, "database.db")
+    db_manage.UPLOAD_ROOT = os.path.join(tmp, "uploads")
+    os.makedirs(db_manage.UPLOAD_ROOT, exist_ok=True)
+
+    import backend
+    backend.DB_PATH = db_manage.DB_PATH
+    backend.UPLOAD_ROOT = db_manage.UPLOAD_ROOT
+    backend.thumbs.THUMB_ROOT = os.path.join(tmp, "thumbs")
+    db_manage.init_db()
+    return backend, tmp
+
+
+def login(client, backend):
+    """用测试客户端登录，返回已带 session 的客户端"""
+    client.post("/api/login", json={"username": backend.ADMIN_USER, "password": backend.ADMIN_PASS})
+    return client
+
+
+def seed_folders(backend, n_folders, m_videos):
+    """构造 n_folders 个文件夹，每个 m_videos 个视频（数据库行 + 空文件）"""
+    db = sqlite3.connect(backend.DB_PATH)
+    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    for i in range(n_folders):
+        ip = f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"
+        db.execute('INSERT INTO folders (ip, remark, updated_at) VALUES (?, ?, ?)',
+                   (ip, f"机器 {i}", now if i % 2 else "2000-01-01 00:00:00"))
+        path = os.path.join(backend.UPLOAD_ROOT, ip)
+        os.makedirs(path, exist_ok=True)
+        rows = []
+        for j in range(m_videos):
+            filename = f"20240101_{j:06d}.mp4"
+            open(os.path.join(path, filename), "wb").close()
+            rows.append((ip, filename, 1024 * 1024 * (j + 1), f"2024-01-01 {j // 3600 % 24:02d}:{j // 60 % 60:02d}:{j % 60:02d}"))
+        db.executemany('INSERT INTO videos (ip, filename, file_size, uploaded_at) VALUES (?, ?, ?, ?)', rows)
+    db.commit()
+    db.close()
+
+
+def legacy_list_folders(backend):
+    """旧版 /api/folders 实现：逐目录 listdir + 每个文件夹 3 次查询（仅用于对比）"""
+    db = backend.get_db()
+    folders = []
+    for folder_name in sorted(os.listdir(backend.UPLOAD_ROOT)):
+        folder_path_ = os.path.join(backend.UPLOAD_ROOT, folder_name)
+        if os.path.isdir(folder_path_):
+            videos = [v for v in os.listdir(folder_path_) if v.lower().endswith(backend.VIDEO_EXTS)]
+            row = db.execute('SELECT remark, upload_enabled, webrtc_direct FROM folders WHERE ip = ?', (folder_name,)).fetchone()
+            last_row = db.execute(
+                'SELECT uploaded_at FROM videos WHERE ip = ? ORDER BY uploaded_at DESC LIMIT 1', (folder_name,)
+            ).fetchone()
+            upd_row = db.execute('SELECT updated_at FROM folders WHERE ip = ?', (folder_name,)).fetchone()
+            online = False
+            if upd_row and upd_row['updated_at']:
+                try:
+                    upd_dt = datetime.strptime(upd_row['updated_at'], "%Y-%m-%d %H:%M:%S")
+                    online = (datetime.utcnow() - upd_dt).total_seconds() <= 5 * 60
+                except Exception:
+                    online = False
+            folders.append({
+                "ip": folder_name,
+                "video_count": len(videos),
+                "remark": row['remark'] if row else "",
+                "last_upload_at": last_row['uploaded_at'] if last_row else None,
+                "online": online,
+                "upload_enabled": bool(row['upload_enabled']) if row else True,
+                "webrtc_direct": bool(row['webrtc_direct']) if row else False,
+            })
+    return backend.jsonify({"folders": folders})
+
+
+def time_requests(client, url, rounds):
+    """重复请求同一 URL，返回每次耗时（秒）"""
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        resp = client.get(url)
+        samples.append(time.perf_counter() - start)
+        assert resp.status_code == 200, resp.status_code
+    return samples
+
+
+def bench_folders(n_folders=2000, m_videos=20, rounds=30):
+    """对比新旧 /api/folders 的 p50 / p99 延迟"""
+    backend, tmp = setup_sandbox()
+    try:
+        print(f"构造数据: {n_folders} 个文件夹 × {m_videos} 个视频 ...")
+        seed_folders(backend, n_folders, m_videos)
+        backend.app.add_url_rule("/bench/legacy_folders", "bench_legacy_folders",
+                                 lambda: legacy_list_folders(backend))
+        client = login(backend.app.test_client(), backend)
+
+        # 预热，避免首个请求的冷缓存影响结果
+        client.get("/bench/legacy_folders")
+        client.get("/api/folders")
+
+        report("before (listdir + 3N SQL)", time_requests(client, "/bench/legacy_folders", rounds))
+        report("after  (aggregated SQL)", time_requests(client, "/api/folders", rounds))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def start_server(app, port):
+    """在后台线程中以多线程 WSGI 服务器运行 app，返回 server（调用 shutdown() 停止）"""
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_serve(concurrency=16, seconds=10, size_mb=64, range_kb=1024, port=5098):
+    """并发随机 Range 拖动：多个观看者同时对同一录像发起随机偏移的分段请求"""
+    import requests
+
+    backend, tmp = setup_sandbox()
+    server = start_server(backend.app, port)
+    try:
+        ip, filename = "10.0.0.1", "bench.mp4"
+        path = os.path.join(backend.folder_path(ip), filename)
+        with open(path, "wb") as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1024 * 1024))
+        size = os.path.getsize(path)
+        url = f"http://127.0.0.1:{port}/uploads/{ip}/{filename}"
+        span = range_kb * 1024
+        deadline = time.time() + seconds
+        samples, transferred, errors = [], [0], [0]
+        lock = threading.Lock()
+
+        def viewer():
+            http = requests.Session()
+            http.post(f"http://127.0.0.1:{port}/api/login",
+                      json={"username": backend.ADMIN_USER, "password": backend.ADMIN_PASS})
+            local, nbytes = [], 0
+            while time.time() < deadline:
+                start = random.randrange(0, size - span)
+                t0 = time.perf_counter()
+                resp = http.get(url, headers={"Range": f"bytes={start}-{start + span - 1}"})
+                local.append(time.perf_counter() - t0)
+                if resp.status_code == 206:
+                    nbytes += len(resp.content)
+                else:
+                    with lock:
+                        errors[0] += 1
+            with lock:
+                samples.extend(local)
+                transferred[0] += nbytes
+
+        print(f"并发 {concurrency} 个观看者，{seconds}s，文件 {size_mb}MB，每次请求 {range_kb}KB ...")
+        threads = [threading.Thread(target=viewer) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        print(f"请求数: {len(samples)}  错误: {errors[0]}  "
+              f"吞吐: {len(samples) / seconds:.1f} req/s, {transferred[0] / seconds / 1024 / 1024:.1f} MB/s")
+        report("range seek", samples)
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def serve_sandbox(tmp, port):
+    """子进程入口：在临时目录上以 SERVE_MODE 指定的方式运行 backend"""
+    backend, _ = setup_sandbox(tmp)
+    backend.serve.run(backend.app, port, host="127.0.0.1", on_start=backend.start_background, name="backend")
+
+
+def wait_port(port, timeout=30):
+    import socket
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"port {port} not ready")
+
+
+def load_test(base, concurrency, seconds, make_request):
+    """concurrency 个客户端线程（各自保持长连接）循环发请求，返回 (延迟样本, 错误数)"""
+    import requests
+
+    deadline = time.time() + seconds
+    samples, errors = [], [0]
+    lock = threading.Lock()
+
+    def client(n):
+        http = requests.Session()
+        http.post(f"{base}/api/login", json={"username": "admin", "password": "123456"})
+        local, failed, i = [], 0, 0
+        while time.time() < deadline:
+            t0 = time.perf_counter()
+            try:
+                ok = make_request(http, n, i).status_code < 300
+            except requests.RequestException:
+                ok = False
+            local.append(time.perf_counter() - t0)
+            failed += not ok
+            i += 1
+        with lock:
+            samples.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples, errors[0]
+
+
+def bench_prod(concurrency=32, seconds=10, upload_kb=256, port=5097):
+    """开发服务器与生产模式（gunicorn / waitress）对比：心跳、列表、上传的吞吐与 p99"""
+    import subprocess
+
+    payload = os.urandom(upload_kb * 1024)
+    scenarios = [
+        ("heartbeat", lambda http, n, i: http.get(f"{base}/api/heartbeat/10.1.{n}.{i % 200}")),
+        ("list folders", lambda http, n, i: http.get(f"{base}/api/folders?limit=50")),
+        # 每次上传内容不同，避免命中去重
+        ("upload", lambda http, n, i: http.post(
+            f"{base}/api/upload/10.2.0.{n}", params={"filename": "bench.mp4"},
+            data=f"{n}-{i}-".encode() + payload, headers={"Content-Type": "application/octet-stream"})),
+    ]
+    base = f"http://127.0.0.1:{port}"
+    results = {}
+    for mode in ("dev", "prod"):
+        tmp = tempfile.mkdtemp(prefix="catchscreen_bench_")
+        setup_sandbox(tmp)
+        seed_folders(sys.modules["backend"], 500, 5)
+        env = dict(os.environ, SERVE_MODE=mode)
+        proc = subprocess.Popen([sys.executable, __file__, "_serve", tmp, str(port)], env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_port(port)
+            for name, make_request in scenarios:
+                samples, errors = load_test(base, concurrency, seconds, make_request)
+                results[(mode, name)] = (len(samples) / seconds, percentile(samples, 50), percentile(samples, 99), errors)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=60)
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"并发 {concurrency}，每项 {seconds}s，上传 {upload_kb}KB")
+    print(f"{'场景':<14}{'模式':<6}{'req/s':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'错误':>6}")
+    for name, _ in scenarios:
+        for mode in ("dev", "prod"):
+            rps, p50, p99, errors = results[(mode, name)]
+            print(f"{name:<14}{mode:<6}{rps:>10.1f}{p50 * 1000:>10.2f}{p99 * 1000:>10.2f}{errors:>6}")
+
+
+def _db_worker(mode, path, threads, seconds, results):
+    """压测子进程：threads 个线程混合执行心跳写、视频登记与列表读"""
+    import sqlite3
+    import database
+
+    deadline = time.time() + seconds
+    lock = threading.Lock()
+    samples, errors, conflicts, writes = [], [0], [0], [0]
+
+    def heartbeat(db, ip):
+        if not db.execute('SELECT ip FROM folders WHERE ip = ?', (ip,)).fetchone():
+            db.execute('INSERT INTO folders (ip) VALUES (?)', (ip,))
+        db.execute('UPDATE folders SET updated_at = CURRENT_TIMESTAMP WHERE ip = ?', (ip,))
+
+    def add_video(db, ip, n):
+        db.execute('INSERT INTO videos (ip, filename, file_size) VALUES (?, ?, ?)', (ip, f"{os.getpid()}_{n}.mp4", 1024))
+
+    def list_folders(db):
+        db.execute('SELECT ip, video_count, updated_at FROM folders ORDER BY last_upload_at DESC LIMIT 50').fetchall()
+
+    def client(t):
+        local, failed, clashed, wrote, n = [], 0, 0, 0, 0
+        while time.time() < deadline:
+            n += 1
+            ip = f"10.9.{t}.{n % 50}"
+            op = n % 4
+            t0 = time.perf_counter()
+            try:
+                if mode == "legacy":
+                    # 旧实现：每次操作新开连接（回滚日志、默认 5 秒超时）
+                    db = sqlite3.connect(path)
+                    try:
+                        if op == 3:
+                            list_folders(db)
+                        else:
+                            heartbeat(db, ip) if op < 2 else add_video(db, ip, n)
+                            db.commit()
+                    finally:
+                        db.close()
+                else:
+                    db = database.get(path)
+                    if op == 3:
+                        list_folders(db)
+                    else:
+                        with database.transaction(db):
+                            heartbeat(db, ip) if op < 2 else add_video(db, ip, n)
+                wrote += op != 3
+            except sqlite3.OperationalError:
+                failed += 1
+            except sqlite3.IntegrityError:
+                # 旧心跳的"先查后插"不在同一写事务里，并发时会插入重复 IP
+                clashed += 1
+            local.append(time.perf_counter() - t0)
+        with lock:
+            samples.extend(local)
+            errors[0] += failed
+            conflicts[0] += clashed
+            writes[0] += wrote
+
+    workers = [threading.Thread(target=client, args=(t,)) for t in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    results.put((samples, errors[0], conflicts[0], writes[0]))
+
+
+def bench_db(processes=4, threads=4, seconds=10):
+    """数据库并发压测：多进程 × 多线程混合读写，对比旧连接方式与共享连接层（WAL）"""
+    import multiprocessing
+    import sqlite3
+    import db_manage
+
+    for mode in ("legacy", "pooled"):
+        tmp = tempfile.mkdtemp(prefix="catchscreen_bench_")
+        try:
+            db_manage.DB_PATH = os.path.join(tmp, "database.db")
+            db_manage.init_db()
+            if mode == "legacy":
+                db = sqlite3.connect(db_manage.DB_PATH)
+                db.execute('PRAGMA journal_mode=DELETE')
+                db.close()
+            results = multiprocessing.Queue()
+            procs = [multiprocessing.Process(target=_db_worker, args=(mode, db_manage.DB_PATH, threads, seconds, results))
+                     for _ in range(processes)]
+            for p in procs:
+                p.start()
+            samples, errors, conflicts, writes = [], 0, 0, 0
+            for _ in procs:
+                s, e, c, w = results.get()
+                samples += s
+                errors += e
+                conflicts += c
+                writes += w
+            for p in procs:
+                p.join()
+            print(f"{mode:<8} {processes} 进程 × {threads} 线程: 写入 {writes / seconds:8.1f}/s  "
+                  f"锁错误 {errors:<5} 插入冲突 {conflicts:<5} p50={percentile(samples, 50) * 1000:7.2f}ms  p99={percentile(samples, 99) * 1000:8.2f}ms")
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def proc_usage(pid):
+    """进程累计 CPU 秒数与常驻内存字节数（读取 /proc，仅 Linux；其他平台返回 None）"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            rss_kb = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+    except (OSError, StopIteration):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return (int(fields[11]) + int(fields[12])) / ticks, rss_kb * 1024
+
+
+def synthetic_track(width, height=240):
+    """30fps 合成视频轨：亮度平面为逐帧滚动的斜向渐变叠加少量噪点（每帧都在变化，但可以被有效压缩）。
+    各发布者使用不同宽度时，观众可按收到的帧宽度判断是否串流"""
+    from aiortc import VideoStreamTrack
+    from av import VideoFrame
+
+    # 平面每行可能有对齐填充，按实际行宽生成数据
+    probe = VideoFrame(width=width, height=height)
+    stride = probe.planes[0].line_size
+    rnd = random.Random(width)
+    noise = bytes(((x + y) * 2 + rnd.randrange(8)) % 256 for y in range(height * 2) for x in range(stride))
+    luma_size = probe.planes[0].buffer_size
+    chroma = [bytes([128]) * plane.buffer_size for plane in probe.planes[1:]]
+
+    class SyntheticTrack(VideoStreamTrack):
+        async def recv(self):
+            pts, time_base = await self.next_timestamp()
+            frame = VideoFrame(width=width, height=height)
+            offset = pts // 3000 % height * stride
+            frame.planes[0].update(noise[offset:offset + luma_size])
+            frame.planes[1].update(chroma[0])
+            frame.planes[2].update(chroma[1])
+            frame.pts = pts
+            frame.time_base = time_base
+            return frame
+
+    return SyntheticTrack()
+
+
+def bench_relay(publishers=2, viewers=2, seconds=10, port=5096):
+    """WebRTC 中继：N 个发布者 × 每路 M 个观众，测量服务端 CPU / 内存，并校验各流互不串流、
+    /viewer/close 只关闭指定会话"""
+    import asyncio
+    import subprocess
+    import requests
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from aiortc.mediastreams import MediaStreamError
+
+    logging.getLogger("aioice").setLevel(logging.WARNING)
+    base = f"http://127.0.0.1:{port}"
+
+    async def post(path, payload):
+        loop = asyncio.get_running_loop()
+        resp = await loop.run_in_executor(None, lambda: requests.post(base + path, json=payload, timeout=30))
+        return resp.status_code, resp.json()
+
+    async def negotiate(pc, path, payload):
+        await pc.setLocalDescription(await pc.createOffer())
+        status, answer = await post(path, dict(payload, sdp=pc.localDescription.sdp, type=pc.localDescription.type))
+        if status != 200:
+            raise RuntimeError(f"{path} {status}: {answer}")
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+        return answer
+
+    async def run(server_pid):
+        pcs, tasks = [], []
+        stats = {"frames": 0, "mismatch": 0}
+
+        for i in range(publishers):
+            pc = RTCPeerConnection()
+            pc.addTrack(synthetic_track(320 + 16 * i))
+            await negotiate(pc, "/webrtc", {"stream": f"bench-{i}"})
+            pcs.append(pc)
+
+        async def measure(window):
+            before, frames = proc_usage(server_pid), stats["frames"]
+            await asyncio.sleep(window)
+            after = proc_usage(server_pid)
+            cpu = (after[0] - before[0]) / window * 100 if before and after else float("nan")
+            rss = after[1] / 1024 / 1024 if after else float("nan")
+            return cpu, rss, (stats["frames"] - frames) / window
+
+        await asyncio.sleep(3)
+        pub_cpu, pub_rss, _ = await measure(seconds / 2)
+
+        sessions = {}
+        for i in range(publishers):
+            for _ in range(viewers):
+                pc = RTCPeerConnection()
+                pc.addTransceiver("video", direction="recvonly")
+
+                def on_track(track, expected=320 + 16 * i):
+                    async def consume():
+                        while True:
+                            try:
+                                frame = await track.recv()
+                            except MediaStreamError:
+                                return
+                            stats["frames"] += 1
+                            stats["mismatch"] += frame.width != expected
+                    tasks.append(asyncio.ensure_future(consume()))
+                pc.on("track", on_track)
+                answer = await negotiate(pc, "/view", {"stream": f"bench-{i}", "timeout": 10})
+                sessions.setdefault(i, []).append(answer["session"])
+                pcs.append(pc)
+
+        await asyncio.sleep(3)
+        cpu, rss, fps = await measure(seconds)
+
+        # 关闭第 0 路的一个观众：只应减少该流的一个观众
+        await post("/viewer/close", {"ip": "bench-0", "session": sessions[0][0]})
+        loop = asyncio.get_running_loop()
+        counts = await loop.run_in_executor(None, lambda: {
+            s["stream"]: s["viewers"] for s in requests.get(base + "/streams", timeout=10).json()["streams"]})
+        expected = {f"bench-{i}": viewers - (i == 0) for i in range(publishers)}
+        if viewers == 1:
+            # 最后一个观众离开时发布者也被关闭
+            expected.pop("bench-0")
+        close_ok = counts == expected
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*(pc.close() for pc in pcs), return_exceptions=True)
+        return pub_cpu, pub_rss, cpu, rss, fps, stats["mismatch"], close_ok, counts
+
+    proc = subprocess.Popen([sys.executable, __file__, "_webrtc", str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_port(port)
+        pub_cpu, pub_rss, cpu, rss, fps, mismatch, close_ok, counts = asyncio.run(run(proc.pid))
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+    total = publishers * viewers
+    print(f"{publishers} 个发布者 × 每路 {viewers} 个观众（320x240 起，30fps）")
+    print(f"仅发布:   服务端 CPU {pub_cpu:6.1f}%  RSS {pub_rss:7.1f} MB")
+    print(f"含观众:   服务端 CPU {cpu:6.1f}%  RSS {rss:7.1f} MB  "
+          f"每观众 +{(cpu - pub_cpu) / max(total, 1):.1f}% CPU, +{(rss - pub_rss) / max(total, 1):.1f} MB")
+    print(f"观众平均帧率 {fps / max(total, 1):.1f} fps，串流帧 {mismatch}")
+    print(f"单会话关闭: {'✅' if close_ok else '❌'} {counts}")
+
+
+def bench_view(viewers=8, port=5097):
+    """观众等待发布端上线：viewers 个观众先等待，之后发布，测量发布到各观众拿到 Answer 的延迟；
+    并检查等待上限（503）与断开连接后取消等待"""
+    import json
+    import asyncio
+    import socket
+    import subprocess
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+    from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
+
+    logging.getLogger("aioice").setLevel(logging.WARNING)
+    base = f"http://127.0.0.1:{port}"
+    pool = ThreadPoolExecutor(max_workers=viewers + 4)
+
+    async def post(path, payload):
+        loop = asyncio.get_running_loop()
+        resp = await loop.run_in_executor(pool, lambda: requests.post(base + path, json=payload, timeout=60))
+        return resp.status_code, resp.json(), time.perf_counter()
+
+    async def metrics():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pool, lambda: requests.get(base + "/metrics", timeout=10).json())
+
+    async def run():
+        pcs = []
+
+        async def view(stream_id):
+            pc = RTCPeerConnection()
+            pc.addTransceiver("video", direction="recvonly")
+            pcs.append(pc)
+            await pc.setLocalDescription(await pc.createOffer())
+            status, answer, done = await post("/view", {
+                "sdp": pc.localDescription.sdp, "type": pc.localDescription.type, "stream": stream_id, "timeout": 30})
+            if status == 200:
+                await pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+            return status, done
+
+        waiting = [asyncio.ensure_future(view("bench")) for _ in range(viewers)]
+        while (await metrics())["waiting"] < viewers:
+            await asyncio.sleep(0.05)
+        # 超过等待上限的观众应立即被拒绝
+        over_status, _ = await view("bench")
+
+        publisher = RTCPeerConnection()
+        publisher.addTrack(VideoStreamTrack())
+        pcs.append(publisher)
+        await publisher.setLocalDescription(await publisher.createOffer())
+        published = time.perf_counter()
+        _, answer, publish_done = await post("/webrtc", {
+            "sdp": publisher.localDescription.sdp, "type": publisher.localDescription.type, "stream": "bench"})
+        await publisher.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+        results = await asyncio.gather(*waiting)
+        joins = sorted((done - published) * 1000 for status, done in results if status == 200)
+
+        # 断开连接：原始套接字发出 /view 后直接关闭，服务端应取消等待
+        pc = RTCPeerConnection()
+        pc.addTransceiver("video", direction="recvonly")
+        pcs.append(pc)
+        await pc.setLocalDescription(await pc.createOffer())
+        body = json.dumps({"sdp": pc.localDescription.sdp, "type": "offer", "stream": "nobody", "timeout": 0}).encode()
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.sendall(f"POST /view HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        while (await metrics())["waiting"] < 1:
+            await asyncio.sleep(0.05)
+        sock.close()
+        closed = time.perf_counter()
+        while (await metrics())["waiting"]:
+            await asyncio.sleep(0.05)
+        released = time.perf_counter() - closed
+
+        await asyncio.sleep(2)
+        final = await metrics()
+        await asyncio.gather(*(pc.close() for pc in pcs), return_exceptions=True)
+        return joins, (publish_done - published) * 1000, over_status, released, final
+
+    env = dict(os.environ, VIEW_MAX_WAITING=str(viewers))
+    proc = subprocess.Popen([sys.executable, __file__, "_webrtc", str(port)], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_port(port)
+        joins, publish_ms, over_status, released, final = asyncio.run(run())
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+        pool.shutdown()
+
+    print(f"{viewers} 个观众先等待，之后发布")
+    print(f"发布请求耗时 {publish_ms:.1f}ms；观众拿到 Answer（从发布开始计）: "
+          f"p50 {percentile(joins, 50):.1f}ms  最大 {joins[-1]:.1f}ms  成功 {len(joins)}/{viewers}")
+    print(f"超过等待上限: {'✅' if over_status == 503 else '❌'} HTTP {over_status}")
+    print(f"断开后释放等待: {released * 1000:.0f}ms  (cancelled={final['cancelled']})")
+    print(f"服务端统计: wait {final['wait']}  ttff {final['ttff']}")
+
+
+def bench_pending(viewers=1000, seconds=5, port=5098):
+    """同时挂起的等待观众：viewers 个观众等待一个尚未发布的流，测量服务端内存 / CPU、
+    挂起期间其他接口的响应延迟，以及全部断开后等待释放的耗时"""
+    import asyncio
+    import subprocess
+    import aiohttp
+    from aiortc import RTCPeerConnection
+
+    base = f"http://127.0.0.1:{port}"
+
+    async def run(server_pid):
+        pc = RTCPeerConnection()
+        pc.addTransceiver("video", direction="recvonly")
+        await pc.setLocalDescription(await pc.createOffer())
+        offer = {"sdp": pc.localDescription.sdp, "type": "offer", "stream": "pending", "timeout": 0}
+        await pc.close()
+
+        async with aiohttp.ClientSession() as probe:
+            async def get(path):
+                async with probe.get(base + path) as resp:
+                    return await resp.json()
+
+            async def latency(path, n=50):
+                samples = []
+                for _ in range(n):
+                    t0 = time.perf_counter()
+                    await get(path)
+                    samples.append((time.perf_counter() - t0) * 1000)
+                return percentile(samples, 50), percentile(samples, 99)
+
+            idle_latency = await latency("/streams")
+            idle_rss = proc_usage(server_pid)
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+            t0 = time.perf_counter()
+            pending = [asyncio.ensure_future(session.post(base + "/view", json=offer)) for _ in range(viewers)]
+            while (await get("/metrics"))["waiting"] < viewers:
+                await asyncio.sleep(0.05)
+            held = time.perf_counter() - t0
+
+            before = proc_usage(server_pid)
+            await asyncio.sleep(seconds)
+            after = proc_usage(server_pid)
+            busy_latency = await latency("/streams")
+            async with probe.post(base + "/view", json=offer) as resp:
+                over_status = resp.status
+
+            # 全部断开，等待应全部释放
+            for task in pending:
+                task.cancel()
+            await session.close()
+            t0 = time.perf_counter()
+            while (await get("/metrics"))["waiting"]:
+                await asyncio.sleep(0.05)
+            released = time.perf_counter() - t0
+            final = await get("/metrics")
+
+        cpu = (after[0] - before[0]) / seconds * 100 if before and after else float("nan")
+        return held, idle_rss, after, cpu, idle_latency, busy_latency, over_status, released, final
+
+    env = dict(os.environ, VIEW_MAX_WAITING=str(viewers))
+    proc = subprocess.Popen([sys.executable, __file__, "_webrtc", str(port)], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_port(port)
+        held, idle_rss, after, cpu, idle_latency, busy_latency, over_status, released, final = asyncio.run(run(proc.pid))
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+    print(f"{viewers} 个观众同时等待未发布的流：全部挂起用时 {held:.2f}s")
+    if idle_rss and after:
+        print(f"服务端 RSS {idle_rss[1] / 1024 / 1024:.1f} MB → {after[1] / 1024 / 1024:.1f} MB"
+              f"（每个等待 {(after[1] - idle_rss[1]) / viewers / 1024:.1f} KB），挂起期间 CPU {cpu:.1f}%")
+    print(f"/streams 延迟 p50/p99: 空闲 {idle_latency[0]:.1f}/{idle_latency[1]:.1f}ms  "
+          f"挂起时 {busy_latency[0]:.1f}/{busy_latency[1]:.1f}ms")
+    print(f"超过等待上限: {'✅' if over_status == 503 else '❌'} HTTP {over_status}")
+    print(f"全部断开后释放: {released * 1000:.0f}ms  (cancelled={final['cancelled']})")
+
+
+def bench_record(seconds=12, segment=4, port=5099):
+    """服务端录制：1 个发布者（640x480）+ 1 个观众，分别在不录制 / 录制时测量观众帧率、帧间隔 p99
+    与服务端 CPU（录制编码在工作线程中，观众不应受影响），并检查写出的分段与 videos 记录"""
+    import asyncio
+    import subprocess
+    import requests
+    import av
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from aiortc.mediastreams import MediaStreamError
+
+    logging.getLogger("aioice").setLevel(logging.WARNING)
+    base = f"http://127.0.0.1:{port}"
+
+    async def negotiate(pc, path, payload):
+        await pc.setLocalDescription(await pc.createOffer())
+        loop = asyncio.get_running_loop()
+        body = dict(payload, sdp=pc.localDescription.sdp, type=pc.localDescription.type)
+        answer = await loop.run_in_executor(None, lambda: requests.post(base + path, json=body, timeout=30).json())
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+
+    async def run(server_pid, record):
+        publisher = RTCPeerConnection()
+        publisher.addTrack(synthetic_track(640, 480))
+        await negotiate(publisher, "/webrtc", {"stream": "bench", "record": record})
+        viewer = RTCPeerConnection()
+        viewer.addTransceiver("video", direction="recvonly")
+        arrivals = []
+
+        def on_track(track):
+            async def consume():
+                while True:
+                    try:
+                        await track.recv()
+                    except MediaStreamError:
+                        return
+                    arrivals.append(time.perf_counter())
+            asyncio.ensure_future(consume())
+        viewer.on("track", on_track)
+        await negotiate(viewer, "/view", {"stream": "bench", "timeout": 10})
+
+        await asyncio.sleep(3)
+        before, start = proc_usage(server_pid), time.perf_counter()
+        await asyncio.sleep(seconds)
+        after, end = proc_usage(server_pid), time.perf_counter()
+        loop = asyncio.get_running_loop()
+        recordings = await loop.run_in_executor(None, lambda: requests.get(base + "/recordings", timeout=10).json())
+        # 先关闭观众再关闭发布者，录制随之结束并写出最后一段
+        await viewer.close()
+        await publisher.close()
+
+        window = [t for t in arrivals if start <= t <= end]
+        gaps = [(b - a) * 1000 for a, b in zip(window, window[1:])]
+        cpu = (after[0] - before[0]) / (end - start) * 100 if before and after else float("nan")
+        return len(window) / (end - start), percentile(gaps, 99), cpu, recordings["recordings"].get("bench", {})
+
+    tmp = tempfile.mkdtemp(prefix="bench_record_")
+    results = {}
+    try:
+        for record in (False, True):
+            env = dict(os.environ, RECORD_SEGMENT_SECONDS=str(segment))
+            proc = subprocess.Popen([sys.executable, __file__, "_webrtc", str(port), tmp], env=env,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_port(port)
+                results[record] = asyncio.run(run(proc.pid, record))
+                time.sleep(2)
+            finally:
+                proc.terminate()
+                proc.wait(timeout=60)
+
+        db = sqlite3.connect(os.path.join(tmp, "database.db"))
+        rows = db.execute("SELECT filename, file_size FROM videos WHERE ip = 'bench' ORDER BY id").fetchall()
+        jobs = db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+        db.close()
+        durations = []
+        for filename, _ in rows:
+            with av.open(os.path.join(tmp, "uploads", "bench", filename)) as container:
+                durations.append(float(container.duration or 0) / av.time_base)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"1 个发布者（640x480，30fps）+ 1 个观众，每项 {seconds} 秒，分段 {segment} 秒")
+    for record, (fps, gap_p99, cpu, status) in results.items():
+        extra = f"  录制丢帧 {status.get('dropped', 0)}/{status.get('frames', 0)}" if record else ""
+        print(f"{'录制' if record else '不录制'}: 观众 {fps:5.1f} fps  帧间隔 p99 {gap_p99:6.1f}ms  服务端 CPU {cpu:5.1f}%{extra}")
+    print(f"分段 {len(rows)} 个（videos 记录 {len(rows)} 条，后台任务 {jobs} 个），时长: "
+          + ", ".join(f"{d:.1f}s" for d in durations)
+          + f"，共 {sum(size for _, size in rows) / 1024:.0f} KB")
+
+
+def bench_direct(n=200, port=5100, backend_port=5101):
+    """观众进入 / 离开时更新 webrtc_direct：旧方式（请求内同步 PATCH backend）与状态通道（内存登记、
+    后台批量写数据库）的延迟对比，写入生效时间，以及 backend 不可用时的回退"""
+    import socket
+    import subprocess
+    import requests
+
+    tmp = tempfile.mkdtemp(prefix="bench_direct_")
+    backend_url = f"http://127.0.0.1:{backend_port}"
+    hung = socket.socket()
+    hung.bind(("127.0.0.1", 0))
+    hung.listen(1024)
+    hung_url = f"http://127.0.0.1:{hung.getsockname()[1]}"
+    procs = []
+
+    def start_webrtc(**env):
+        proc = subprocess.Popen([sys.executable, __file__, "_webrtc", str(port), tmp], env=dict(os.environ, **env),
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        procs.append(proc)
+        wait_port(port)
+        return proc
+
+    def stop(proc):
+        proc.terminate()
+        proc.wait(timeout=30)
+        procs.remove(proc)
+
+    def timed(fn, count):
+        samples = []
+        for i in range(count):
+            t0 = time.perf_counter()
+            fn(i)
+            samples.append((time.perf_counter() - t0) * 1000)
+        return samples
+
+    def open_close(http, ip):
+        http.post(f"http://127.0.0.1:{port}/viewer/open", json={"ip": ip}, timeout=10).raise_for_status()
+        http.post(f"http://127.0.0.1:{port}/viewer/close", json={"ip": ip}, timeout=10).raise_for_status()
+
+    def direct_value(ip):
+        db = sqlite3.connect(os.path.join(tmp, "database.db"))
+        try:
+            row = db.execute("SELECT webrtc_direct FROM folders WHERE ip = ?", (ip,)).fetchone()
+            return row and row[0]
+        finally:
+            db.close()
+
+    def wait_for(check, timeout=15):
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < timeout:
+            if check():
+                return time.perf_counter() - t0
+            time.sleep(0.01)
+        return None
+
+    try:
+        backend = subprocess.Popen([sys.executable, __file__, "_serve", tmp, str(backend_port)],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        procs.append(backend)
+        wait_port(backend_port)
+
+        # 旧方式：每次进入 / 离开在请求内同步 PATCH 一次（每次新建连接）
+        patch = lambda i, url=backend_url: requests.patch(
+            f"{url}/api/folders/10.0.0.{i % 250}/webrtc_direct", json={"webrtc_direct": bool(i % 2)}, timeout=2)
+        old = timed(patch, n)
+
+        def patch_hung(i):
+            try:
+                patch(i, hung_url)
+            except requests.RequestException:
+                pass
+        old_hung = timed(patch_hung, 3)
+
+        # 新方式：进入 + 离开各一次请求，webrtc_direct 只登记到内存
+        proc = start_webrtc(BACKEND_URL=backend_url)
+        http = requests.Session()
+        new = timed(lambda i: open_close(http, f"10.1.0.{i % 250}"), n)
+        http.post(f"http://127.0.0.1:{port}/viewer/open", json={"ip": "10.9.9.9"}, timeout=10)
+        to_db = wait_for(lambda: direct_value("10.9.9.9") == 1)
+        to_heartbeat = wait_for(lambda: requests.get(
+            f"{backend_url}/api/heartbeat/10.9.9.9", timeout=5).json().get("webrtc_direct") is True)
+        db_status = http.get(f"http://127.0.0.1:{port}/metrics", timeout=10).json()["webrtc_direct"]
+        stop(proc)
+
+        # 回退：只走 HTTP；backend 无响应时请求仍然立即返回，更新留在内存中重试
+        proc = start_webrtc(BACKEND_URL=backend_url, WEBRTC_DIRECT_MODE="http")
+        http = requests.Session()
+        fallback = timed(lambda i: open_close(http, f"10.2.0.{i % 250}"), n)
+        http.post(f"http://127.0.0.1:{port}/viewer/open", json={"ip": "10.9.9.8"}, timeout=10)
+        via_http = wait_for(lambda: direct_value("10.9.9.8") == 1)
+        stop(proc)
+
+        proc = start_webrtc(BACKEND_URL=hung_url, WEBRTC_DIRECT_MODE="http")
+        http = requests.Session()
+        down = timed(lambda i: open_close(http, f"10.3.0.{i % 250}"), 20)
+        time.sleep(3)
+        down_status = http.get(f"http://127.0.0.1:{port}/metrics", timeout=10).json()["webrtc_direct"]
+        stop(proc)
+    finally:
+        for proc in list(procs):
+            proc.terminate()
+            proc.wait(timeout=30)
+        hung.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    def line(label, samples):
+        print(f"{label:<34} p50 {percentile(samples, 50):7.2f}ms  p99 {percentile(samples, 99):7.2f}ms")
+
+    print(f"webrtc_direct 更新：{n} 次")
+    line("旧: 请求内同步 PATCH（每次）", old)
+    line("旧: backend 无响应时（每次）", old_hung)
+    line("新: 进入 + 离开（两个请求合计）", new)
+    line("新: 只走 HTTP 回退（进入 + 离开）", fallback)
+    line("新: backend 无响应（进入 + 离开）", down)
+    print(f"生效：写入数据库 {to_db * 1000:.0f}ms，心跳应答可见 {to_heartbeat * 1000:.0f}ms；"
+          f"HTTP 回退写入 {via_http * 1000:.0f}ms")
+    print(f"数据库通道：{db_status['updates']} 次更新合并为 {db_status['batches']} 批写出")
+    print(f"backend 无响应：积压 {down_status['pending']} 个 IP、写出中 {down_status['in_flight']} 个，"
+          f"失败 {down_status['failures']} 批（稍后重试）")
+
+
+def _cluster_client(base, index, seconds, ready, go, results):
+    """bench_cluster 的客户端子进程：发布一路合成视频（宽度 320 + 16 × index）并观看，
+    准备好后等待 go，统计 seconds 秒内收到的帧数与串流帧"""
+    import asyncio
+    import requests
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from aiortc.mediastreams import MediaStreamError
+
+    logging.getLogger("aioice").setLevel(logging.WARNING)
+    width = 320 + 16 * index
+
+    async def negotiate(pc, path, payload):
+        await pc.setLocalDescription(await pc.createOffer())
+        loop = asyncio.get_running_loop()
+        body = dict(payload, sdp=pc.localDescription.sdp, type=pc.localDescription.type)
+        answer = await loop.run_in_executor(None, lambda: requests.post(base + path, json=body, timeout=30).json())
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+
+    async def run():
+        stats = {"frames": 0, "mismatch": 0}
+        publisher = RTCPeerConnection()
+        publisher.addTrack(synthetic_track(width))
+        await negotiate(publisher, "/webrtc", {"stream": f"bench-{index}"})
+        viewer = RTCPeerConnection()
+        viewer.addTransceiver("video", direction="recvonly")
+
+        def on_track(track):
+            async def consume():
+                while True:
+                    try:
+                        frame = await track.recv()
+                    except MediaStreamError:
+                        return
+                    stats["frames"] += 1
+                    stats["mismatch"] += frame.width != width
+            asyncio.ensure_future(consume())
+        viewer.on("track", on_track)
+        await negotiate(viewer, "/view", {"stream": f"bench-{index}", "timeout": 10})
+        await asyncio.sleep(3)
+        ready.put(index)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, go.wait)
+        frames = stats["frames"]
+        await asyncio.sleep(seconds)
+        results.put((index, (stats["frames"] - frames) / seconds, stats["mismatch"]))
+        # 留出时间让主进程读取 /streams
+        await asyncio.sleep(2)
+        await viewer.close()
+        await publisher.close()
+
+    asyncio.run(run())
+
+
+def bench_cluster(publishers=4, max_workers=2, seconds=8, port=5103):
+    """多进程中继：publishers 个回环发布者（各带 1 个观众，每个发布者一个客户端进程），
+    WEBRTC_WORKERS 从 1 到 max_workers，测量观众收到的总帧率与服务端 CPU（路由 + 全部工作进程）；
+    最后结束一个工作进程，检查其被重启且该流重新发布后可以观看"""
+    import signal
+    import subprocess
+    import multiprocessing
+    import requests
+
+    base = f"http://127.0.0.1:{port}"
+
+    def server_usage(pids):
+        usage = [proc_usage(pid) for pid in pids]
+        return sum(u[0] for u in usage if u), sum(u[1] for u in usage if u)
+
+    def run_clients(n, window):
+        ready, results, go = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Event()
+        procs = [multiprocessing.Process(target=_cluster_client, args=(base, i, window, ready, go, results))
+                 for i in range(n)]
+        for p in procs:
+            p.start()
+        for _ in procs:
+            ready.get(timeout=120)
+        return procs, go, results
+
+    def worker_pids():
+        return [w["pid"] for w in requests.get(base + "/metrics", timeout=10).json().get("workers", [])]
+
+    rows, crash = [], None
+    for n in range(1, max_workers + 1):
+        env = dict(os.environ, WEBRTC_WORKERS=str(n))
+        proc = subprocess.Popen([sys.executable, __file__, "_webrtc", str(port)], env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_port(port)
+            time.sleep(1)
+            pids = [proc.pid] + worker_pids()
+            clients, go, results = run_clients(publishers, seconds)
+            before = server_usage(pids)
+            go.set()
+            time.sleep(seconds)
+            after = server_usage(pids)
+            placement = {s["stream"]: s.get("worker", 0) for s in requests.get(base + "/streams", timeout=10).json()["streams"]}
+            fps = [results.get(timeout=60) for _ in clients]
+            for p in clients:
+                p.join()
+            rows.append((n, sum(f for _, f, _ in fps), min(f for _, f, _ in fps), sum(m for _, _, m in fps),
+                         (after[0] - before[0]) / seconds * 100, after[1] / 1024 / 1024, placement))
+
+            if n == max_workers and n > 1:
+                # 结束 bench-0 所在的工作进程，等待重启后重新发布并观看
+                victim = requests.get(base + "/metrics", timeout=10).json()["workers"][placement.get("bench-0", 0)]
+                os.kill(victim["pid"], signal.SIGKILL)
+                killed = time.perf_counter()
+                while True:
+                    status = requests.get(base + "/metrics", timeout=10).json()["workers"][victim["index"]]
+                    if status["alive"] and status["restarts"] and status["metrics"]:
+                        break
+                    time.sleep(0.1)
+                restarted = time.perf_counter() - killed
+                clients, go, results = run_clients(1, 2)
+                go.set()
+                _, refps, _ = results.get(timeout=60)
+                clients[0].join()
+                crash = (victim["index"], restarted, status["restarts"], refps)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=60)
+
+    print(f"{publishers} 个回环发布者（各 1 个观众，320x240 起，30fps），每项 {seconds} 秒，本机 {os.cpu_count()} 核")
+    for n, total, slowest, mismatch, cpu, rss, placement in rows:
+        per_worker = {}
+        for worker in placement.values():
+            per_worker[worker] = per_worker.get(worker, 0) + 1
+        print(f"工作进程 {n}: 观众总帧率 {total:6.1f} fps（最慢 {slowest:4.1f}）  服务端 CPU {cpu:6.1f}%  "
+              f"RSS {rss:6.1f} MB  串流帧 {mismatch}  各进程流数 {dict(sorted(per_worker.items()))}")
+    if len(rows) > 1:
+        print(f"总帧率 {rows[-1][0]} 进程 / 1 进程: {rows[-1][1] / max(rows[0][1], 0.1):.2f}x")
+    if crash:
+        index, restarted, restarts, refps = crash
+        print(f"结束工作进程 #{index}: {restarted:.1f} 秒后重启（重启 {restarts} 次），"
+              f"重新发布后观众 {refps:.1f} fps {'✅' if refps > 0 else '❌'}")
+
+
+def bench_soak(cycles=2000, concurrency=8, port=5104):
+    """连接生命周期浸泡测试：1 个发布者（另有 1 个常驻观众），观众反复连接 / 断开 cycles 次（concurrency 路并发），轮流使用
+    /viewer/close 关闭、客户端直接关闭、拿到 Answer 后不建立连接三种方式；之后强制结束一个带 20 个观众的客户端进程
+    （对端消失）。记录服务端内存变化与连接数是否回到基线，并检查每 IP / 总连接数上限"""
+    import signal
+    import asyncio
+    import subprocess
+    import aiohttp
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+
+    logging.getLogger("aioice").setLevel(logging.WARNING)
+    base = f"http://127.0.0.1:{port}"
+    per_ip, max_connections = 16, 128
+
+    async def run(server_pid):
+        http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+
+        async def post(path, payload, ip):
+            async with http.post(base + path, json=payload, headers={"X-Forwarded-For": ip}) as resp:
+                return resp.status, await resp.json()
+
+        async def get(path):
+            async with http.get(base + path) as resp:
+                return await resp.json()
+
+        async def negotiate(pc, path, payload, ip):
+            await pc.setLocalDescription(await pc.createOffer())
+            status, answer = await post(path, dict(payload, sdp=pc.localDescription.sdp, type="offer"), ip)
+            if status != 200:
+                raise RuntimeError(f"{path} {status}: {answer}")
+            return answer
+
+        # 拿到 Answer 后不建立连接用的 Offer（对应的客户端连接已关闭）
+        pc = RTCPeerConnection()
+        pc.addTransceiver("video", direction="recvonly")
+        await pc.setLocalDescription(await pc.createOffer())
+        dead_offer = {"sdp": pc.localDescription.sdp, "type": "offer", "stream": "soak", "timeout": 5}
+        await pc.close()
+
+        publisher = RTCPeerConnection()
+        publisher.addTrack(synthetic_track(320))
+        answer = await negotiate(publisher, "/webrtc", {"stream": "soak"}, "10.0.0.1")
+        await publisher.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+        # 常驻观众：/viewer/close 关闭最后一个观众时会关闭发布者
+        anchor = RTCPeerConnection()
+        anchor.addTransceiver("video", direction="recvonly")
+        answer = await negotiate(anchor, "/view", {"stream": "soak", "timeout": 5}, "10.0.0.2")
+        await anchor.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+        await asyncio.sleep(2)
+
+        stats = {"done": 0, "failed": 0}
+        samples = [(0, proc_usage(server_pid)[1])]
+        counter = iter(range(cycles))
+
+        async def cycle(n, ip):
+            mode = n % 3
+            if mode == 2:
+                await post("/view", dead_offer, ip)
+                return
+            pc = RTCPeerConnection()
+            pc.addTransceiver("video", direction="recvonly")
+            got = asyncio.get_running_loop().create_future()
+            pc.on("track", lambda track: got.done() or got.set_result(track))
+            try:
+                answer = await negotiate(pc, "/view", {"stream": "soak", "timeout": 5}, ip)
+                await pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+                track = await asyncio.wait_for(got, 10)
+                await asyncio.wait_for(track.recv(), 10)
+                if mode == 0:
+                    await post("/viewer/close", {"ip": "soak", "session": answer["session"]}, ip)
+            finally:
+                await pc.close()
+
+        async def worker(w):
+            for n in counter:
+                try:
+                    # 每次换一个来源 IP：未建立的连接要等协商超时才回收，同一 IP 会触及每 IP 上限
+                    await cycle(n, f"10.1.{w}.{n % 250}")
+                except Exception:
+                    stats["failed"] += 1
+                stats["done"] += 1
+                if stats["done"] % max(cycles // 10, 1) == 0:
+                    samples.append((stats["done"], proc_usage(server_pid)[1]))
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(w) for w in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+
+        # 对端消失：子进程建立 20 个观众后被强制结束（不发送 DTLS close_notify）
+        vanish = subprocess.Popen([sys.executable, __file__, "_soak_vanish", str(port), "20"], stdout=subprocess.PIPE)
+        vanish.stdout.readline()
+        peak = (await get("/connections"))["total"]
+        vanish.send_signal(signal.SIGKILL)
+        vanish.wait()
+
+        async def settle(timeout=60):
+            deadline = time.perf_counter() + timeout
+            while time.perf_counter() < deadline:
+                counts = await get("/connections")
+                if counts["total"] == 2:
+                    break
+                await asyncio.sleep(0.5)
+            return counts
+        settled = await settle()
+        samples.append(("settled", proc_usage(server_pid)[1]))
+
+        # 上限：同一 IP 超过每 IP 上限返回 429；不同 IP 填满总数后返回 503
+        statuses = [(await post("/view", dead_offer, "203.0.113.1"))[0] for _ in range(per_ip + 1)]
+        per_ip_status = statuses[-1] if statuses[:-1] == [200] * per_ip else statuses
+        filled, global_status = 0, None
+        for i in range(max_connections * 2):
+            status, _ = await post("/view", dead_offer, f"198.51.{i // 250}.{i % 250}")
+            if status != 200:
+                global_status = status
+                break
+            filled += 1
+        capped = await settle()
+
+        await anchor.close()
+        await publisher.close()
+        await http.close()
+        return elapsed, stats, samples, peak, settled, per_ip_status, filled, global_status, capped
+
+    env = dict(os.environ, WEBRTC_NEGOTIATION_TIMEOUT="3", WEBRTC_DISCONNECT_GRACE="4", LIFECYCLE_INTERVAL="1",
+               WEBRTC_MAX_PER_IP=str(per_ip), WEBRTC_MAX_CONNECTIONS=str(max_connections))
+    proc = subprocess.Popen([sys.executable, __file__, "_webrtc", str(port)], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_port(port)
+        elapsed, stats, samples, peak, settled, per_ip_status, filled, global_status, capped = asyncio.run(run(proc.pid))
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+    print(f"{cycles} 次观众连接 / 断开（{concurrency} 路并发），耗时 {elapsed:.1f} 秒，失败 {stats['failed']}")
+    print("服务端 RSS: " + "  ".join(f"{n}:{rss / 1024 / 1024:.1f}MB" for n, rss in samples))
+    # 前半程包含导入与内存池的预热，按后半程的增长判断是否泄漏（不计对端消失测试）
+    soak = samples[:-1]
+    print(f"后半程增长 {(soak[-1][1] - soak[len(soak) // 2][1]) / 1024 / 1024:+.1f} MB（{soak[len(soak) // 2][0]} 次之后）")
+    print(f"对端消失: 20 个观众在线时共 {peak} 个连接；回收后 {settled['total']} 个（发布者与常驻观众）"
+          f" {'✅' if settled['total'] == 2 else '❌'}")
+    print(f"回收统计: {settled['reaped']}")
+    print(f"每 IP 上限 {per_ip}: 第 {per_ip + 1} 个连接 HTTP {per_ip_status} {'✅' if per_ip_status == 429 else '❌'}")
+    print(f"总数上限 {max_connections}: 新建 {filled} 个后 HTTP {global_status} {'✅' if global_status == 503 else '❌'}，"
+          f"回收后 {capped['total']} 个，拒绝统计 {capped['rejected']}")
+
+
+def _soak_vanish(port, n):
+    """bench_soak 的子进程：建立 n 个观众后输出一行，等待被强制结束"""
+    import asyncio
+    import requests
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+
+    async def run():
+        pcs = []
+        for i in range(n):
+            pc = RTCPeerConnection()
+            pc.addTransceiver("video", direction="recvonly")
+            await pc.setLocalDescription(await pc.createOffer())
+            body = {"sdp": pc.localDescription.sdp, "type": "offer", "stream": "soak", "timeout": 5}
+            loop = asyncio.get_running_loop()
+            answer = await loop.run_in_executor(None, lambda: requests.post(
+                f"http://127.0.0.1:{port}/view", json=body, headers={"X-Forwarded-For": f"10.2.0.{i}"}, timeout=30).json())
+            await pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+            pcs.append(pc)
+        while not all(pc.connectionState == "connected" for pc in pcs):
+            await asyncio.sleep(0.1)
+        print("ready", flush=True)
+        await asyncio.sleep(3600)
+
+    asyncio.run(run())
+
+
+def bench_fanout(viewers=4, seconds=6, port=5102):
+    """共享编码：1 个发布者（640x480），观众逐个增加到 viewers 个，分别在每观众单独编码 / 共享编码
+    （WEBRTC_FANOUT=1）时测量服务端 CPU 与观众帧率，得出每增加一个观众的 CPU 开销"""
+    import asyncio
+    import subprocess
+    import requests
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from aiortc.mediastreams import MediaStreamError
+
+    logging.getLogger("aioice").setLevel(logging.WARNING)
+    base = f"http://127.0.0.1:{port}"
+
+    async def negotiate(pc, path, payload):
+        await pc.setLocalDescription(await pc.createOffer())
+        loop = asyncio.get_running_loop()
+        body = dict(payload, sdp=pc.localDescription.sdp, type=pc.localDescription.type)
+        answer = await loop.run_in_executor(None, lambda: requests.post(base + path, json=body, timeout=30).json())
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+
+    async def run(server_pid):
+        publisher = RTCPeerConnection()
+        publisher.addTrack(synthetic_track(640, 480))
+        await negotiate(publisher, "/webrtc", {"stream": "bench"})
+        pcs, tasks, frames = [publisher], [], []
+        rows = []
+        for n in range(viewers + 1):
+            if n:
+                pc = RTCPeerConnection()
+                pc.addTransceiver("video", direction="recvonly")
+                frames.append(0)
+
+                def on_track(track, i=n - 1):
+                    async def consume():
+                        while True:
+                            try:
+                                frame = await track.recv()
+                            except MediaStreamError:
+                                return
+                            frames[i] += frame.width == 640
+                    tasks.append(asyncio.ensure_future(consume()))
+                pc.on("track", on_track)
+                await negotiate(pc, "/view", {"stream": "bench", "timeout": 10})
+                pcs.append(pc)
+            await asyncio.sleep(3)
+            before, counted = proc_usage(server_pid), list(frames)
+            await asyncio.sleep(seconds)
+            after = proc_usage(server_pid)
+            cpu = (after[0] - before[0]) / seconds * 100 if before and after else float("nan")
+            fps = [(b - a) / seconds for a, b in zip(counted, frames)]
+            rows.append((n, cpu, min(fps) if fps else None))
+        loop = asyncio.get_running_loop()
+        streams = await loop.run_in_executor(None, lambda: requests.get(base + "/streams", timeout=10).json())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*(pc.close() for pc in pcs), return_exceptions=True)
+        return rows, streams["streams"][0]["fanout"]
+
+    results = {}
+    for mode in ("0", "1"):
+        env = dict(os.environ, WEBRTC_FANOUT=mode)
+        proc = subprocess.Popen([sys.executable, __file__, "_webrtc", str(port)], env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_port(port)
+            results[mode] = asyncio.run(run(proc.pid))
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+    print(f"1 个发布者（640x480，30fps），观众 0..{viewers} 个，每档 {seconds} 秒")
+    for mode, (rows, profiles) in results.items():
+        print("共享编码 (WEBRTC_FANOUT=1):" if mode == "1" else "每观众单独编码:")
+        for n, cpu, fps in rows:
+            extra = f"  最慢观众 {fps:5.1f} fps" if fps is not None else ""
+            print(f"  观众 {n}: 服务端 CPU {cpu:6.1f}%{extra}")
+        if viewers > 1:
+            print(f"  第 2..{viewers} 个观众平均每个 +{(rows[-1][1] - rows[1][1]) / (viewers - 1):.1f}% CPU"
+                  f"（第 1 个 +{rows[1][1] - rows[0][1]:.1f}%）")
+        if profiles:
+            print(f"  编码配置: {profiles}")
+
+
+def bench_stats(viewers=8, seconds=10, port=5105):
+    """连接质量采样（qos）的开销：1 个发布者 + viewers 个观众，在关闭采样（WEBRTC_STATS_INTERVAL=0）、
+    默认间隔与 10 倍频率下测量服务端 CPU，并读取 /stats 中采样任务自身的耗时，校验各项统计"""
+    import asyncio
+    import subprocess
+    import requests
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from aiortc.mediastreams import MediaStreamError
+
+    logging.getLogger("aioice").setLevel(logging.WARNING)
+    base = f"http://127.0.0.1:{port}"
+
+    async def negotiate(pc, path, payload):
+        await pc.setLocalDescription(await pc.createOffer())
+        loop = asyncio.get_running_loop()
+        body = dict(payload, sdp=pc.localDescription.sdp, type=pc.localDescription.type)
+        answer = await loop.run_in_executor(None, lambda: requests.post(base + path, json=body, timeout=30).json())
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+        return answer
+
+    async def consume(track):
+        while True:
+            try:
+                await track.recv()
+            except MediaStreamError:
+                return
+
+    async def run(server_pid):
+        loop = asyncio.get_running_loop()
+        get = lambda path: loop.run_in_executor(None, lambda: requests.get(base + path, timeout=10))
+        publisher = RTCPeerConnection()
+        publisher.addTrack(synthetic_track(320))
+        await negotiate(publisher, "/webrtc", {"stream": "bench"})
+        pcs, tasks, sessions = [publisher], [], []
+        for _ in range(viewers):
+            pc = RTCPeerConnection()
+            pc.addTransceiver("video", direction="recvonly")
+            pc.on("track", lambda track: tasks.append(asyncio.ensure_future(consume(track))))
+            sessions.append((await negotiate(pc, "/view", {"stream": "bench", "timeout": 10}))["session"])
+            pcs.append(pc)
+        await asyncio.sleep(5)
+        before, stats_before = proc_usage(server_pid), (await get("/stats")).json()
+        await asyncio.sleep(seconds)
+        after, stats = proc_usage(server_pid), (await get("/stats")).json()
+        cpu = (after[0] - before[0]) / seconds * 100 if before and after else float("nan")
+        detail = await get(f"/stats?connection={sessions[0]}")
+        missing = await get("/stats?connection=none")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*(pc.close() for pc in pcs), return_exceptions=True)
+        collector_ms = stats["collector"]["total_ms"] - stats_before["collector"]["total_ms"]
+        return cpu, collector_ms / seconds / 10, stats, detail.json() if detail.ok else None, missing.status_code
+
+    results = {}
+    for interval in ("0", "2", "0.2"):
+        env = dict(os.environ, WEBRTC_STATS_INTERVAL=interval)
+        proc = subprocess.Popen([sys.executable, __file__, "_webrtc", str(port)], env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_port(port)
+            results[interval] = asyncio.run(run(proc.pid))
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+    print(f"1 个发布者（320x240，30fps）+ {viewers} 个观众，每种间隔测量 {seconds} 秒")
+    base_cpu = results["0"][0]
+    for interval, (cpu, own, stats, detail, missing) in results.items():
+        label = "关闭采样" if interval == "0" else f"每 {interval} 秒采样"
+        collector = stats["collector"]
+        print(f"  {label:10}: 服务端 CPU {cpu:6.1f}%（{cpu - base_cpu:+.1f}%）  采样任务自身 {own:.3f}% 单核"
+              f"  每轮 {collector['avg_ms']:.2f}ms（最长 {collector['max_ms']:.2f}ms）  每个连接 {collector['per_sample_us']:.0f}µs")
+    _, _, stats, detail, missing = results["2"]
+    for stream in stats["streams"]:
+        print(f"  流 {stream['stream']}: 发布者 {stream['publisher']}")
+        print(f"    观众 {stream['viewers']}")
+    print(f"  观众连接明细: current={detail and detail['current']}，history {len(detail['history']) if detail else 0} 个间隔")
+    ok = (detail is not None and missing == 404 and stats["streams"]
+          and stats["streams"][0]["viewers"]["count"] == viewers and stats["streams"][0]["viewers"]["fps"]
+          and all(c["current"] for c in stats["connections"]))
+    print(f"  统计校验: {'通过' if ok else '失败'}（未知连接返回 {missing}）")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("""
+性能基准工具
+------------
+用法: python bench.py <命令> [参数...]
+
+命令:
+  folders [N] [M] [轮数]  - /api/folders 新旧实现延迟对比（N 个文件夹 × M 个视频）
+  serve [并发] [秒] [MB]  - 视频 Range 拖动并发压测
+  prod [并发] [秒] [KB]   - 开发服务器与生产模式对比（心跳 / 列表 / 上传）
+  db [进程] [线程] [秒]   - 数据库并发读写压测（旧连接方式 vs 共享连接层 + WAL）
+  relay [N] [M] [秒]      - WebRTC 中继：N 个发布者 × 每路 M 个观众的 CPU / 内存
+  view [观众数]           - 观众等待发布端上线的加入延迟、等待上限与断开取消
+  pending [观众数] [秒]   - 同时挂起的等待观众：内存、CPU、其他接口延迟与断开释放
+  record [秒] [分段秒]    - 服务端录制对观众帧率 / 服务端 CPU 的影响，以及写出的分段
+  direct [次数]           - 观众进入 / 离开时更新 webrtc_direct 的延迟（同步 PATCH vs 状态通道）与回退
+  fanout [观众数] [秒]    - 每观众单独编码与共享编码（WEBRTC_FANOUT）时每增加一个观众的 CPU 开销
+  cluster [N] [进程] [秒] - N 个回环发布者在 1..进程 个 WebRTC 工作进程上的总帧率 / CPU，以及崩溃重启
+  soak [次数] [并发]      - 观众反复连接 / 断开时服务端内存与连接回收，以及每 IP / 总连接数上限
+  stats [观众数] [秒]     - 连接质量采样（qos）在不同采样间隔下的服务端 CPU 开销与 /stats 统计
+        """)
+        sys.exit(1)
+
+    command = sys.argv[1]
+    if command == "_serve":
+        serve_sandbox(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+    if command == "_webrtc":
+        import webrtc_server
+        if len(sys.argv) > 3:
+            # 录制写入临时目录
+            import db_manage
+            import recorder
+            recorder.UPLOAD_ROOT = os.path.join(sys.argv[3], "uploads")
+            recorder.DB_PATH = db_manage.DB_PATH = os.path.join(sys.argv[3], "database.db")
+            db_manage.migrate(path=recorder.DB_PATH)
+        webrtc_server.start_webrtc_server(int(sys.argv[2]))
+        sys.exit(0)
+    if command == "_soak_vanish":
+        _soak_vanish(int(sys.argv[2]), int(sys.argv[3]))
+        sys.exit(0)
+    args = [int(a) for a in sys.argv[2:]]
+
+    if command == "folders":
+        bench_folders(*args)
+    elif command == "serve":
+        bench_serve(*args)
+    elif command == "prod":
+        bench_prod(*args)
+    elif command == "db":
+        bench_db(*args)
+    elif command == "relay":
+        bench_relay(*args)
+    elif command == "view":
+        bench_view(*args)
+    elif command == "pending":
+        bench_pending(*args)
+    elif command == "record":
+        bench_record(*args)
+    elif command == "direct":
+        bench_direct(*args)
+    elif command == "fanout":
+        bench_fanout(*args)
+    elif command == "cluster":
+        bench_cluster(*args)
+    elif command == "soak":
+        bench_soak(*args)
+    elif command == "stats":
+        bench_stats(*args)
+    else:
+        print(f"未知命令: {command}")
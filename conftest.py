@@ -0,0 +1 @@
+"""pytest 配置：测试直接 import 仓库根目录下的模块（本文件所在目录由 pytest 加入 sys.path）"""
@@ -0,0 +1,81 @@
+"""
+数据库访问层
+------------
+backend.py / db_manage.py / jobs.py 共用的 SQLite 连接：
+
+- WAL 日志：读写互不阻塞，写事务只需追加 WAL，提交时不再整库加锁
+- synchronous=NORMAL：WAL 下只在检查点时 fsync，断电最多丢失最近提交的事务，不会损坏数据库
+- busy_timeout：写锁被占用时等待而不是立即报 "database is locked"
+- 每个线程复用同一个连接（及其预编译语句缓存），不再每个请求重新打开
+- transaction()：显式的 BEGIN IMMEDIATE 事务，开始时即取得写锁，避免读后升级写锁时的冲突
+- foreign_keys=ON：表结构中的 ON DELETE CASCADE 生效（SQLite 默认不检查外键）
+"""
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# 等待写锁的最长秒数、每个连接缓存的预编译语句数、页缓存大小（KB）
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", 30))
+DB_CACHED_STATEMENTS = 256
+DB_CACHE_KB = 16 * 1024
+
+_local = threading.local()
+
+
+def connect(path, autocommit=False):
+    """打开一个新连接并设置 PRAGMA。autocommit=True 时不自动开启事务（由调用方显式 BEGIN）"""
+    db = sqlite3.connect(
+        path, timeout=DB_BUSY_TIMEOUT, cached_statements=DB_CACHED_STATEMENTS,
+        isolation_level=None if autocommit else "",
+    )
+    db.row_factory = sqlite3.Row
+    # journal_mode=WAL 写入数据库文件本身，对已是 WAL 的库是空操作
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute(f'PRAGMA cache_size=-{DB_CACHE_KB}')
+    db.execute('PRAGMA temp_store=MEMORY')
+    db.execute('PRAGMA foreign_keys=ON')
+    return db
+
+
+def get(path):
+    """当前线程的共享连接（按数据库路径区分）。fork 出的子进程不复用父进程的连接"""
+    pool = getattr(_local, "pool", None)
+    if pool is None or _local.pid != os.getpid():
+        pool = _local.pool = {}
+        _local.pid = os.getpid()
+    db = pool.get(path)
+    if db is None:
+        db = pool[path] = connect(path)
+    return db
+
+
+def release(db):
+    """请求结束时调用：回滚未提交的事务，连接留在线程中复用"""
+    if db.in_transaction:
+        db.rollback()
+
+
+def close_all():
+    """关闭当前线程的全部共享连接"""
+    pool = getattr(_local, "pool", None) or {}
+    for db in pool.values():
+        db.close()
+    pool.clear()
+
+
+@contextmanager
+def transaction(db):
+    """写事务：BEGIN IMMEDIATE，正常结束提交，异常回滚。已在事务中时并入外层事务"""
+    if db.in_transaction:
+        yield db
+        return
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
@@ -4,17 +4,27 @@
 用于管理 SQLite 数据库的脚本
 """
 
-import sqlite3
+import database
 import os
+import time
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "database.db")
+UPLOAD_ROOT = os.path.join(os.path.dirname(__file__), "uploads")
+VIDEO_EXTS = (".mp4", ".avi", ".mov", ".webm", ".mkv")
 
 
 def init_db():
-    """初始化数据库表"""
-    db = sqlite3.connect(DB_PATH)
-    cursor = db.cursor()
-    
+    """初始化数据库：按顺序执行尚未应用的迁移"""
+    applied = migrate()
+    print(f"✅ 数据库初始化完成 (schema v{LATEST_VERSION}{f'，本次应用 {len(applied)} 个迁移' if applied else ''})")
+
+
+# ---------------- 迁移 ----------------
+# 每个迁移是一个函数 (cursor) -> None，在单独的写事务中执行并记录到 schema_version 表。
+# 只能在列表末尾追加新迁移，已发布的迁移不要修改。
+
+def migrate_base(cursor):
+    """v1：引入版本号之前由 init_db 维护的全部表结构（幂等，旧库升级时补齐缺失的列）"""
     # 创建文件夹表
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS folders (
@@ -37,34 +47,555 @@ def init_db():
         )
     ''')
     
+    # 断点续传会话与已接收的分块（offset/length 为字节区间）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            ip TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT,
+            idempotency_key TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_chunks (
+            upload_id TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            PRIMARY KEY (upload_id, offset),
+            FOREIGN KEY (upload_id) REFERENCES upload_sessions(id) ON DELETE CASCADE
+        )
+    ''')
+
     # 创建索引
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_ip ON videos(ip)')
-     # ✅ 插入一条默认记录（仅在表为空时）
-    # cursor.execute('''
-    #     INSERT INTO folders (ip, remark)
-    #     VALUES (?, ?)
-    #     ''', ('172.16.0.195', '测试文件夹'))
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions(updated_at)')
+    # 列表分页/排序用索引：视频按 IP 内的上传时间、大小、文件名做键集分页
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_ip_uploaded ON videos(ip, uploaded_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_ip_size ON videos(ip, file_size, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_ip_filename ON videos(ip, filename, id)')
 
-    # 迁移：为 folders 增加配置列（如不存在）
     def ensure_column(table: str, column: str, definition: str):
-        cursor.execute(f'PRAGMA table_info({table})')
-        cols = [row[1] for row in cursor.fetchall()]
-        if column not in cols:
-            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        return add_column(cursor, table, column, definition)
 
     # 是否上传录屏：0/1，默认 1（开启）
     ensure_column('folders', 'upload_enabled', 'INTEGER DEFAULT 1')
     # 是否直连 WebRTC：0/1，默认 0（关闭）
     ensure_column('folders', 'webrtc_direct', 'INTEGER DEFAULT 0')
+    # 在线/离线筛选用索引
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_folders_updated ON folders(updated_at)')
+
+    # 按 IP 维护的视频统计（由 videos 上的触发器在同一事务内更新）
+    added = ensure_column('folders', 'video_count', 'INTEGER NOT NULL DEFAULT 0')
+    added |= ensure_column('folders', 'total_bytes', 'INTEGER NOT NULL DEFAULT 0')
+    added |= ensure_column('folders', 'last_upload_at', 'TIMESTAMP')
+    create_counter_triggers(cursor)
+    if added:
+        # 旧库首次升级：按现有 videos 回填统计
+        cursor.execute('INSERT OR IGNORE INTO folders (ip) SELECT DISTINCT ip FROM videos')
+        rebuild_counters(cursor)
+
+    # 上传去重：内容哈希与客户端幂等键（同一 IP 内幂等键唯一）
+    ensure_column('videos', 'sha256', 'TEXT')
+    ensure_column('videos', 'idempotency_key', 'TEXT')
+    ensure_column('upload_sessions', 'idempotency_key', 'TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_ip_sha256 ON videos(ip, sha256)')
+    cursor.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_videos_ip_idempotency '
+        'ON videos(ip, idempotency_key) WHERE idempotency_key IS NOT NULL'
+    )
+
+    # 上传后处理：视频元数据（由 jobs.py 的工作进程探测写入）与任务队列
+    ensure_column('videos', 'duration', 'REAL')
+    ensure_column('videos', 'video_codec', 'TEXT')
+    ensure_column('videos', 'audio_codec', 'TEXT')
+    ensure_column('videos', 'width', 'INTEGER')
+    ensure_column('videos', 'height', 'INTEGER')
+    ensure_column('videos', 'faststart', 'INTEGER')
+    ensure_column('videos', 'processed_at', 'TIMESTAMP')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            video_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            action TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            progress REAL NOT NULL DEFAULT 0,
+            error TEXT,
+            worker TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            heartbeat_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_video ON jobs(video_id)')
+    create_job_triggers(cursor)
+
+
+def migrate_indexes(cursor):
+    """v2：列表排序用索引。
+
+    - videos(uploaded_at)：db_manage list 按上传时间全表输出时免排序
+    - 文件大小排序的表达式与接口一致（COALESCE(file_size, 0)），否则索引用不上
+    - 文件夹按最近上传 / 心跳时间 / 视频数排序
+    - idx_videos_ip 是 idx_videos_ip_uploaded 的前缀，删除以减少写入开销
+    """
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_uploaded ON videos(uploaded_at)')
+    cursor.execute('DROP INDEX IF EXISTS idx_videos_ip_size')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_ip_size ON videos(ip, COALESCE(file_size, 0), id)')
+    cursor.execute('DROP INDEX IF EXISTS idx_videos_ip')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_folders_last_upload ON folders(COALESCE(last_upload_at, ''), ip)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_folders_heartbeat ON folders(COALESCE(updated_at, ''), ip)")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_folders_video_count ON folders(video_count, ip)')
+
+
+def migrate_foreign_keys(cursor):
+    """v3：启用外键约束（database.connect 中 PRAGMA foreign_keys=ON）前修复孤儿记录，
+    之后删除文件夹会级联删除其视频记录，删除上传会话会级联删除其分块"""
+    cursor.execute('INSERT OR IGNORE INTO folders (ip) SELECT DISTINCT ip FROM videos')
+    cursor.execute('DELETE FROM upload_chunks WHERE upload_id NOT IN (SELECT id FROM upload_sessions)')
+    rebuild_counters(cursor)
+    broken = cursor.execute('PRAGMA foreign_key_check').fetchall()
+    if broken:
+        raise RuntimeError(f"外键检查失败: {[tuple(r) for r in broken[:5]]}")
+
+
+def migrate_retention(cursor):
+    """v4：文件夹级保留策略（NULL 使用全局默认值，0 不限制，见 retention.py）"""
+    add_column(cursor, 'folders', 'retention_days', 'INTEGER')
+    add_column(cursor, 'folders', 'retention_bytes', 'INTEGER')
+    add_column(cursor, 'folders', 'retention_count', 'INTEGER')
+
+
+def migrate_purges(cursor):
+    """v5：文件夹删除改为墓碑 + 后台清除（见 purge.py）"""
+    add_column(cursor, 'folders', 'deleted_at', 'TIMESTAMP')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS purges (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ip TEXT NOT NULL,
+            trash_path TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            files_total INTEGER NOT NULL DEFAULT 0,
+            bytes_total INTEGER NOT NULL DEFAULT 0,
+            files_deleted INTEGER NOT NULL DEFAULT 0,
+            bytes_deleted INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_purges_status ON purges(status, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_purges_ip ON purges(ip, id)')
+
+
+def migrate_unique_filenames(cursor):
+    """v6：同一文件夹下的文件名唯一。
+
+    对账（reconcile）可能与上传 / 录制同时运行，先登记了尚在写入的文件，之后上传完成时又插入一条。
+    已有的重复记录保留最后登记的一条（上传 / 录制写入的，带 sha256），其余删除（触发器同步统计与任务）。
+    idx_videos_ip_filename 改为 (ip, filename) 唯一索引；filename 非空且唯一，按文件名分页仍不需要排序
+    """
+    cursor.execute('''
+        DELETE FROM videos WHERE id NOT IN (SELECT MAX(id) FROM videos GROUP BY ip, filename)
+    ''')
+    cursor.execute('DROP INDEX IF EXISTS idx_videos_ip_filename')
+    cursor.execute('CREATE UNIQUE INDEX idx_videos_ip_filename ON videos(ip, filename)')
+
+
+MIGRATIONS = [
+    (1, "基础表结构", migrate_base),
+    (2, "列表排序索引", migrate_indexes),
+    (3, "启用外键级联删除", migrate_foreign_keys),
+    (4, "文件夹保留策略", migrate_retention),
+    (5, "文件夹墓碑与后台清除", migrate_purges),
+    (6, "文件夹内文件名唯一", migrate_unique_filenames),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def add_column(cursor, table, column, definition):
+    """列不存在时添加，返回是否新增"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    cols = [row[1] for row in cursor.fetchall()]
+    if column not in cols:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        return True
+    return False
+
+
+def schema_version(db):
+    """当前已应用的最高迁移版本，未初始化的库为 0"""
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    return db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def migrate(dry_run=False, path=None):
+    """执行尚未应用的迁移，每个迁移一个事务（失败时回滚，版本号不变）。
+
+    dry_run=True 时在同一事务中执行全部待执行的迁移后回滚，只打印会执行的语句。
+    返回应用（或将应用）的迁移版本列表。
+    """
+    db = database.connect(path or DB_PATH, autocommit=True)
+    statements = []
+    if dry_run:
+        # 只记录会修改数据库的语句
+        db.set_trace_callback(lambda sql: statements.append(" ".join(sql.split())))
+    applied = []
+    try:
+        if dry_run:
+            db.execute('BEGIN IMMEDIATE')
+        for version, description, func in MIGRATIONS:
+            if not dry_run:
+                db.execute('BEGIN IMMEDIATE')
+            try:
+                # 在写事务内读取版本，多个进程同时启动时只有一个会执行迁移
+                if version <= schema_version(db):
+                    if not dry_run:
+                        db.rollback()
+                    continue
+                statements.clear()
+                func(db.cursor())
+                db.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)', (version, description))
+            except BaseException:
+                db.rollback()
+                raise
+            applied.append(version)
+            if dry_run:
+                print(f"-- v{version}: {description}")
+                for sql in statements:
+                    if not sql.upper().startswith(("SELECT", "PRAGMA", "BEGIN", "--")):
+                        print(sql + ";")
+            else:
+                db.commit()
+        if dry_run:
+            db.rollback()
+            if not applied:
+                print("-- 已是最新版本")
+    finally:
+        db.close()
+    return applied
+
+
+def show_version():
+    """显示已应用的迁移"""
+    db = database.connect(DB_PATH)
+    current = schema_version(db)
+    for version, description, applied_at in db.execute(
+        'SELECT version, description, applied_at FROM schema_version ORDER BY version'
+    ):
+        print(f"v{version}  {applied_at}  {description}")
+    pending = [m for m in MIGRATIONS if m[0] > current]
+    print(f"当前版本: v{current}，最新: v{LATEST_VERSION}，待执行: {len(pending)}")
+    db.close()
+
+
+# ---------------- 查询计划检查 ----------------
+# 接口与后台任务中的高频查询（与 backend.py / jobs.py / presence.py 中的写法保持一致），
+# 新增查询或修改排序表达式时同步更新。第三项为 True 表示允许整表扫描（本身就要读全部行）
+_VIDEO_PAGE = (
+    'SELECT s.*, {sort} AS sort_key, s.id AS tie_key FROM ('
+    'SELECT id, filename, file_size, uploaded_at, duration, video_codec, width, height, processed_at '
+    'FROM videos WHERE ip = ?) AS s WHERE ({sort}, s.id) < (?, ?) ORDER BY {sort} DESC, s.id DESC LIMIT ?'
+)
+_FOLDER_PAGE = (
+    'SELECT s.*, {sort} AS sort_key, s.ip AS tie_key FROM ('
+    'SELECT f.ip, f.remark, f.upload_enabled, f.webrtc_direct, f.updated_at, '
+    'f.video_count, f.total_bytes, f.last_upload_at, '
+    "COALESCE(f.updated_at >= datetime('now', ?), 0) AS online FROM folders f WHERE f.deleted_at IS NULL) AS s "
+    'ORDER BY {sort} DESC, s.ip DESC LIMIT ?'
+)
+HOT_QUERIES = [
+    ("视频列表 按上传时间", _VIDEO_PAGE.format(sort="s.uploaded_at"), False),
+    ("视频列表 按大小", _VIDEO_PAGE.format(sort="COALESCE(s.file_size, 0)"), False),
+    ("视频列表 按文件名", _VIDEO_PAGE.format(sort="s.filename"), False),
+    ("文件夹列表 按 IP", _FOLDER_PAGE.format(sort="s.ip"), False),
+    ("文件夹列表 按最近上传", _FOLDER_PAGE.format(sort="COALESCE(s.last_upload_at, '')"), False),
+    ("文件夹列表 按心跳时间", _FOLDER_PAGE.format(sort="COALESCE(s.updated_at, '')"), False),
+    ("文件夹列表 按视频数", _FOLDER_PAGE.format(sort="s.video_count"), False),
+    ("最近上传", 'SELECT filename, uploaded_at FROM videos WHERE ip = ? ORDER BY uploaded_at DESC LIMIT 1', False),
+    ("删除视频后更新统计", 'SELECT MAX(uploaded_at) FROM videos WHERE ip = ?', False),
+    ("按内容哈希去重", 'SELECT filename, file_size, sha256 FROM videos WHERE ip = ? AND sha256 = ?', False),
+    ("按幂等键去重", 'SELECT filename, file_size, sha256 FROM videos WHERE ip = ? AND idempotency_key = ?', False),
+    ("按文件名查视频", 'SELECT sha256 FROM videos WHERE ip = ? AND filename = ?', False),
+    ("删除文件夹级联", 'SELECT id FROM videos WHERE ip = ?', False),
+    ("后台清除 按文件名删除记录", 'SELECT id FROM videos WHERE ip = ? AND filename = ?', False),
+    ("后台清除 进行中的任务", "SELECT id FROM purges WHERE ip = ? AND status != 'done' ORDER BY id DESC LIMIT 1", False),
+    ("领取任务", "SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1", False),
+    ("任务计数", 'SELECT status, COUNT(*) AS n FROM jobs GROUP BY status', False),
+    ("在线状态同步", 'SELECT ip, updated_at FROM folders WHERE updated_at >= ? ORDER BY updated_at', False),
+    ("上传会话回收", "SELECT id FROM upload_sessions WHERE updated_at < datetime('now', ?)", False),
+    ("保留策略 文件夹内最旧",
+     'SELECT id, ip, filename, file_size, uploaded_at FROM videos WHERE ip = ? ORDER BY uploaded_at, id', False),
+    ("保留策略 全局最旧", 'SELECT id, ip, filename, file_size, uploaded_at FROM videos ORDER BY uploaded_at, id', True),
+    ("db_manage list", 'SELECT ip, filename, file_size, uploaded_at FROM videos ORDER BY uploaded_at DESC', True),
+    ("db_manage stats", 'SELECT SUM(video_count), SUM(total_bytes) FROM folders', True),
+]
+
+
+def plan_problems(db, sql, full_scan_ok=False):
+    """返回查询计划中的问题：未走索引的整表扫描、为 ORDER BY / GROUP BY 建临时 B 树"""
+    problems = []
+    for row in db.execute('EXPLAIN QUERY PLAN ' + sql, [None] * sql.count('?')):
+        detail = row[3]
+        if detail.startswith("SCAN ") and "INDEX" not in detail and not full_scan_ok:
+            problems.append(detail)
+        # "RIGHT PART OF ORDER BY" 只对前导列相同的少量行排序，不算问题
+        elif "TEMP B-TREE" in detail and "RIGHT PART" not in detail:
+            problems.append(detail)
+    return problems
+
+
+def check_plans(path=None):
+    """用 EXPLAIN QUERY PLAN 检查高频查询，全部走索引返回 True。
+
+    不指定 path 时在临时库上执行全部迁移后检查（检查的是代码中的表结构）。
+    """
+    import tempfile
+    import shutil
+
+    tmp = None
+    if path is None:
+        tmp = tempfile.mkdtemp(prefix="catchscreen_check_")
+        path = os.path.join(tmp, "database.db")
+        migrate(path=path)
+    db = database.connect(path)
+    ok = True
+    try:
+        for name, sql, full_scan_ok in HOT_QUERIES:
+            problems = plan_problems(db, sql, full_scan_ok)
+            ok &= not problems
+            print(f"{'❌' if problems else '✅'} {name}" + "".join(f"\n     {p}" for p in problems))
+    finally:
+        db.close()
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return ok
+
+
+def create_counter_triggers(cursor):
+    """创建维护 folders.video_count / total_bytes / last_upload_at 的触发器"""
+    # 插入视频前确保文件夹记录存在
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_videos_folder BEFORE INSERT ON videos
+        BEGIN
+            INSERT OR IGNORE INTO folders (ip) VALUES (NEW.ip);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_videos_insert AFTER INSERT ON videos
+        BEGIN
+            UPDATE folders SET
+                video_count = video_count + 1,
+                total_bytes = total_bytes + COALESCE(NEW.file_size, 0),
+                last_upload_at = CASE
+                    WHEN last_upload_at IS NULL OR NEW.uploaded_at > last_upload_at THEN NEW.uploaded_at
+                    ELSE last_upload_at END
+            WHERE ip = NEW.ip;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_videos_delete AFTER DELETE ON videos
+        BEGIN
+            UPDATE folders SET
+                video_count = video_count - 1,
+                total_bytes = total_bytes - COALESCE(OLD.file_size, 0),
+                last_upload_at = (SELECT MAX(uploaded_at) FROM videos WHERE ip = OLD.ip)
+            WHERE ip = OLD.ip;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_videos_update AFTER UPDATE OF file_size, uploaded_at ON videos
+        BEGIN
+            UPDATE folders SET
+                total_bytes = total_bytes - COALESCE(OLD.file_size, 0) + COALESCE(NEW.file_size, 0),
+                last_upload_at = (SELECT MAX(uploaded_at) FROM videos WHERE ip = NEW.ip)
+            WHERE ip = NEW.ip;
+        END
+    ''')
+
+
+def create_job_triggers(cursor):
+    """新视频入库即排队处理；视频删除时一并删除其任务"""
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_videos_job AFTER INSERT ON videos
+        BEGIN
+            INSERT INTO jobs (video_id) VALUES (NEW.id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_videos_job_delete AFTER DELETE ON videos
+        BEGIN
+            DELETE FROM jobs WHERE video_id = OLD.id;
+        END
+    ''')
+
+
+def upsert_video(cursor, ip, filename, file_size, sha256=None, idempotency_key=None):
+    """登记上传 / 录制完成的视频。同名记录已存在（对账先登记了写入中的文件）时以本次为准更新，
+    并重新排队处理（之前的任务可能处理的是不完整的文件）。幂等键冲突时抛出 sqlite3.IntegrityError"""
+    cursor.execute('''
+        INSERT INTO videos (ip, filename, file_size, sha256, idempotency_key) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(ip, filename) DO UPDATE SET
+            file_size = excluded.file_size,
+            sha256 = excluded.sha256,
+            idempotency_key = COALESCE(excluded.idempotency_key, idempotency_key),
+            uploaded_at = CURRENT_TIMESTAMP
+    ''', (ip, filename, file_size, sha256, idempotency_key))
+    cursor.execute('''
+        INSERT INTO jobs (video_id)
+        SELECT id FROM videos v WHERE ip = ? AND filename = ?
+            AND NOT EXISTS (SELECT 1 FROM jobs WHERE video_id = v.id AND status = 'queued')
+    ''', (ip, filename))
+
+
+def rebuild_counters(cursor, ip=None):
+    """按 videos 表重新计算统计列（ip 为空时重算全部文件夹）"""
+    sql = '''
+        UPDATE folders SET
+            video_count = (SELECT COUNT(*) FROM videos v WHERE v.ip = folders.ip),
+            total_bytes = (SELECT COALESCE(SUM(file_size), 0) FROM videos v WHERE v.ip = folders.ip),
+            last_upload_at = (SELECT MAX(uploaded_at) FROM videos v WHERE v.ip = folders.ip)
+    '''
+    if ip is None:
+        cursor.execute(sql)
+    else:
+        cursor.execute(sql + ' WHERE ip = ?', (ip,))
+
+
+def reconcile_uploads(upload_root=None, prune=False):
+    """以磁盘为准对账：单次流式遍历 uploads/，补建缺失的 folders / videos 行并重算统计列。
+
+    prune=True 时同时删除磁盘上已不存在的视频记录、修正大小不一致的记录。
+    接口只读数据库，文件系统仅在启动或手动执行时用于对账。
+    返回 (新增文件夹数, 新增视频数, 删除视频数)。
+    """
+    upload_root = upload_root or UPLOAD_ROOT
+    if not os.path.isdir(upload_root):
+        return 0, 0, 0
+
+    db = database.connect(DB_PATH)
+    cursor = db.cursor()
+    known = {row[0] for row in cursor.execute('SELECT ip FROM folders')}
+    seen = set()
+    added_folders = 0
+    added_videos = 0
+    removed_videos = 0
+
+    with os.scandir(upload_root) as entries:
+        for entry in entries:
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+            ip = entry.name
+            seen.add(ip)
+            if ip not in known:
+                cursor.execute('INSERT OR IGNORE INTO folders (ip) VALUES (?)', (ip,))
+                added_folders += 1
+            # 每次只把一个文件夹的记录载入内存
+            tracked = {
+                row[0]: (row[1], row[2])
+                for row in cursor.execute('SELECT filename, id, file_size FROM videos WHERE ip = ?', (ip,))
+            }
+            rows = []
+            with os.scandir(entry.path) as files:
+                for f in files:
+                    if not f.name.lower().endswith(VIDEO_EXTS) or not f.is_file():
+                        continue
+                    st = f.stat()
+                    if f.name in tracked:
+                        video_id, size = tracked.pop(f.name)
+                        if prune and size != st.st_size:
+                            cursor.execute('UPDATE videos SET file_size = ? WHERE id = ?', (st.st_size, video_id))
+                        continue
+                    uploaded_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(st.st_mtime))
+                    rows.append((ip, f.name, st.st_size, uploaded_at))
+            if rows:
+                cursor.executemany(
+                    'INSERT OR IGNORE INTO videos (ip, filename, file_size, uploaded_at) VALUES (?, ?, ?, ?)', rows
+                )
+                added_videos += cursor.rowcount
+            if prune and tracked:
+                cursor.executemany('DELETE FROM videos WHERE id = ?', [(v[0],) for v in tracked.values()])
+                removed_videos += len(tracked)
+            rebuild_counters(cursor, ip)
+
+    # 目录已不存在的文件夹：保留文件夹记录（可能仅有心跳），清理其视频记录
+    for ip in known - seen:
+        if prune:
+            cursor.execute('DELETE FROM videos WHERE ip = ?', (ip,))
+            removed_videos += cursor.rowcount
+        rebuild_counters(cursor, ip)
 
     db.commit()
     db.close()
-    print("✅ 数据库初始化完成")
+    return added_folders, added_videos, removed_videos
+
+
+def reconcile():
+    """对账命令：按磁盘重建视频记录与统计列"""
+    start = time.time()
+    added_folders, added_videos, removed_videos = reconcile_uploads(prune=True)
+    print(f"✅ 对账完成 ({time.time() - start:.2f}s)")
+    print(f"新增文件夹: {added_folders}")
+    print(f"新增视频记录: {added_videos}")
+    print(f"删除失效记录: {removed_videos}")
+
+
+def retention_report(apply=False):
+    """按保留策略列出会删除的录像；apply=True 时立即执行删除"""
+    import retention
+
+    db = database.connect(DB_PATH)
+    policy = retention.defaults()
+    print("\n🧹 保留策略（0 不限制）:")
+    print(f"默认: 保留 {policy['retention_days']} 天 / {policy['retention_bytes'] / 1024 / 1024:.0f} MB / "
+          f"{policy['retention_count']} 个，全部合计 {retention.RETENTION_TOTAL_BYTES / 1024 / 1024:.0f} MB")
+    for row in db.execute(
+        'SELECT ip, retention_days, retention_bytes, retention_count FROM folders '
+        'WHERE retention_days IS NOT NULL OR retention_bytes IS NOT NULL OR retention_count IS NOT NULL ORDER BY ip'
+    ):
+        p = retention.effective_policy(row)
+        print(f"{row['ip']}: 保留 {p['retention_days']} 天 / {p['retention_bytes'] / 1024 / 1024:.0f} MB / "
+              f"{p['retention_count']} 个")
+
+    if apply:
+        start = time.time()
+        n, size = retention.run_once(db, UPLOAD_ROOT)
+        db.close()
+        print(f"\n✅ 已删除 {n} 个录像，释放 {size / 1024 / 1024:.2f} MB ({time.time() - start:.1f}s)")
+        return
+
+    report = retention.summarize(db)
+    db.close()
+    print(f"\n将删除 {report['count']} 个录像，释放 {report['bytes'] / 1024 / 1024:.2f} MB")
+    if report['by_reason']:
+        print("按原因: " + ", ".join(f"{k} {v}" for k, v in report['by_reason'].items()))
+    for ip, item in sorted(report['folders'].items(), key=lambda kv: -kv[1]['bytes']):
+        print(f"  {ip}: {item['count']} 个, {item['bytes'] / 1024 / 1024:.2f} MB")
+    for video in report['videos'][:20]:
+        print(f"  [{video['reason']}] {video['ip']}/{video['filename']} ({video['uploaded_at']})")
+    if report['count'] > 20:
+        print(f"  ... 另有 {report['count'] - 20} 个")
+    if report['count']:
+        print("（仅预览，执行删除: python db_manage.py retention --apply）")
 
 
 def list_all():
     """列出所有数据"""
-    db = sqlite3.connect(DB_PATH)
+    db = database.connect(DB_PATH)
     cursor = db.cursor()
     
     print("\n📁 文件夹列表:")
@@ -103,7 +634,7 @@ def clear_db():
         print("已取消")
         return
     
-    db = sqlite3.connect(DB_PATH)
+    db = database.connect(DB_PATH)
     cursor = db.cursor()
     
     cursor.execute('DELETE FROM videos')
@@ -116,17 +647,17 @@ def clear_db():
 
 def show_stats():
     """显示统计信息"""
-    db = sqlite3.connect(DB_PATH)
+    db = database.connect(DB_PATH)
     cursor = db.cursor()
     
     cursor.execute('SELECT COUNT(*) FROM folders')
     folder_count = cursor.fetchone()[0]
     
-    cursor.execute('SELECT COUNT(*) FROM videos')
-    video_count = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT SUM(file_size) FROM videos')
-    total_size = cursor.fetchone()[0] or 0
+    # 直接汇总 folders 上维护的统计列，无需扫描 videos
+    cursor.execute('SELECT SUM(video_count), SUM(total_bytes) FROM folders')
+    video_count, total_size = cursor.fetchone()
+    video_count = video_count or 0
+    total_size = total_size or 0
     total_size_mb = total_size / (1024 * 1024)
     
     print(f"\n📊 数据库统计:")
@@ -147,9 +678,14 @@ if __name__ == "__main__":
 用法: python db_manage.py <命令>
 
 命令:
-  init     - 初始化数据库
+  init     - 初始化数据库（执行全部待执行的迁移）
+  migrate [--dry-run] - 执行迁移；--dry-run 只打印将执行的 SQL
+  version  - 显示已应用的迁移版本
+  check [数据库路径] - 检查高频查询的执行计划（有整表扫描 / 临时排序时退出码为 1）
   list     - 列出所有数据
   stats    - 显示统计信息
+  reconcile - 按 uploads/ 目录重建视频记录与统计
+  retention [--apply] - 预览按保留策略会删除的录像；--apply 立即删除
   clear    - 清空数据库
         """)
         sys.exit(1)
@@ -158,10 +694,23 @@ if __name__ == "__main__":
     
     if command == "init":
         init_db()
+    elif command == "migrate":
+        dry_run = "--dry-run" in sys.argv[2:]
+        applied = migrate(dry_run=dry_run)
+        if not dry_run:
+            print(f"✅ 已应用迁移: {', '.join(f'v{v}' for v in applied)}" if applied else "✅ 已是最新版本")
+    elif command == "version":
+        show_version()
+    elif command == "check":
+        sys.exit(0 if check_plans(sys.argv[2] if len(sys.argv) > 2 else None) else 1)
     elif command == "list":
         list_all()
     elif command == "stats":
         show_stats()
+    elif command == "reconcile":
+        reconcile()
+    elif command == "retention":
+        retention_report(apply="--apply" in sys.argv[2:])
     elif command == "clear":
         clear_db()
     else:
@@ -0,0 +1,257 @@
+"""
+观众共享编码（encode-once fan-out）
+----------------------------------
+默认每个观众的视频轨都是一路中继订阅，aiortc 为每个观众连接各运行一个编码器：同一画面有 N 个观众就编码 N 次。
+开启 WEBRTC_FANOUT 后，同一发布流按编码配置（codec + 码率档位）只订阅、编码一次，
+编码得到的 av.Packet 分发给该配置下所有观众的 PacketTrack；aiortc 的发送端收到 Packet 时只做 RTP 打包（pack），不再编码。
+每增加一个观众只多一次打包与发送，CPU 基本不随观众数增长。
+
+- 观众的编码配置按其 Offer 中排在最前的可共享编码 codec 与请求的码率选出，
+  并通过 setCodecPreferences 让协商结果与之一致
+- 新观众加入、观众发来 PLI / FIR、观众消费过慢丢包时请求关键帧；同一配置两次强制关键帧之间至少间隔
+  FANOUT_KEYFRAME_MIN_INTERVAL 秒，多个观众同时加入只编码一个关键帧。观众从关键帧开始接收
+- 码率固定为档位值，不再随单个观众的带宽估计（REMB）调整；音频仍按观众单独编码
+- 最后一个观众离开时停止编码并退订中继
+- 观众的 PLI / FIR 通过替换发送端的私有方法 _send_keyframe 接入（按 requirements.txt 中固定的 aiortc 版本编写）；
+  aiortc 中没有该方法时不使用共享编码，记录警告后按观众单独编码
+"""
+
+import os
+import time
+import asyncio
+from fractions import Fraction
+
+import aiortc
+import av
+from av.video.frame import PictureType
+from aiortc import MediaStreamTrack, RTCRtpSender
+from aiortc.mediastreams import MediaStreamError
+from aiortc.sdp import SessionDescription
+
+import recorder
+
+# 是否开启共享编码；支持的视频 codec（aiortc 能打包的）
+WEBRTC_FANOUT = os.environ.get("WEBRTC_FANOUT", "0") == "1"
+FANOUT_CODECS = ("video/VP8", "video/H264")
+# 码率档位（bps，逗号分隔）：观众请求的码率取不超过它的最高档，未请求时取第一档
+FANOUT_BITRATES = [int(b) for b in os.environ.get("WEBRTC_FANOUT_BITRATES", "1000000").split(",") if b.strip()]
+# 两次强制关键帧的最小间隔（秒）；每个观众最多积压的包数（约 1 秒），超出时丢弃并从下一个关键帧重新开始
+FANOUT_KEYFRAME_MIN_INTERVAL = 0.5
+FANOUT_QUEUE_SIZE = 30
+# 编码时间戳的时基（90kHz，与 RTP 视频时钟一致）
+VIDEO_TIME_BASE = Fraction(1, 90000)
+
+_warned = False  # 是否已记录过“无法接入关键帧请求”的警告
+
+
+def keyframe_hook_available():
+    """aiortc 的发送端是否有 _send_keyframe（PLI / FIR 的处理入口，私有方法，升级 aiortc 后可能不存在）"""
+    return callable(getattr(RTCRtpSender, "_send_keyframe", None))
+
+
+def choose_profile(offer_sdp, bitrate=None):
+    """按观众 Offer 与请求码率选出编码配置 (codec, 码率)；Offer 中没有可共享编码的视频 codec，
+    或当前 aiortc 无法接入关键帧请求时返回 None"""
+    global _warned
+    if not keyframe_hook_available():
+        if not _warned:
+            _warned = True
+            print(f"[FANOUT] aiortc {aiortc.__version__} 的 RTCRtpSender 没有 _send_keyframe，共享编码已停用，改为每个观众单独编码")
+        return None
+    try:
+        description = SessionDescription.parse(offer_sdp)
+    except ValueError:
+        return None
+    offered = [codec.mimeType.lower() for media in description.media if media.kind == "video"
+               for codec in media.rtp.codecs]
+    codec = next((c for c in offered if c in [m.lower() for m in FANOUT_CODECS]), None)
+    if codec is None:
+        return None
+    codec = next(m for m in FANOUT_CODECS if m.lower() == codec)
+    tiers = sorted(FANOUT_BITRATES)
+    if bitrate:
+        tier = max([b for b in tiers if b <= bitrate] or tiers[:1])
+    else:
+        tier = FANOUT_BITRATES[0]
+    return codec, tier
+
+
+def codec_preferences(codec):
+    """setCodecPreferences 用：只保留该 codec（及对应的 RTX），使协商结果与共享编码一致"""
+    return [c for c in RTCRtpSender.getCapabilities("video").codecs
+            if c.mimeType.lower() in (codec.lower(), "video/rtx")]
+
+
+def _open_codec(codec, bitrate, width, height):
+    """创建编码器，参数与 aiortc 对应编码器一致（实时、低延迟）"""
+    if codec == "video/VP8":
+        context = av.CodecContext.create("libvpx", "w")
+        context.gop_size = 3000
+        context.qmin = 2
+        context.qmax = 56
+        context.options = {
+            "bufsize": str(bitrate), "cpu-used": "-6", "deadline": "realtime", "lag-in-frames": "0",
+            "minrate": str(bitrate), "maxrate": str(bitrate), "noise-sensitivity": "4", "overshoot-pct": "15",
+            "partitions": "0", "static-thresh": "1", "undershoot-pct": "100",
+        }
+    else:
+        context = av.CodecContext.create("libx264", "w")
+        context.profile = "Baseline"
+        context.options = {"level": "31", "tune": "zerolatency"}
+    context.width = width
+    context.height = height
+    context.bit_rate = bitrate
+    context.pix_fmt = "yuv420p"
+    context.framerate = Fraction(30, 1)
+    context.time_base = VIDEO_TIME_BASE
+    return context
+
+
+def _encode(profile, frame, pts, keyframe):
+    """编码一帧（在线程池中执行），返回 av.Packet 列表。中继帧由所有订阅者共享，编码用的是副本"""
+    width, height = frame.width - frame.width % 2, frame.height - frame.height % 2
+    if frame.format.name == "yuv420p" and (frame.width, frame.height) == (width, height):
+        frame = recorder.copy_frame(frame)
+    else:
+        frame = frame.reformat(width=width, height=height, format="yuv420p")
+    context = profile["context"]
+    if context is None or (context.width, context.height) != (width, height):
+        context = profile["context"] = _open_codec(profile["codec"], profile["bitrate"], width, height)
+        keyframe = True
+    frame.pts = pts
+    frame.time_base = VIDEO_TIME_BASE
+    frame.pict_type = PictureType.I if keyframe else PictureType.NONE
+    return context.encode(frame)
+
+
+class PacketTrack(MediaStreamTrack):
+    """一个观众的共享编码视频轨：recv 返回已编码的 av.Packet，从关键帧开始"""
+
+    kind = "video"
+
+    def __init__(self, profile):
+        super().__init__()
+        self._profile = profile
+        self._queue = asyncio.Queue()
+        self._waiting_keyframe = True
+
+    def push(self, packet):
+        """事件循环线程中调用。None 表示编码结束"""
+        if packet is None:
+            self._queue.put_nowait(None)
+            return
+        if self._waiting_keyframe:
+            if not packet.is_keyframe:
+                return
+            self._waiting_keyframe = False
+        if self._queue.qsize() >= FANOUT_QUEUE_SIZE and not packet.is_keyframe:
+            # 消费过慢：丢弃积压，等下一个关键帧
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._profile["dropped"] += 1
+            self._waiting_keyframe = True
+            request_keyframe(self._profile)
+            return
+        self._queue.put_nowait(packet)
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        packet = await self._queue.get()
+        if packet is None:
+            self.stop()
+            raise MediaStreamError
+        return packet
+
+    def stop(self):
+        super().stop()
+        _unsubscribe(self._profile, self)
+
+
+def request_keyframe(profile):
+    """请求下一帧编码为关键帧（不早于上一个关键帧后 FANOUT_KEYFRAME_MIN_INTERVAL 秒）"""
+    profile["keyframe"] = True
+
+
+def subscribe(stream, source, profile_key):
+    """为一个观众订阅 stream（webrtc_server 的发布流）的视频源轨 source，返回 PacketTrack。
+    该配置还没有编码任务时订阅中继并启动"""
+    profiles = stream.setdefault("fanout", {})
+    profile = profiles.get(profile_key)
+    if profile is None:
+        codec, bitrate = profile_key
+        profile = profiles[profile_key] = {
+            "codec": codec, "bitrate": bitrate, "sinks": set(), "context": None, "keyframe": True,
+            "last_keyframe": None, "frames": 0, "keyframes": 0, "dropped": 0, "profiles": profiles,
+            "source": stream["relay"].subscribe(source, buffered=False),
+        }
+        profile["task"] = asyncio.ensure_future(_encode_loop(profile))
+    track = PacketTrack(profile)
+    profile["sinks"].add(track)
+    request_keyframe(profile)
+    return track
+
+
+def attach(sender, track):
+    """把观众发送端收到的 PLI / FIR 转为共享编码的关键帧请求（aiortc 只对自己编码的帧处理该请求）"""
+    if not callable(getattr(sender, "_send_keyframe", None)):
+        raise RuntimeError(f"aiortc {aiortc.__version__} RTCRtpSender has no _send_keyframe")
+    sender._send_keyframe = lambda: request_keyframe(track._profile)
+
+
+def _unsubscribe(profile, track):
+    profile["sinks"].discard(track)
+    if not profile["sinks"]:
+        # 最后一个观众离开：停止编码并退订中继
+        if profile["profiles"].get((profile["codec"], profile["bitrate"])) is profile:
+            del profile["profiles"][(profile["codec"], profile["bitrate"])]
+        profile["source"].stop()
+        # 编码任务可能正等在中继上（退订后不会再被唤醒），直接取消
+        profile["task"].cancel()
+
+
+async def _encode_loop(profile):
+    """编码任务：从中继取帧，编码一次后分发给该配置的全部观众；源轨结束或没有观众时退出"""
+    loop = asyncio.get_running_loop()
+    started = None
+    last_pts = -1
+    try:
+        while profile["sinks"]:
+            try:
+                frame = await profile["source"].recv()
+            except MediaStreamError:
+                break
+            # 按帧到达事件循环的时间打时间戳（中继帧的 pts 可能被其他订阅者改写）
+            now = time.monotonic()
+            started = now if started is None else started
+            pts = int((now - started) / VIDEO_TIME_BASE)
+            if pts <= last_pts:
+                continue
+            last_pts = pts
+            keyframe = profile["keyframe"] and (
+                profile["last_keyframe"] is None or now - profile["last_keyframe"] >= FANOUT_KEYFRAME_MIN_INTERVAL)
+            if keyframe:
+                profile["keyframe"] = False
+            packets = await loop.run_in_executor(None, _encode, profile, frame, pts, keyframe)
+            profile["frames"] += 1
+            for packet in packets:
+                if packet.is_keyframe:
+                    profile["last_keyframe"] = now
+                    profile["keyframes"] += 1
+                for sink in list(profile["sinks"]):
+                    sink.push(packet)
+    except Exception as e:
+        print(f"[FANOUT] {profile['codec']}@{profile['bitrate']} 编码失败: {e}")
+    finally:
+        profile["source"].stop()
+        for sink in list(profile["sinks"]):
+            sink.push(None)
+
+
+def status(stream):
+    """发布流的共享编码配置：[{"codec", "bitrate", "viewers", "frames", "keyframes", "dropped"}]"""
+    return [
+        {"codec": p["codec"], "bitrate": p["bitrate"], "viewers": len(p["sinks"]), "frames": p["frames"],
+         "keyframes": p["keyframes"], "dropped": p["dropped"]}
+        for p in stream.get("fanout", {}).values()
+    ]
@@ -0,0 +1,390 @@
+"""
+后台处理任务
+------------
+新视频入库时由触发器写入 jobs 表，独立的工作进程池从表中领取任务：
+探测时长、编码与分辨率并写回 videos 表；MP4 兼容的编码重新封装为 faststart MP4（moov 前置，可边下边播），
+浏览器无法播放的编码（如 AVI 里的 MPEG-4 Part 2）转码为 H.264 / AAC。
+
+用法: python jobs.py <命令> [参数...]
+"""
+
+import os
+import sys
+import time
+import socket
+import struct
+import sqlite3
+import threading
+import contextlib
+from multiprocessing import Process
+
+import av
+
+import db_manage
+import database
+
+# 工作进程数、空闲时轮询间隔（秒）、单个任务最多尝试次数
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_POLL_INTERVAL = 1.0
+JOB_MAX_ATTEMPTS = 3
+# 运行中的任务超过该秒数没有心跳（工作进程崩溃）则重新领取；执行期间每 JOB_HEARTBEAT_INTERVAL 秒刷新心跳
+JOB_STALE_AFTER = 120
+JOB_HEARTBEAT_INTERVAL = 5
+# 是否对浏览器无法播放的编码转码（0 则只探测 / 重新封装）
+JOB_TRANSCODE = os.environ.get("JOB_TRANSCODE", "1") != "0"
+
+# 可以直接放进 MP4 并被主流浏览器播放的编码
+MP4_VIDEO_CODECS = {"h264", "hevc", "av1", "vp9"}
+MP4_AUDIO_CODECS = {"aac", "mp3"}
+# WebM 本身浏览器可播放，只探测不处理
+WEBM_VIDEO_CODECS = {"vp8", "vp9", "av1"}
+WEBM_AUDIO_CODECS = {"opus", "vorbis"}
+
+STATUSES = ("queued", "running", "done", "failed")
+
+
+class SkipJob(Exception):
+    """视频记录或文件已不存在，任务直接失败，不再重试"""
+
+
+def connect(db_path=None):
+    return database.connect(db_path or db_manage.DB_PATH, autocommit=True)
+
+
+def is_faststart(path):
+    """MP4 的 moov 是否位于 mdat 之前（逐个读取顶层 box 头）"""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, kind = struct.unpack(">I4s", header)
+            if kind == b"moov":
+                return True
+            if kind == b"mdat":
+                return False
+            if size == 1:
+                size = struct.unpack(">Q", f.read(8))[0] - 8
+            elif size == 0:
+                return False
+            f.seek(size - 8, os.SEEK_CUR)
+
+
+def probe(path):
+    """探测容器与音视频流信息"""
+    with av.open(path) as container:
+        video = container.streams.video[0] if container.streams.video else None
+        audio = container.streams.audio[0] if container.streams.audio else None
+        return {
+            "format": container.format.name,
+            "duration": container.duration / av.time_base if container.duration else None,
+            "video_codec": video.codec_context.name if video else None,
+            "audio_codec": audio.codec_context.name if audio else None,
+            "width": video.codec_context.width if video else None,
+            "height": video.codec_context.height if video else None,
+        }
+
+
+def plan(path, info):
+    """决定处理方式：probe（仅探测）/ remux（重新封装）/ transcode（转码）"""
+    ext = os.path.splitext(path)[1].lower()
+    if info["video_codec"] is None:
+        return "probe"
+    if ext == ".webm" and info["video_codec"] in WEBM_VIDEO_CODECS \
+            and info["audio_codec"] in WEBM_AUDIO_CODECS | {None}:
+        return "probe"
+    if info["video_codec"] in MP4_VIDEO_CODECS and info["audio_codec"] in MP4_AUDIO_CODECS | {None}:
+        if ext == ".mp4" and is_faststart(path):
+            return "probe"
+        return "remux"
+    return "transcode" if JOB_TRANSCODE else "probe"
+
+
+def convert(src, dst, info, progress=None):
+    """写出 faststart MP4：兼容的流直接复制，其余转码为 H.264 / AAC"""
+    duration = info["duration"] or 0
+    last_report = time.monotonic()
+    with av.open(src) as inp, av.open(dst, "w", format="mp4", options={"movflags": "+faststart"}) as out:
+        mapping = {}
+        for stream in inp.streams.video[:1] + inp.streams.audio[:1]:
+            copy = stream.codec_context.name in (MP4_VIDEO_CODECS if stream.type == "video" else MP4_AUDIO_CODECS)
+            if copy:
+                ostream = out.add_stream_from_template(stream)
+            elif stream.type == "video":
+                ostream = out.add_stream("libx264", rate=stream.average_rate or 25,
+                                         options={"preset": "veryfast", "crf": "23"})
+                # yuv420p 要求宽高为偶数
+                ostream.width = stream.codec_context.width // 2 * 2
+                ostream.height = stream.codec_context.height // 2 * 2
+                ostream.pix_fmt = "yuv420p"
+            else:
+                ostream = out.add_stream("aac", rate=stream.codec_context.sample_rate or 44100)
+            mapping[stream.index] = (ostream, copy)
+
+        for packet in inp.demux(*[inp.streams[i] for i in mapping]):
+            ostream, copy = mapping[packet.stream.index]
+            if copy:
+                # demux 结束时的空包没有时间戳，不能写入
+                if packet.dts is not None:
+                    packet.stream = ostream
+                    out.mux(packet)
+            else:
+                for frame in packet.decode():
+                    if ostream.type == "video":
+                        frame = frame.reformat(ostream.width, ostream.height, "yuv420p")
+                    out.mux(ostream.encode(frame))
+            if progress and duration and packet.pts is not None \
+                    and time.monotonic() - last_report >= JOB_HEARTBEAT_INTERVAL:
+                last_report = time.monotonic()
+                progress(min(0.99, float(packet.pts * packet.time_base) / duration))
+
+        for ostream, copy in mapping.values():
+            if not copy:
+                out.mux(ostream.encode(None))
+
+
+def output_path(src):
+    """处理结果的最终路径：.mp4 原地替换，其他格式改为同名 .mp4（重名时追加序号）"""
+    stem, ext = os.path.splitext(src)
+    if ext.lower() == ".mp4":
+        return src
+    candidate, n = stem + ".mp4", 0
+    while True:
+        try:
+            os.close(os.open(candidate, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return candidate
+        except FileExistsError:
+            n += 1
+            candidate = f"{stem}_{n}.mp4"
+
+
+def process_video(db, upload_root, job):
+    """执行一个任务，返回 (action, 文件名)"""
+    video = db.execute('SELECT ip, filename FROM videos WHERE id = ?', (job['video_id'],)).fetchone()
+    if video is None:
+        raise SkipJob("video record not found")
+    src = os.path.join(upload_root, video['ip'], video['filename'])
+    if not os.path.isfile(src):
+        raise SkipJob("video file not found")
+
+    def report(progress):
+        db.execute('UPDATE jobs SET progress = ? WHERE id = ?', (progress, job['id']))
+
+    info = probe(src)
+    action = plan(src, info)
+    filename = video['filename']
+    if action != "probe":
+        tmp = src + ".part"
+        try:
+            convert(src, tmp, info, report)
+            dst = output_path(src)
+            os.replace(tmp, dst)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        filename = os.path.basename(dst)
+        info = probe(dst)
+
+    path = os.path.join(upload_root, video['ip'], filename)
+    # sha256 保持为上传时的内容哈希，供重试去重使用
+    cur = db.execute('''
+        UPDATE videos SET filename = ?, file_size = ?, duration = ?, video_codec = ?, audio_codec = ?,
+            width = ?, height = ?, faststart = ?, processed_at = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', (filename, os.path.getsize(path), info["duration"], info["video_codec"], info["audio_codec"],
+          info["width"], info["height"], int(filename.lower().endswith(".mp4") and is_faststart(path)),
+          job['video_id']))
+    if cur.rowcount == 0:
+        # 处理期间视频被删除
+        if path != src:
+            os.remove(path)
+        raise SkipJob("video deleted during processing")
+    if path != src:
+        os.remove(src)
+    return action, filename
+
+
+@contextlib.contextmanager
+def heartbeat(db, job_id):
+    """任务执行期间由后台线程按墙钟每 JOB_HEARTBEAT_INTERVAL 秒刷新心跳。
+    只探测的任务、没有时长的输入和耗时的探测都不会触发 convert 的进度回调，不能靠它维持心跳"""
+    path = db.execute('PRAGMA database_list').fetchone()['file']
+    stop = threading.Event()
+
+    def beat():
+        # sqlite 连接不能跨线程使用，心跳线程单独连接
+        conn = connect(path)
+        try:
+            while not stop.wait(JOB_HEARTBEAT_INTERVAL):
+                try:
+                    conn.execute("UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'running'",
+                                 (job_id,))
+                except sqlite3.OperationalError as e:
+                    print(f"[JOB] #{job_id} 心跳失败: {e}")
+        finally:
+            conn.close()
+
+    thread = threading.Thread(target=beat, name=f"job-heartbeat-{job_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def claim(db, worker):
+    """领取一个排队中（或心跳超时）的任务，没有时返回 None"""
+    with database.transaction(db):
+        return db.execute('''
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, progress = 0, error = NULL,
+                started_at = CURRENT_TIMESTAMP, heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE status = 'queued' OR (status = 'running' AND heartbeat_at < datetime('now', ?))
+                ORDER BY id LIMIT 1
+            )
+            RETURNING id, video_id, attempts
+        ''', (worker, f'-{JOB_STALE_AFTER} seconds')).fetchone()
+
+
+def finish(db, job_id, status, action=None, error=None):
+    db.execute('''
+        UPDATE jobs SET status = ?, action = COALESCE(?, action), error = ?,
+            progress = CASE WHEN ? = 'done' THEN 1 ELSE progress END,
+            finished_at = CASE WHEN ? = 'queued' THEN NULL ELSE CURRENT_TIMESTAMP END
+        WHERE id = ?
+    ''', (status, action, error, status, status, job_id))
+
+
+def run_job(db, upload_root, job):
+    if job['attempts'] > JOB_MAX_ATTEMPTS:
+        finish(db, job['id'], "failed", error="too many attempts")
+        return
+    start = time.time()
+    try:
+        with heartbeat(db, job['id']):
+            action, filename = process_video(db, upload_root, job)
+    except SkipJob as e:
+        finish(db, job['id'], "failed", error=str(e))
+        return
+    except av.error.InvalidDataError as e:
+        # 文件本身损坏，重试无意义
+        finish(db, job['id'], "failed", error=f"invalid video: {e}")
+        return
+    except Exception as e:
+        # 未到最大次数时重新排队
+        status = "queued" if job['attempts'] < JOB_MAX_ATTEMPTS else "failed"
+        finish(db, job['id'], status, error=f"{type(e).__name__}: {e}")
+        print(f"[JOB] #{job['id']} 处理失败 ({job['attempts']}/{JOB_MAX_ATTEMPTS}): {e}")
+        return
+    finish(db, job['id'], "done", action=action)
+    print(f"[JOB] #{job['id']} {action} {filename} ({time.time() - start:.1f}s)")
+
+
+def run_pending(db_path=None, upload_root=None):
+    """在当前进程中处理完队列中的所有任务，返回处理数量"""
+    db = connect(db_path)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    count = 0
+    try:
+        while True:
+            job = claim(db, worker)
+            if job is None:
+                return count
+            run_job(db, upload_root or db_manage.UPLOAD_ROOT, job)
+            count += 1
+    finally:
+        db.close()
+
+
+def worker_loop(db_path, upload_root):
+    """工作进程主循环：领取任务，空闲时轮询"""
+    db = connect(db_path)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        try:
+            job = claim(db, worker)
+        except sqlite3.OperationalError as e:
+            print(f"[JOB] 领取任务失败: {e}")
+            job = None
+        if job is None:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+        try:
+            run_job(db, upload_root, job)
+        except sqlite3.Error as e:
+            # 结果写不进数据库时任务保持 running，心跳超时后会被重新领取
+            print(f"[JOB] #{job['id']} 更新状态失败: {e}")
+
+
+def start_workers(db_path=None, upload_root=None, workers=None):
+    """启动后台工作进程池（守护进程，随主进程退出），返回进程列表"""
+    processes = []
+    for _ in range(JOB_WORKERS if workers is None else workers):
+        p = Process(target=worker_loop, args=(db_path or db_manage.DB_PATH, upload_root or db_manage.UPLOAD_ROOT),
+                    daemon=True)
+        p.start()
+        processes.append(p)
+    return processes
+
+
+def enqueue_unprocessed(db_path=None):
+    """为尚未处理且没有待办任务的视频补建任务（触发器建立之前入库的旧视频），返回数量"""
+    db = connect(db_path)
+    try:
+        cur = db.execute('''
+            INSERT INTO jobs (video_id)
+            SELECT v.id FROM videos v
+            WHERE v.processed_at IS NULL
+              AND NOT EXISTS (SELECT 1 FROM jobs j WHERE j.video_id = v.id AND j.status IN ('queued', 'running'))
+        ''')
+        return cur.rowcount
+    finally:
+        db.close()
+
+
+def show_jobs():
+    db = connect()
+    print("\n📋 任务统计:")
+    for row in db.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status'):
+        print(f"  {row['status']:<8} {row['n']}")
+    print("\n❌ 最近失败:")
+    for row in db.execute('''
+        SELECT j.id, v.ip, v.filename, j.error FROM jobs j LEFT JOIN videos v ON v.id = j.video_id
+        WHERE j.status = 'failed' ORDER BY j.id DESC LIMIT 10
+    '''):
+        print(f"  #{row['id']} {row['ip']}/{row['filename']}: {row['error']}")
+    db.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("""
+后台处理任务
+------------
+用法: python jobs.py <命令> [参数...]
+
+命令:
+  status       - 显示任务统计与最近失败
+  enqueue      - 为尚未处理的旧视频补建任务
+  run          - 在当前进程中处理完队列后退出
+  worker [N]   - 启动 N 个工作进程持续处理（默认 JOB_WORKERS）
+        """)
+        sys.exit(1)
+
+    command = sys.argv[1]
+
+    if command == "status":
+        show_jobs()
+    elif command == "enqueue":
+        print(f"✅ 新建任务: {enqueue_unprocessed()}")
+    elif command == "run":
+        print(f"✅ 处理任务: {run_pending()}")
+    elif command == "worker":
+        processes = start_workers(workers=int(sys.argv[2]) if len(sys.argv) > 2 else None)
+        print(f"✅ 已启动 {len(processes)} 个工作进程")
+        for p in processes:
+            p.join()
+    else:
+        print(f"未知命令: {command}")
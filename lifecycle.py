@@ -0,0 +1,167 @@
+"""
+WebRTC 连接生命周期管理
+----------------------
+webrtc_server 的 PeerConnection 只在收到 "closed" 状态时移出注册表：对端直接消失、ICE 一直没有完成、
+或媒体早已停止的连接会一直占着内存与 UDP 端口。本模块登记每个连接，后台定期检查并关闭：
+
+- 协商超时：创建后 WEBRTC_NEGOTIATION_TIMEOUT 秒仍未连接（观众拿到 Answer 后没有发起 ICE 等）
+- 失败：连接状态为 failed 的立即关闭（aiortc 中 failed 不会恢复）
+- 断开：已连接，但 WEBRTC_DISCONNECT_GRACE 秒内没有收到对端任何数据包（aiortc 没有 disconnected 状态，
+  对端消失时只是不再收到包；正常的观众至少会定期回 RTCP 接收报告）
+- 空闲：已连接，但 WEBRTC_IDLE_TIMEOUT 秒内没有媒体（发布者没有上行 RTP、观众没有下行 RTP）
+
+另外限制每个来源 IP 与整个进程的连接数：超出每 IP 上限返回 429，超出总数返回 503。
+来源 IP 只在请求来自受信任的代理时才取 X-Forwarded-For（见 webrtc_server._client_ip）。
+活动情况来自 getStats()：transport 的 packetsReceived（对端发来的全部包）与
+inbound-rtp / outbound-rtp 的包数（媒体）；qos 在一个检查间隔内采过样时直接复用其最近的样本。
+"""
+
+import os
+import time
+import asyncio
+from collections import Counter
+
+import qos
+
+# 未连接的最长时间、已连接但收不到对端数据包的最长时间、没有媒体的最长时间（秒）
+WEBRTC_NEGOTIATION_TIMEOUT = float(os.environ.get("WEBRTC_NEGOTIATION_TIMEOUT", 30))
+WEBRTC_DISCONNECT_GRACE = float(os.environ.get("WEBRTC_DISCONNECT_GRACE", 15))
+WEBRTC_IDLE_TIMEOUT = float(os.environ.get("WEBRTC_IDLE_TIMEOUT", 120))
+# 连接数上限：整个进程、每个来源 IP（0 不限制）
+WEBRTC_MAX_CONNECTIONS = int(os.environ.get("WEBRTC_MAX_CONNECTIONS", 1000))
+WEBRTC_MAX_PER_IP = int(os.environ.get("WEBRTC_MAX_PER_IP", 50))
+# 检查间隔（秒）
+LIFECYCLE_INTERVAL = float(os.environ.get("LIFECYCLE_INTERVAL", 5))
+
+# {pc_id: {"pc", "type", "ip", "created_at", "state", "state_at", "connected_at",
+#          "rx_packets", "rx_at", "media_packets", "media_at"}}，时间均为 time.monotonic()
+connections = {}
+_per_ip = Counter()
+reaped = {"negotiation": 0, "failed": 0, "disconnected": 0, "idle": 0}
+rejected = {"per_ip": 0, "global": 0}
+
+
+def admit(ip):
+    """是否还能为 ip 新建连接：可以时返回 None，否则返回 (HTTP 状态码, 错误 JSON)"""
+    if WEBRTC_MAX_PER_IP and _per_ip[ip] >= WEBRTC_MAX_PER_IP:
+        rejected["per_ip"] += 1
+        return 429, {"error": "too many connections from this address", "limit": WEBRTC_MAX_PER_IP}
+    if WEBRTC_MAX_CONNECTIONS and len(connections) >= WEBRTC_MAX_CONNECTIONS:
+        rejected["global"] += 1
+        return 503, {"error": "server at connection capacity", "limit": WEBRTC_MAX_CONNECTIONS}
+    return None
+
+
+def track(pc_id, pc, conn_type, ip):
+    """登记新建的连接"""
+    now = time.monotonic()
+    connections[pc_id] = {
+        "pc": pc, "type": conn_type, "ip": ip, "created_at": now, "state": pc.connectionState, "state_at": now,
+        "connected_at": None, "rx_packets": 0, "rx_at": now, "media_packets": 0, "media_at": now,
+    }
+    _per_ip[ip] += 1
+
+
+def state_changed(pc_id, state):
+    conn = connections.get(pc_id)
+    if conn is None:
+        return
+    now = time.monotonic()
+    conn["state"], conn["state_at"] = state, now
+    if state == "failed":
+        # webrtc_server 收到 failed 后立即关闭，关闭时计入 reaped
+        conn.setdefault("reason", "failed")
+    if state == "connected" and conn["connected_at"] is None:
+        # 从连上时开始计算断开 / 空闲
+        conn["connected_at"] = conn["rx_at"] = conn["media_at"] = now
+
+
+def forget(pc_id):
+    """连接已关闭，移出登记；由生命周期管理关闭的按原因计入 reaped（每个连接只计一次）"""
+    conn = connections.pop(pc_id, None)
+    if conn is not None:
+        if "reason" in conn:
+            reaped[conn["reason"]] += 1
+        _per_ip[conn["ip"]] -= 1
+        if _per_ip[conn["ip"]] <= 0:
+            del _per_ip[conn["ip"]]
+
+
+async def _activity(pc_id, conn):
+    """(对端发来的包数, 媒体包数)：发布者数收到的 RTP，观众数发出的 RTP"""
+    sample = qos.latest(pc_id, LIFECYCLE_INTERVAL)
+    if sample is not None:
+        return sample[qos.RX_PACKETS], sample[qos.MEDIA_PACKETS]
+    report = await conn["pc"].getStats()
+    rx = media = 0
+    for stats in report.values():
+        if stats.type == "transport":
+            rx += stats.packetsReceived
+        elif stats.type == "inbound-rtp" and conn["type"] == "publisher":
+            media += stats.packetsReceived
+        elif stats.type == "outbound-rtp" and conn["type"] != "publisher":
+            media += stats.packetsSent
+    return rx, media
+
+
+async def _reason(pc_id, conn, now):
+    """该连接应被关闭的原因，没有时返回 None"""
+    if conn["state"] == "failed":
+        return "failed"
+    if conn["connected_at"] is None:
+        return "negotiation" if now - conn["created_at"] >= WEBRTC_NEGOTIATION_TIMEOUT else None
+    if conn["state"] != "connected":
+        return None
+    rx, media = await _activity(pc_id, conn)
+    if rx != conn["rx_packets"]:
+        conn["rx_packets"], conn["rx_at"] = rx, now
+    if media != conn["media_packets"]:
+        conn["media_packets"], conn["media_at"] = media, now
+    if WEBRTC_DISCONNECT_GRACE and now - conn["rx_at"] >= WEBRTC_DISCONNECT_GRACE:
+        return "disconnected"
+    if WEBRTC_IDLE_TIMEOUT and now - conn["media_at"] >= WEBRTC_IDLE_TIMEOUT:
+        return "idle"
+    return None
+
+
+async def sweep(close):
+    """检查一轮，对应关闭的连接调用 close(pc_id, reason)（协程），返回 [(pc_id, reason)]"""
+    now = time.monotonic()
+    closed = []
+    for pc_id, conn in list(connections.items()):
+        try:
+            reason = await _reason(pc_id, conn, now)
+        except Exception as e:
+            print(f"[LIFECYCLE] PC#{pc_id[:8]} 检查失败: {e!r}")
+            continue
+        if reason is not None:
+            conn.setdefault("reason", reason)
+            closed.append((pc_id, reason))
+    if closed:
+        await asyncio.gather(*(close(pc_id, reason) for pc_id, reason in closed), return_exceptions=True)
+    return closed
+
+
+async def run(close):
+    """后台任务：每 LIFECYCLE_INTERVAL 秒检查一次"""
+    while True:
+        await asyncio.sleep(LIFECYCLE_INTERVAL)
+        try:
+            await sweep(close)
+        except Exception as e:
+            print(f"[LIFECYCLE] 检查失败: {e!r}")
+
+
+def counts(top=10):
+    """当前连接数：总数、按类型 / 状态、连接最多的来源 IP，上限与累计关闭 / 拒绝数"""
+    return {
+        "total": len(connections),
+        "by_type": dict(Counter(conn["type"] for conn in connections.values())),
+        "by_state": dict(Counter(conn["state"] for conn in connections.values())),
+        "top_ips": _per_ip.most_common(top),
+        "limits": {"max_connections": WEBRTC_MAX_CONNECTIONS, "max_per_ip": WEBRTC_MAX_PER_IP,
+                   "negotiation_timeout": WEBRTC_NEGOTIATION_TIMEOUT, "disconnect_grace": WEBRTC_DISCONNECT_GRACE,
+                   "idle_timeout": WEBRTC_IDLE_TIMEOUT},
+        "reaped": dict(reaped),
+        "rejected": dict(rejected),
+    }
@@ -0,0 +1,180 @@
+"""
+在线状态索引
+------------
+按 IP 记录最近心跳时间，过期时间放在最小堆中：心跳 O(log n) 入堆，到期检查只看堆顶，
+不再扫描全部客户端。上线 / 下线变化推送给订阅者（仪表盘的 SSE 连接）。
+
+多进程部署时每个进程各有一份索引：本进程收到的心跳立即生效，
+其他进程的心跳通过 sync_from_db() 从 folders.updated_at 同步。
+"""
+
+import os
+import json
+import time
+import heapq
+import queue
+import calendar
+import threading
+
+# 在线判定窗口（秒）：最近一次心跳在此时间内视为在线
+ONLINE_WINDOW = int(os.environ.get("ONLINE_WINDOW", 5 * 60))
+# 到期检查间隔（秒）、每个进程最多同时保持的推送连接数、每个订阅者最多积压的事件数
+EXPIRE_INTERVAL = 1
+PRESENCE_MAX_STREAMS = int(os.environ.get("PRESENCE_MAX_STREAMS", 8))
+SUBSCRIBER_QUEUE_SIZE = 1000
+# 从数据库同步时回看的秒数：其他进程的心跳最多晚 HEARTBEAT_FLUSH_INTERVAL 秒写入（写锁等待时更久），
+# 写入的 updated_at 是收到心跳的时间，可能早于上次同步到的位置
+SYNC_OVERLAP = 60
+
+_lock = threading.Lock()
+_last_seen = {}     # ip -> 最近心跳时间（epoch 秒）
+_heap = []          # (到期时间, ip)，同一 IP 可能有多条，出堆时与 _last_seen 核对
+_online = set()
+_subscribers = set()
+_synced_until = ""  # 已从数据库同步到的 updated_at
+_started = False
+
+
+def _publish(ip, online, last_seen):
+    """调用方需持有 _lock"""
+    event = {"ip": ip, "online": online, "last_seen": format_time(last_seen)}
+    for q in list(_subscribers):
+        try:
+            q.put_nowait(event)
+        except queue.Full:
+            # 消费太慢的订阅者直接断开，浏览器重连后会收到新的快照
+            _subscribers.discard(q)
+            with q.mutex:
+                q.queue.clear()
+            q.put_nowait(None)
+
+
+def format_time(ts):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts)) if ts else None
+
+
+def parse_time(text):
+    return calendar.timegm(time.strptime(text, "%Y-%m-%d %H:%M:%S"))
+
+
+def seen(ip, ts=None):
+    """记录一次心跳（ts 为 epoch 秒，默认当前时间）；比已知时间旧的忽略"""
+    ts = time.time() if ts is None else ts
+    with _lock:
+        if ts <= _last_seen.get(ip, 0):
+            return
+        _last_seen[ip] = ts
+        heapq.heappush(_heap, (ts + ONLINE_WINDOW, ip))
+        if ip not in _online and ts + ONLINE_WINDOW > time.time():
+            _online.add(ip)
+            _publish(ip, True, ts)
+
+
+def expire(now=None):
+    """处理所有已到期的条目，返回本次下线的 IP 列表"""
+    now = time.time() if now is None else now
+    gone = []
+    with _lock:
+        while _heap and _heap[0][0] <= now:
+            deadline, ip = heapq.heappop(_heap)
+            # 之后又有心跳的旧条目直接丢弃
+            if _last_seen.get(ip, 0) + ONLINE_WINDOW > deadline:
+                continue
+            if ip in _online:
+                _online.discard(ip)
+                gone.append(ip)
+                _publish(ip, False, _last_seen[ip])
+    return gone
+
+
+def forget(ip):
+    """删除文件夹时移除（堆中残留条目出堆时会被忽略）"""
+    with _lock:
+        _last_seen.pop(ip, None)
+        if ip in _online:
+            _online.discard(ip)
+            _publish(ip, False, None)
+
+
+def is_online(ip):
+    with _lock:
+        return ip in _online
+
+
+def online_ips():
+    with _lock:
+        return sorted(_online)
+
+
+def started():
+    return _started
+
+
+def sync_from_db(db):
+    """从 folders.updated_at 同步其他进程写入的心跳（只读上次同步位置 SYNC_OVERLAP 秒之前起的行，
+    晚写入的旧心跳也能读到；已知的心跳由 seen() 忽略）"""
+    global _synced_until
+    since = time.time() - ONLINE_WINDOW
+    if _synced_until:
+        since = max(since, parse_time(_synced_until) - SYNC_OVERLAP)
+    since = format_time(since)
+    rows = db.execute(
+        'SELECT ip, updated_at FROM folders WHERE updated_at >= ? ORDER BY updated_at', (since,)
+    ).fetchall()
+    for ip, updated_at in rows:
+        try:
+            seen(ip, parse_time(updated_at))
+        except (TypeError, ValueError):
+            continue
+    if rows and rows[-1][1] > _synced_until:
+        _synced_until = rows[-1][1]
+
+
+def start(db):
+    """启动到期检查线程。db 用于启动时加载窗口内已在线的客户端"""
+    global _started
+    sync_from_db(db)
+
+    def loop():
+        while True:
+            time.sleep(EXPIRE_INTERVAL)
+            try:
+                expire()
+            except Exception as e:
+                print(f"[PRESENCE] 到期检查失败: {e}")
+
+    threading.Thread(target=loop, name="presence-expire", daemon=True).start()
+    _started = True
+
+
+def subscribe():
+    """注册一个订阅者，返回事件队列；超过连接上限时返回 None"""
+    q = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    with _lock:
+        if len(_subscribers) >= PRESENCE_MAX_STREAMS:
+            return None
+        _subscribers.add(q)
+    return q
+
+
+def unsubscribe(q):
+    with _lock:
+        _subscribers.discard(q)
+
+
+def sse_stream(q, keepalive=15):
+    """把订阅队列转成 SSE 文本流：先发当前在线快照，之后逐条推送上线 / 下线"""
+    try:
+        yield f"retry: 3000\nevent: snapshot\ndata: {json.dumps({'online': online_ips(), 'window': ONLINE_WINDOW})}\n\n"
+        while True:
+            try:
+                event = q.get(timeout=keepalive)
+            except queue.Empty:
+                # 注释行保活，避免代理断开空闲连接
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                return
+            yield f"data: {json.dumps(event)}\n\n"
+    finally:
+        unsubscribe(q)
@@ -0,0 +1,186 @@
+"""
+后台清除已删除的文件夹
+----------------------
+删除文件夹时只把 uploads/<ip> 原子重命名到 uploads/.trash/，并在 folders 上标记 deleted_at（墓碑），
+请求立即返回。后台进程按限定的速率逐个删除回收站中的文件，同时分批删除对应的 videos 记录，
+进度记录在 purges 表中；全部删除后移除墓碑（folders 行）。
+
+清除完成之前，该 IP 的上传返回 409，文件夹不出现在列表中。
+"""
+
+import os
+import time
+import shutil
+import sqlite3
+from multiprocessing import Process
+
+import database
+
+TRASH_DIR = ".trash"
+# 每批删除的文件数（每批提交一次记录与进度）；删除速率上限：每秒文件数、每秒字节数
+PURGE_BATCH = 50
+PURGE_FILES_PER_SEC = int(os.environ.get("PURGE_FILES_PER_SEC", 200))
+PURGE_BYTES_PER_SEC = int(os.environ.get("PURGE_BYTES_PER_SEC", 1024 * 1024 * 1024))
+# 空闲时轮询间隔（秒）；失败的清除多久后重试（秒）
+PURGE_POLL_INTERVAL = 1.0
+PURGE_RETRY_AFTER = 60
+
+STATUSES = ("pending", "running", "done", "failed")
+
+
+def trash_root(upload_root):
+    return os.path.join(upload_root, TRASH_DIR)
+
+
+def create(db, upload_root, ip, folder):
+    """标记墓碑并把 folder 目录移入回收站，返回清除任务 id（已在清除中时返回已有的 id）。
+
+    在同一个写事务中完成：重命名失败时回滚，文件夹保持原样。
+    """
+    with database.transaction(db):
+        row = db.execute(
+            "SELECT id FROM purges WHERE ip = ? AND status != 'done' ORDER BY id DESC LIMIT 1", (ip,)
+        ).fetchone()
+        if row:
+            return row['id']
+        db.execute(
+            'INSERT INTO folders (ip, deleted_at) VALUES (?, CURRENT_TIMESTAMP) '
+            'ON CONFLICT(ip) DO UPDATE SET deleted_at = CURRENT_TIMESTAMP',
+            (ip,)
+        )
+        counts = db.execute('SELECT video_count, total_bytes FROM folders WHERE ip = ?', (ip,)).fetchone()
+        purge_id = db.execute(
+            'INSERT INTO purges (ip, files_total, bytes_total) VALUES (?, ?, ?) RETURNING id',
+            (ip, counts['video_count'], counts['total_bytes'])
+        ).fetchone()[0]
+        if os.path.isdir(folder):
+            trash = os.path.join(TRASH_DIR, f"{os.path.basename(folder)}.{purge_id}")
+            os.makedirs(trash_root(upload_root), exist_ok=True)
+            os.rename(folder, os.path.join(upload_root, trash))
+            db.execute('UPDATE purges SET trash_path = ? WHERE id = ?', (trash, purge_id))
+    return purge_id
+
+
+def is_deleted(db, ip):
+    """该 IP 是否正在清除（墓碑存在）"""
+    return db.execute('SELECT 1 FROM folders WHERE ip = ? AND deleted_at IS NOT NULL', (ip,)).fetchone() is not None
+
+
+def _throttle(started, files, size):
+    """按速率上限计算到目前为止至少应耗时多久，不足则等待"""
+    target = max(files / PURGE_FILES_PER_SEC if PURGE_FILES_PER_SEC else 0,
+                 size / PURGE_BYTES_PER_SEC if PURGE_BYTES_PER_SEC else 0)
+    delay = target - (time.monotonic() - started)
+    if delay > 0:
+        time.sleep(delay)
+
+
+def _commit_batch(db, purge_id, ip, batch):
+    with database.transaction(db):
+        db.executemany('DELETE FROM videos WHERE ip = ? AND filename = ?', [(ip, name) for name, _ in batch])
+        db.execute(
+            'UPDATE purges SET files_deleted = files_deleted + ?, bytes_deleted = bytes_deleted + ?, '
+            'updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (len(batch), sum(size for _, size in batch), purge_id)
+        )
+
+
+def run(db, upload_root, purge):
+    """执行（或从中断处继续）一个清除任务"""
+    purge_id, ip = purge['id'], purge['ip']
+    with database.transaction(db):
+        db.execute(
+            "UPDATE purges SET status = 'running', error = NULL, started_at = COALESCE(started_at, CURRENT_TIMESTAMP), "
+            "updated_at = CURRENT_TIMESTAMP WHERE id = ?", (purge_id,)
+        )
+
+    trash = os.path.join(upload_root, purge['trash_path']) if purge['trash_path'] else None
+    if trash and os.path.isdir(trash):
+        started = time.monotonic()
+        files = size = 0
+        batch = []
+        # 只遍历一次目录：已删除的条目不会再出现，无需每批重新扫描
+        with os.scandir(trash) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                    continue
+                entry_size = entry.stat(follow_symlinks=False).st_size
+                os.unlink(entry.path)
+                batch.append((entry.name, entry_size))
+                files += 1
+                size += entry_size
+                if len(batch) >= PURGE_BATCH:
+                    _commit_batch(db, purge_id, ip, batch)
+                    batch = []
+                    _throttle(started, files, size)
+        if batch:
+            _commit_batch(db, purge_id, ip, batch)
+        os.rmdir(trash)
+
+    # 没有对应文件的记录（文件早已丢失）分批删除
+    while True:
+        with database.transaction(db):
+            n = db.execute(
+                'DELETE FROM videos WHERE id IN (SELECT id FROM videos WHERE ip = ? LIMIT ?)', (ip, PURGE_BATCH)
+            ).rowcount
+        if n < PURGE_BATCH:
+            break
+
+    with database.transaction(db):
+        # 移除墓碑；期间有请求重新创建了空目录的一并删除
+        if db.execute('DELETE FROM folders WHERE ip = ? AND deleted_at IS NOT NULL', (ip,)).rowcount:
+            try:
+                os.rmdir(os.path.join(upload_root, ip.replace("/", "_")))
+            except OSError:
+                pass
+        db.execute(
+            "UPDATE purges SET status = 'done', updated_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP "
+            "WHERE id = ?", (purge_id,)
+        )
+
+
+def next_purge(db):
+    """下一个待执行的清除：未完成的，以及失败超过 PURGE_RETRY_AFTER 秒的"""
+    return db.execute(
+        "SELECT * FROM purges WHERE status IN ('pending', 'running') "
+        "OR (status = 'failed' AND updated_at < datetime('now', ?)) ORDER BY id LIMIT 1",
+        (f'-{PURGE_RETRY_AFTER} seconds',)
+    ).fetchone()
+
+
+def run_pending(db, upload_root):
+    """执行全部待清除的任务，返回执行的数量（失败的记录错误，稍后重试）"""
+    done = 0
+    while True:
+        purge = next_purge(db)
+        if purge is None:
+            return done
+        try:
+            run(db, upload_root, purge)
+            done += 1
+        except OSError as e:
+            print(f"[PURGE] #{purge['id']} {purge['ip']} 清除失败: {e}")
+            with database.transaction(db):
+                db.execute(
+                    "UPDATE purges SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (str(e), purge['id'])
+                )
+
+
+def loop(db_path, upload_root):
+    """后台进程主循环"""
+    db = database.connect(db_path)
+    while True:
+        try:
+            run_pending(db, upload_root)
+        except sqlite3.Error as e:
+            print(f"[PURGE] 更新数据库失败: {e}")
+        time.sleep(PURGE_POLL_INTERVAL)
+
+
+def start(db_path, upload_root):
+    """启动后台清除进程（守护进程，随主进程退出）"""
+    p = Process(target=loop, args=(db_path, upload_root), name="purge", daemon=True)
+    p.start()
+    return p
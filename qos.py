@@ -0,0 +1,217 @@
+"""
+WebRTC 连接质量统计（QoS）
+------------------------
+后台任务每 WEBRTC_STATS_INTERVAL 秒对每个已连接的 PeerConnection 采样一次 getStats()，
+每个连接保留最近 WEBRTC_STATS_SAMPLES 个样本（环形缓冲，连接关闭时丢弃）。样本只记累计计数，
+码率、帧率、丢包率由相邻 / 首尾样本相减得出：
+
+- 码率：transport 收发的字节数
+- 帧率：登记了计帧轨（meter）的连接按取走的帧数计算——观众为发出的视频帧，
+  发布者为中继取走的帧（没有观众与录制时中继不取帧，为 0）
+- 丢包：发布者为上行 RTP 的 packetsLost，观众为对端接收报告（remote-inbound-rtp）中的 packetsLost
+- 抖动：视频 RTP 的 jitter（换算为毫秒）；往返时延：观众为接收报告计算的 roundTripTime，
+  发布者没有（aiortc 作为接收端不计算 RTT）
+
+采样直接 await 各收发端的 getStats()（不经 gather 创建任务，整轮不让出事件循环），
+每轮耗时计入 collector，可据此评估常开的开销。lifecycle 检查活动时复用最近的样本，不再单独调用 getStats()。
+"""
+
+import os
+import time
+import asyncio
+from collections import deque
+
+# 采样间隔（秒，0 关闭）与每个连接保留的样本数（默认约 2 分钟）
+WEBRTC_STATS_INTERVAL = float(os.environ.get("WEBRTC_STATS_INTERVAL", 2))
+WEBRTC_STATS_SAMPLES = int(os.environ.get("WEBRTC_STATS_SAMPLES", 60))
+# RTP 时钟频率，jitter 以时间戳为单位
+CLOCK_RATES = {"video": 90000, "audio": 48000}
+
+# 样本为元组（连接多时比 dict 省内存），字段依次为：
+# 采样时间（time.monotonic()）、收 / 发字节数、收到的包数（transport）、媒体包数（发布者收到 / 观众发出的 RTP）、
+# 丢包数、帧数（没有计帧轨时为 None）、视频抖动（毫秒）、往返时延（毫秒）
+SAMPLE_FIELDS = ("t", "rx_bytes", "tx_bytes", "rx_packets", "media_packets", "lost", "frames", "jitter_ms", "rtt_ms")
+T, RX_BYTES, TX_BYTES, RX_PACKETS, MEDIA_PACKETS, LOST, FRAMES, JITTER_MS, RTT_MS = range(len(SAMPLE_FIELDS))
+
+# {pc_id: {"pc", "type", "stream", "meter": 计帧轨（有 frames 属性）或 None, "samples": deque}}
+connections = {}
+# 采样任务自身的开销：轮数、样本数、失败数，每轮耗时（毫秒）
+collector = {"sweeps": 0, "samples": 0, "errors": 0, "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0}
+
+
+def track(pc_id, pc, conn_type, stream_id):
+    """登记新建的连接"""
+    connections[pc_id] = {"pc": pc, "type": conn_type, "stream": stream_id, "meter": None,
+                          "samples": deque(maxlen=WEBRTC_STATS_SAMPLES)}
+
+
+def meter(pc_id, metered):
+    """登记连接的计帧轨"""
+    conn = connections.get(pc_id)
+    if conn is not None:
+        conn["meter"] = metered
+
+
+def forget(pc_id):
+    connections.pop(pc_id, None)
+
+
+async def _report(pc):
+    """连接的统计报告：直接 await 各收发端的 getStats()（它们不会挂起），不让出事件循环"""
+    report = {}
+    for part in [*pc.getSenders(), *pc.getReceivers()]:
+        report.update(await part.getStats())
+    return report
+
+
+def _sample(conn, report, now):
+    publisher = conn["type"] == "publisher"
+    rx_bytes = tx_bytes = rx_packets = media = lost = 0
+    jitter = rtt = None
+    for stats in report.values():
+        if stats.type == "transport":
+            rx_bytes += stats.bytesReceived
+            tx_bytes += stats.bytesSent
+            rx_packets += stats.packetsReceived
+        elif stats.type == "inbound-rtp" and publisher:
+            media += stats.packetsReceived
+            lost += stats.packetsLost
+        elif stats.type == "outbound-rtp" and not publisher:
+            media += stats.packetsSent
+        elif stats.type == "remote-inbound-rtp" and not publisher:
+            lost += stats.packetsLost
+            if stats.roundTripTime is not None and (rtt is None or stats.kind == "video"):
+                rtt = round(stats.roundTripTime * 1000, 1)
+        else:
+            continue
+        if stats.type in ("inbound-rtp", "remote-inbound-rtp") and stats.kind == "video":
+            jitter = round(stats.jitter * 1000 / CLOCK_RATES["video"], 1)
+    frames = conn["meter"].frames if conn["meter"] is not None else None
+    return now, rx_bytes, tx_bytes, rx_packets, media, lost, frames, jitter, rtt
+
+
+async def sweep():
+    """采样一轮（只采已连接的连接），返回采样数"""
+    started = time.perf_counter()
+    count = 0
+    for conn in list(connections.values()):
+        if conn["pc"].connectionState != "connected":
+            continue
+        try:
+            report = await _report(conn["pc"])
+        except Exception as e:
+            collector["errors"] += 1
+            print(f"[QOS] 采样失败: {e!r}")
+            continue
+        conn["samples"].append(_sample(conn, report, time.monotonic()))
+        count += 1
+    elapsed = (time.perf_counter() - started) * 1000
+    collector["sweeps"] += 1
+    collector["samples"] += count
+    collector["last_ms"] = round(elapsed, 3)
+    collector["max_ms"] = round(max(collector["max_ms"], elapsed), 3)
+    collector["total_ms"] += elapsed
+    return count
+
+
+async def run():
+    """后台任务：每 WEBRTC_STATS_INTERVAL 秒采样一轮（为 0 时直接返回）"""
+    while WEBRTC_STATS_INTERVAL > 0:
+        await asyncio.sleep(WEBRTC_STATS_INTERVAL)
+        try:
+            await sweep()
+        except Exception as e:
+            print(f"[QOS] 采样失败: {e!r}")
+
+
+def latest(pc_id, max_age):
+    """最近 max_age 秒内的样本（供 lifecycle 复用），没有时返回 None"""
+    conn = connections.get(pc_id)
+    if conn is None or not conn["samples"]:
+        return None
+    sample = conn["samples"][-1]
+    return sample if time.monotonic() - sample[T] <= max_age else None
+
+
+def _rates(first, last):
+    """两个样本之间的平均收发码率（kbps）、帧率与丢包率（%）"""
+    seconds = last[T] - first[T]
+    if seconds <= 0:
+        return None
+    packets, lost = last[MEDIA_PACKETS] - first[MEDIA_PACKETS], last[LOST] - first[LOST]
+    frames = None if first[FRAMES] is None or last[FRAMES] is None else last[FRAMES] - first[FRAMES]
+    return {
+        "seconds": round(seconds, 1),
+        "rx_kbps": round((last[RX_BYTES] - first[RX_BYTES]) * 8 / seconds / 1000, 1),
+        "tx_kbps": round((last[TX_BYTES] - first[TX_BYTES]) * 8 / seconds / 1000, 1),
+        "fps": None if frames is None else round(frames / seconds, 1),
+        "loss_pct": round(max(lost, 0) * 100 / (packets + lost), 2) if packets + lost > 0 else 0.0,
+    }
+
+
+def _spread(values):
+    """数值的平均与最大值，忽略 None"""
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {"avg": round(sum(values) / len(values), 1), "max": round(max(values), 1)}
+
+
+def summary(pc_id, history=False):
+    """单个连接：最近一个间隔（current）与整个缓冲区（window）的码率、帧率、丢包率、抖动、往返时延。
+    history 为 True 时另返回每个间隔的数值"""
+    conn = connections.get(pc_id)
+    if conn is None:
+        return None
+    samples = list(conn["samples"])
+    result = {"connection": pc_id, "type": conn["type"], "stream": conn["stream"], "samples": len(samples),
+              "current": None, "window": None}
+    if len(samples) >= 2:
+        result["current"] = dict(_rates(samples[-2], samples[-1]) or {},
+                                 jitter_ms=samples[-1][JITTER_MS], rtt_ms=samples[-1][RTT_MS])
+        result["window"] = dict(_rates(samples[0], samples[-1]) or {},
+                                jitter_ms=_spread(s[JITTER_MS] for s in samples),
+                                rtt_ms=_spread(s[RTT_MS] for s in samples))
+    if history:
+        result["history"] = [dict(_rates(a, b) or {}, jitter_ms=b[JITTER_MS], rtt_ms=b[RTT_MS])
+                             for a, b in zip(samples, samples[1:])]
+    return result
+
+
+def _stream_summary(stream_id, items):
+    """一个流：发布者的当前值，观众的人数、下行码率合计与帧率 / 丢包率 / 抖动 / 往返时延的平均与最差值"""
+    publisher = next((s for s in items if s["type"] == "publisher"), None)
+    viewers = [s["current"] for s in items if s["type"] != "publisher" and s["current"]]
+    fps = [v["fps"] for v in viewers if v["fps"] is not None]
+    return {
+        "stream": stream_id,
+        "publisher": publisher and dict(publisher["current"] or {}, connection=publisher["connection"]),
+        "viewers": {
+            "count": sum(s["type"] != "publisher" for s in items),
+            "tx_kbps": round(sum(v["tx_kbps"] for v in viewers), 1),
+            "fps": {"avg": round(sum(fps) / len(fps), 1), "min": min(fps)} if fps else None,
+            "loss_pct": _spread(v["loss_pct"] for v in viewers),
+            "jitter_ms": _spread(v["jitter_ms"] for v in viewers),
+            "rtt_ms": _spread(v["rtt_ms"] for v in viewers),
+        },
+    }
+
+
+def status(stream_id=None):
+    """全部（或指定流的）连接与按流汇总的统计，以及采样开销"""
+    items = [summary(pc_id) for pc_id, conn in list(connections.items())
+             if stream_id is None or conn["stream"] == stream_id]
+    by_stream = {}
+    for item in items:
+        by_stream.setdefault(item["stream"], []).append(item)
+    sweeps = collector["sweeps"]
+    return {
+        "interval": WEBRTC_STATS_INTERVAL,
+        "max_samples": WEBRTC_STATS_SAMPLES,
+        "collector": dict(collector, total_ms=round(collector["total_ms"], 1),
+                          avg_ms=round(collector["total_ms"] / sweeps, 3) if sweeps else 0.0,
+                          per_sample_us=round(collector["total_ms"] * 1000 / collector["samples"], 1)
+                          if collector["samples"] else 0.0),
+        "streams": [_stream_summary(s, group) for s, group in by_stream.items()],
+        "connections": items,
+    }
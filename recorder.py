@@ -0,0 +1,253 @@
+"""
+服务端录制直播流
+----------------
+订阅发布者的中继视频轨，按固定时长分段编码为 H.264 MP4，写入 uploads/<ip>/ 并登记到 videos 表，
+与客户端上传的录像一样进入列表、后台任务（探测 / faststart）与保留策略。
+带宽受限的站点开启后可以关闭客户端上传。
+
+事件循环上的协程只负责从中继轨取帧放入队列；编码、写盘与登记在每路录制各自的工作线程中完成，
+不阻塞中继。编码跟不上时丢弃最旧的帧并计数，不会让队列无限增长。
+中继帧由所有订阅者共享，观众的编码器会在其他线程中改写帧的 pts / time_base，
+因此录制按帧到达事件循环的时间打时间戳，不读取帧自带的时间戳。
+
+分段先写到 uploads/.recording/（对账时跳过以 . 开头的目录），完成后原子重命名到 uploads/<ip>/。
+"""
+
+import os
+import re
+import time
+import queue
+import hashlib
+import threading
+from datetime import datetime
+from fractions import Fraction
+
+import av
+from aiortc.mediastreams import MediaStreamError
+
+import database
+import db_manage
+import purge
+
+UPLOAD_ROOT = os.path.join(os.path.dirname(__file__), "uploads")
+DB_PATH = db_manage.DB_PATH
+RECORDING_DIR = ".recording"
+# 流 id（即文件夹名）允许的字符：IPv4 / IPv6 地址、主机名等。不能以点开头：
+# 排除 . / ..，以及 .recording、.sessions、.trash 等内部目录
+NAME_PATTERN = re.compile(r"[A-Za-z0-9_:-][A-Za-z0-9_.:-]*")
+NAME_MAX_LEN = 64
+
+# 是否录制所有发布中的流（发布请求可用 "record" 字段单独开关）；每段时长（秒）；短于该秒数的尾段丢弃
+RECORD_LIVE = os.environ.get("RECORD_LIVE", "0") == "1"
+RECORD_SEGMENT_SECONDS = int(os.environ.get("RECORD_SEGMENT_SECONDS", 5 * 60))
+RECORD_MIN_SECONDS = 1
+# 编码参数（libx264）
+RECORD_CODEC = "libx264"
+RECORD_PRESET = os.environ.get("RECORD_PRESET", "veryfast")
+RECORD_CRF = int(os.environ.get("RECORD_CRF", 28))
+# 等待编码的帧数上限（约 2 秒），超出时丢弃最旧的帧
+RECORD_QUEUE_SIZE = 60
+# 分段内时间戳的时基（90kHz，与 RTP 视频时钟一致）
+VIDEO_TIME_BASE = Fraction(1, 90000)
+
+_lock = threading.Lock()
+recordings = {}  # ip -> 录制状态 {"ip", "thread", "queue", "segments", "frames", "dropped", "started_at"}
+_workers = set()  # 还在编码 / 保存的工作线程（录制停止后仍要写完最后一段）
+
+
+def valid_name(name):
+    """流 id 能否直接用作 uploads/ 下的文件夹名"""
+    return isinstance(name, str) and len(name) <= NAME_MAX_LEN and NAME_PATTERN.fullmatch(name) is not None
+
+
+def folder_name(ip):
+    """流 id 对应的文件夹名；不合法（会逃出 uploads/ 或写入内部目录）时抛出 ValueError"""
+    if not valid_name(ip):
+        raise ValueError(f"invalid stream id: {ip!r}")
+    return ip
+
+
+def reserve_segment_name(folder):
+    """在 folder 下独占创建与上传相同格式的文件名（毫秒时间戳.mp4，撞名时追加序号），返回文件名。
+    O_EXCL 保证不会覆盖同一时刻上传的录像"""
+    now = datetime.now()
+    stamp = now.strftime("%Y%m%d_%H%M%S_") + f"{now.microsecond // 1000:03d}"
+    seq = 0
+    while True:
+        filename = f"{stamp}_{seq}.mp4" if seq else f"{stamp}.mp4"
+        try:
+            os.close(os.open(os.path.join(folder, filename), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return filename
+        except FileExistsError:
+            seq += 1
+
+
+def copy_frame(frame):
+    """帧的独立副本（按行复制各平面，兼容两边行宽填充不同）"""
+    copy = av.VideoFrame(frame.width, frame.height, frame.format.name)
+    for src, dst in zip(frame.planes, copy.planes):
+        if src.line_size == dst.line_size:
+            dst.update(bytes(src))
+            continue
+        data, out, width = memoryview(src), bytearray(dst.buffer_size), min(src.line_size, dst.line_size)
+        for row in range(dst.height):
+            out[row * dst.line_size:row * dst.line_size + width] = data[row * src.line_size:row * src.line_size + width]
+        dst.update(out)
+    return copy
+
+
+def _open_segment(state, frame, arrived):
+    """按首帧尺寸打开一个新分段"""
+    os.makedirs(os.path.join(UPLOAD_ROOT, RECORDING_DIR), exist_ok=True)
+    path = os.path.join(UPLOAD_ROOT, RECORDING_DIR, f"{folder_name(state['ip'])}.{os.getpid()}.{state['segments']}.mp4")
+    container = av.open(path, "w", format="mp4", options={"movflags": "+faststart"})
+    stream = container.add_stream(RECORD_CODEC, rate=30)
+    stream.width = frame.width - frame.width % 2
+    stream.height = frame.height - frame.height % 2
+    stream.pix_fmt = "yuv420p"
+    stream.time_base = VIDEO_TIME_BASE
+    stream.codec_context.time_base = VIDEO_TIME_BASE
+    stream.options = {"preset": RECORD_PRESET, "crf": str(RECORD_CRF)}
+    return {"path": path, "container": container, "stream": stream, "started": arrived, "last_pts": -1,
+            "size": (frame.width, frame.height)}
+
+
+def _close_segment(state, segment):
+    """结束分段：刷新编码器，足够长的移入 uploads/<ip>/ 并登记，否则丢弃"""
+    for packet in segment["stream"].encode(None):
+        segment["container"].mux(packet)
+    segment["container"].close()
+    duration = float(segment["last_pts"] * VIDEO_TIME_BASE)
+    if duration < RECORD_MIN_SECONDS:
+        os.remove(segment["path"])
+        return None
+    return _register(state["ip"], segment["path"], duration)
+
+
+def _register(ip, path, duration):
+    """把完成的分段移入文件夹并写入 videos。文件夹正在删除时丢弃"""
+    db = database.get(DB_PATH)
+    if purge.is_deleted(db, ip):
+        os.remove(path)
+        print(f"[RECORD] {ip} 文件夹正在删除，丢弃录制分段")
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    folder = os.path.join(UPLOAD_ROOT, folder_name(ip))
+    os.makedirs(folder, exist_ok=True)
+    with database.transaction(db):
+        filename = reserve_segment_name(folder)
+        os.replace(path, os.path.join(folder, filename))
+        size = os.path.getsize(os.path.join(folder, filename))
+        db_manage.upsert_video(db.cursor(), ip, filename, size, sha256=digest.hexdigest())
+    print(f"[RECORD] {ip} 录制分段 {filename} ({duration:.1f}秒, {size} 字节)")
+    return filename
+
+
+def _encode_loop(state):
+    """工作线程：从队列取 (帧, 到达时间) 编码，达到分段时长或分辨率变化时换新分段；收到 None 时结束"""
+    segment = None
+    try:
+        while True:
+            item = state["queue"].get()
+            if item is None:
+                break
+            frame, arrived = item
+            if segment is not None and (
+                (frame.width, frame.height) != segment["size"]
+                or arrived - segment["started"] >= RECORD_SEGMENT_SECONDS
+            ):
+                _close_segment(state, segment)
+                segment = None
+            if segment is None:
+                segment = _open_segment(state, frame, arrived)
+                state["segments"] += 1
+            stream = segment["stream"]
+            pts = int((arrived - segment["started"]) / VIDEO_TIME_BASE)
+            if pts <= segment["last_pts"]:
+                continue
+            segment["last_pts"] = pts
+            # 中继帧共享，不能就地修改：无需转换时 reformat 返回原对象，此时复制一份
+            if frame.format.name == "yuv420p" and (frame.width, frame.height) == (stream.width, stream.height):
+                frame = copy_frame(frame)
+            else:
+                frame = frame.reformat(width=stream.width, height=stream.height, format="yuv420p")
+            frame.pts = pts
+            frame.time_base = VIDEO_TIME_BASE
+            for packet in stream.encode(frame):
+                segment["container"].mux(packet)
+    except Exception as e:
+        print(f"[RECORD] {state['ip']} 录制失败: {e}")
+    finally:
+        if segment is not None:
+            try:
+                _close_segment(state, segment)
+            except Exception as e:
+                print(f"[RECORD] {state['ip']} 保存最后一段失败: {e}")
+        database.close_all()
+        with _lock:
+            _workers.discard(state["thread"])
+
+
+def _put(state, frame):
+    """放入编码队列，满时丢弃最旧的帧"""
+    while True:
+        try:
+            state["queue"].put_nowait(frame)
+            return
+        except queue.Full:
+            try:
+                state["queue"].get_nowait()
+                state["dropped"] += 1
+            except queue.Empty:
+                pass
+
+
+async def record(ip, track):
+    """录制一路视频轨到 uploads/<ip>/ 直到其结束（在事件循环上作为任务运行）。track 应为单独订阅的中继轨。
+    ip 不是合法的文件夹名时抛出 ValueError，不开始录制"""
+    folder_name(ip)
+    state = {"ip": ip, "queue": queue.Queue(maxsize=RECORD_QUEUE_SIZE), "segments": 0, "frames": 0,
+             "dropped": 0, "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    state["thread"] = threading.Thread(target=_encode_loop, args=(state,), name=f"record-{ip}", daemon=True)
+    with _lock:
+        recordings[ip] = state
+        _workers.add(state["thread"])
+    state["thread"].start()
+    print(f"[RECORD] {ip} 开始录制")
+    try:
+        while True:
+            try:
+                frame = await track.recv()
+            except MediaStreamError:
+                break
+            state["frames"] += 1
+            _put(state, (frame, time.monotonic()))
+    finally:
+        track.stop()
+        _put(state, None)
+        with _lock:
+            if recordings.get(ip) is state:
+                del recordings[ip]
+        print(f"[RECORD] {ip} 停止录制 | 帧 {state['frames']}，丢弃 {state['dropped']}")
+    return state
+
+
+def join_all(timeout=30):
+    """等待所有录制线程写完最后一段（进程退出前调用，在线程中执行）"""
+    with _lock:
+        threads = list(_workers)
+    for thread in threads:
+        thread.join(timeout)
+
+
+def status():
+    """正在录制的流：{ip: {"ip", "segments", "frames", "dropped", "queued", "started_at"}}"""
+    with _lock:
+        return {
+            ip: {"ip": state["ip"], "segments": state["segments"], "frames": state["frames"],
+                        "dropped": state["dropped"], "queued": state["queue"].qsize(), "started_at": state["started_at"]}
+            for ip, state in recordings.items()
+        }
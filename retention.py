@@ -0,0 +1,182 @@
+"""
+录像保留策略
+------------
+按 videos 表（不遍历文件系统）找出超出保留策略的录像，从最旧的开始分批删除文件与记录。
+记录删除由 videos 上的触发器同步更新 folders 统计列并删除对应任务。
+
+策略（0 表示不限制）：
+- 每个文件夹：最长保留天数、最大总字节数、最多录像数。全局默认值来自环境变量
+  RETENTION_MAX_AGE_DAYS / RETENTION_MAX_BYTES / RETENTION_MAX_COUNT，
+  folders.retention_days / retention_bytes / retention_count 非 NULL 时覆盖默认值
+- 全部文件夹合计：RETENTION_TOTAL_BYTES，超出时从所有录像中最旧的开始删除
+"""
+
+import os
+import time
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from multiprocessing import Process
+
+import database
+
+# 全局默认策略（作用于每个文件夹）与全部录像的总容量上限，0 不限制
+RETENTION_MAX_AGE_DAYS = int(os.environ.get("RETENTION_MAX_AGE_DAYS", 0))
+RETENTION_MAX_BYTES = int(os.environ.get("RETENTION_MAX_BYTES", 0))
+RETENTION_MAX_COUNT = int(os.environ.get("RETENTION_MAX_COUNT", 0))
+RETENTION_TOTAL_BYTES = int(os.environ.get("RETENTION_TOTAL_BYTES", 0))
+# 后台检查间隔（秒）；每批最多删除的文件数与批次之间的间隔（秒），避免长时间占用磁盘与写锁
+RETENTION_INTERVAL = int(os.environ.get("RETENTION_INTERVAL", 10 * 60))
+RETENTION_BATCH = 100
+RETENTION_BATCH_PAUSE = 1.0
+
+POLICY_FIELDS = ("retention_days", "retention_bytes", "retention_count")
+
+
+def defaults():
+    return {
+        "retention_days": RETENTION_MAX_AGE_DAYS,
+        "retention_bytes": RETENTION_MAX_BYTES,
+        "retention_count": RETENTION_MAX_COUNT,
+    }
+
+
+def effective_policy(row):
+    """文件夹的生效策略：列为 NULL 时使用全局默认值"""
+    policy = defaults()
+    for field in POLICY_FIELDS:
+        if row[field] is not None:
+            policy[field] = row[field]
+    return policy
+
+
+def candidates(db, now=None):
+    """按策略逐个产出应删除的录像（dict，含 reason），每个文件夹内从最旧的开始。
+
+    正在处理（任务 running）的视频跳过，下一轮再删。
+    """
+    now = now or datetime.now(timezone.utc)
+    busy = {r[0] for r in db.execute("SELECT video_id FROM jobs WHERE status = 'running'")}
+    # 已删除、正在后台清除的文件夹不参与
+    purging = {r[0] for r in db.execute('SELECT ip FROM folders WHERE deleted_at IS NOT NULL')}
+    chosen = set()
+    kept_bytes = 0
+
+    folders = db.execute(
+        'SELECT ip, video_count, total_bytes, retention_days, retention_bytes, retention_count '
+        'FROM folders WHERE video_count > 0 AND deleted_at IS NULL'
+    ).fetchall()
+    for folder in folders:
+        policy = effective_policy(folder)
+        days, max_bytes, max_count = policy["retention_days"], policy["retention_bytes"], policy["retention_count"]
+        count, size = folder["video_count"], folder["total_bytes"]
+        cutoff = (now - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S") if days else None
+        if cutoff or (max_count and count > max_count) or (max_bytes and size > max_bytes):
+            # 从最旧的开始，直到既不过期、数量与容量也都在限额内
+            for row in db.execute(
+                'SELECT id, ip, filename, file_size, uploaded_at FROM videos WHERE ip = ? ORDER BY uploaded_at, id',
+                (folder["ip"],)
+            ):
+                if cutoff and row["uploaded_at"] < cutoff:
+                    reason = "age"
+                elif max_count and count > max_count:
+                    reason = "count"
+                elif max_bytes and size > max_bytes:
+                    reason = "bytes"
+                else:
+                    break
+                count -= 1
+                size -= row["file_size"] or 0
+                if row["id"] in busy:
+                    continue
+                chosen.add(row["id"])
+                yield dict(row, reason=reason)
+        kept_bytes += size
+
+    if RETENTION_TOTAL_BYTES and kept_bytes > RETENTION_TOTAL_BYTES:
+        for row in db.execute('SELECT id, ip, filename, file_size, uploaded_at FROM videos ORDER BY uploaded_at, id'):
+            if kept_bytes <= RETENTION_TOTAL_BYTES:
+                break
+            if row["id"] in chosen or row["ip"] in purging:
+                continue
+            kept_bytes -= row["file_size"] or 0
+            if row["id"] in busy:
+                continue
+            yield dict(row, reason="total")
+
+
+def delete_videos(db, upload_root, videos):
+    """删除文件后删除记录（先删文件：记录还在而文件已不存在时对账可以修正，反之会被重新补录）。
+    返回 (删除数, 释放字节数)"""
+    deleted = []
+    freed = 0
+    for video in videos:
+        try:
+            os.remove(os.path.join(upload_root, video["ip"], video["filename"]))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # 例如 Windows 下文件正被播放，下一轮再试
+            print(f"[RETENTION] 删除失败 {video['ip']}/{video['filename']}: {e}")
+            continue
+        deleted.append((video["id"],))
+        freed += video["file_size"] or 0
+    if deleted:
+        with database.transaction(db):
+            db.executemany('DELETE FROM videos WHERE id = ?', deleted)
+    return len(deleted), freed
+
+
+def run_once(db, upload_root, batch=None, pause=None):
+    """按策略删除直到没有超出的录像，每批 batch 个，批次之间暂停 pause 秒。返回 (删除数, 释放字节数)"""
+    batch = batch or RETENTION_BATCH
+    pause = RETENTION_BATCH_PAUSE if pause is None else pause
+    total, freed = 0, 0
+    while True:
+        # 每批重新计算：批次之间可能有新上传、策略修改或任务开始 / 结束
+        gen = candidates(db)
+        videos = [v for _, v in zip(range(batch), gen)]
+        gen.close()
+        if not videos:
+            return total, freed
+        n, size = delete_videos(db, upload_root, videos)
+        total += n
+        freed += size
+        if n == 0:
+            # 这一批全部删除失败，等下一轮
+            return total, freed
+        time.sleep(pause)
+
+
+def loop(db_path, upload_root):
+    """后台进程主循环"""
+    db = database.connect(db_path)
+    while True:
+        try:
+            n, size = run_once(db, upload_root)
+            if n:
+                print(f"[RETENTION] 删除 {n} 个录像，释放 {size / 1024 / 1024:.1f} MB")
+        except sqlite3.Error as e:
+            print(f"[RETENTION] 执行失败: {e}")
+        time.sleep(RETENTION_INTERVAL)
+
+
+def start(db_path, upload_root):
+    """启动后台清理进程（守护进程，随主进程退出）"""
+    p = Process(target=loop, args=(db_path, upload_root), name="retention", daemon=True)
+    p.start()
+    return p
+
+
+def summarize(db, now=None):
+    """预估本轮会删除的录像：{"count", "bytes", "by_reason", "folders": {ip: {"count", "bytes"}}, "videos": [...]}"""
+    result = {"count": 0, "bytes": 0, "by_reason": {}, "folders": {}, "videos": []}
+    for video in candidates(db, now):
+        size = video["file_size"] or 0
+        result["count"] += 1
+        result["bytes"] += size
+        result["by_reason"][video["reason"]] = result["by_reason"].get(video["reason"], 0) + 1
+        folder = result["folders"].setdefault(video["ip"], {"count": 0, "bytes": 0})
+        folder["count"] += 1
+        folder["bytes"] += size
+        result["videos"].append(video)
+    return result
@@ -0,0 +1,123 @@
+"""
+生产环境启动
+------------
+backend.py 的 WSGI 启动入口（webrtc_server.py 使用 aiohttp，不经过这里）：
+Linux / macOS 使用 gunicorn（多进程 + 线程池），Windows 使用 waitress（单进程线程池），
+SERVE_MODE=dev 或命令行 --dev 时仍使用 Flask 开发服务器。
+
+gunicorn 模式下：kill -HUP <主进程> 平滑重载工作进程，kill -TERM 等待进行中的请求结束后退出。
+"""
+
+import os
+import sys
+
+# dev / prod
+SERVE_MODE = os.environ.get("SERVE_MODE", "prod").lower()
+# 工作进程数（仅 gunicorn）、每进程线程数
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", 2))
+WEB_THREADS = int(os.environ.get("WEB_THREADS", 16))
+# 空闲长连接保持秒数；单个请求无响应的超时秒数（大文件上传较慢，需留足余量）
+WEB_KEEPALIVE = int(os.environ.get("WEB_KEEPALIVE", 5))
+WEB_TIMEOUT = int(os.environ.get("WEB_TIMEOUT", 300))
+# 平滑退出 / 重载时等待进行中请求的秒数
+WEB_GRACEFUL_TIMEOUT = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", 30))
+# 每个工作进程处理多少请求后自动重启（0 不重启），防止内存缓慢增长
+WEB_MAX_REQUESTS = int(os.environ.get("WEB_MAX_REQUESTS", 0))
+WEB_PIDFILE = os.environ.get("WEB_PIDFILE") or None
+# 请求行 / 请求头大小与数量上限（请求体上限由各应用的 MAX_CONTENT_LENGTH 控制）
+LIMIT_REQUEST_LINE = 8190
+LIMIT_REQUEST_FIELDS = 100
+LIMIT_REQUEST_FIELD_SIZE = 8190
+
+
+def dev_mode():
+    return SERVE_MODE == "dev" or "--dev" in sys.argv
+
+
+def run(app, port, host="0.0.0.0", workers=None, threads=None, on_start=None, name="app"):
+    """启动服务并阻塞。
+
+    on_start 在每个实际处理请求的进程中调用一次（gunicorn 为每个工作进程），
+    用于启动该进程内的后台线程；workers 为 1 时用于保存进程内状态的应用（如 WebRTC 会话）。
+    """
+    max_body = app.config.get("MAX_CONTENT_LENGTH")
+    if dev_mode():
+        print(f"⚠️  {name}: Flask 开发服务器 (port {port})，勿用于生产环境")
+        if on_start:
+            on_start()
+        # 重要：Windows 下禁用 reloader，避免重复启动子进程导致套接字异常
+        app.run(host=host, port=port, debug=True, use_reloader=False, threaded=True)
+        return
+
+    if os.name != "nt":
+        try:
+            import gunicorn  # noqa: F401
+        except ImportError:
+            print("⚠️  未安装 gunicorn，改用 waitress")
+        else:
+            return _run_gunicorn(app, host, port, workers, threads, on_start, name)
+    _run_waitress(app, host, port, threads, on_start, max_body, name)
+
+
+def _run_gunicorn(app, host, port, workers, threads, on_start, name):
+    from gunicorn.app.base import BaseApplication
+
+    options = {
+        "bind": f"{host}:{port}",
+        "workers": WEB_WORKERS if workers is None else workers,
+        "threads": WEB_THREADS if threads is None else threads,
+        "worker_class": "gthread",
+        "keepalive": WEB_KEEPALIVE,
+        "timeout": WEB_TIMEOUT,
+        "graceful_timeout": WEB_GRACEFUL_TIMEOUT,
+        "max_requests": WEB_MAX_REQUESTS,
+        "max_requests_jitter": WEB_MAX_REQUESTS // 10,
+        "limit_request_line": LIMIT_REQUEST_LINE,
+        "limit_request_fields": LIMIT_REQUEST_FIELDS,
+        "limit_request_field_size": LIMIT_REQUEST_FIELD_SIZE,
+        "pidfile": WEB_PIDFILE if name == "backend" else None,
+        "proc_name": f"catchscreen-{name}",
+        "accesslog": None,
+        "errorlog": "-",
+        # gunicorn 25+ 的控制套接字默认路径固定，同一台机器上的多个实例会互相冲突；重载用 HUP 信号即可
+        "control_socket_disable": True,
+        "post_fork": _post_fork,
+    }
+    if on_start:
+        options["post_worker_init"] = lambda worker: on_start()
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                # 跳过当前 gunicorn 版本不支持的配置项
+                if key in self.cfg.settings:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    print(f"✅ {name}: gunicorn {options['workers']} 进程 × {options['threads']} 线程 (port {port})")
+    Application().run()
+
+
+def _post_fork(server, worker):
+    """gunicorn 直接 os.fork 出工作进程，会继承主进程 multiprocessing 的子进程表
+    （任务进程池、WebRTC 子进程），退出时 atexit 会去 join 这些不属于自己的进程而报错"""
+    import multiprocessing.process
+    multiprocessing.process._children.clear()
+
+
+def _run_waitress(app, host, port, threads, on_start, max_body, name):
+    from waitress import serve
+
+    if on_start:
+        on_start()
+    threads = WEB_THREADS if threads is None else threads
+    print(f"✅ {name}: waitress {threads} 线程 (port {port})")
+    serve(
+        app, host=host, port=port, threads=threads,
+        channel_timeout=WEB_TIMEOUT,
+        max_request_header_size=LIMIT_REQUEST_FIELDS * LIMIT_REQUEST_FIELD_SIZE,
+        max_request_body_size=max_body or 1024 * 1024 * 1024,
+        ident=f"catchscreen-{name}",
+    )
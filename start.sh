@@ -6,15 +6,24 @@ echo "===================================="
 echo ""
 
 # 检查依赖
-if ! pip show flask flask-cors &>/dev/null; then
+if ! pip show flask flask-cors gunicorn &>/dev/null; then
     echo "正在安装依赖..."
     pip install -r requirements.txt
 fi
 
+# 生产模式参数（可在运行前导出覆盖）：工作进程数、每进程线程数、长连接保持秒数
+export WEB_WORKERS="${WEB_WORKERS:-2}"
+export WEB_THREADS="${WEB_THREADS:-16}"
+export WEB_KEEPALIVE="${WEB_KEEPALIVE:-5}"
+# 主进程 PID 文件：kill -HUP $(cat backend.pid) 平滑重启工作进程
+export WEB_PIDFILE="${WEB_PIDFILE:-backend.pid}"
+
 echo ""
 echo "启动后端服务..."
 echo "访问地址: http://127.0.0.1:5000/frontend/login.html"
+echo "（开发调试: ./start.sh --dev）"
 echo ""
 
-python backend.py
+# exec 使 Ctrl+C / SIGTERM 直接送达 gunicorn 主进程，平滑退出
+exec python backend.py "$@"
 
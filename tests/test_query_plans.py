@@ -0,0 +1,15 @@
+"""高频查询（db_manage.HOT_QUERIES）的执行计划检查：与 python db_manage.py check 相同，
+在临时库上执行全部迁移后要求每条查询都走索引"""
+
+import db_manage
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    path = str(tmp_path / "database.db")
+    db_manage.migrate(path=path)
+    assert db_manage.check_plans(path)
+
+
+def test_check_plans_on_fresh_schema():
+    # 不指定路径时 check_plans 自行建临时库并迁移
+    assert db_manage.check_plans()
@@ -0,0 +1,200 @@
+"""
+视频缩略图
+----------
+后台线程池为录像抽取封面帧（可选生成横向拼接的预览条），结果按内容寻址缓存在 thumbs/ 下，
+缓存总大小超过上限时按最近使用时间淘汰（LRU）。
+"""
+
+import os
+import hashlib
+import threading
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
+
+import av
+
+THUMB_ROOT = os.path.join(os.path.dirname(__file__), "thumbs")
+# 封面宽度（高度按比例）、预览条帧数（0 表示不生成）及每帧宽度
+THUMB_WIDTH = 320
+THUMB_SPRITE_FRAMES = int(os.environ.get("THUMB_SPRITE_FRAMES", 0))
+THUMB_SPRITE_WIDTH = 160
+# 缓存上限（字节）、后台线程数、请求时等待现场生成的最长秒数
+THUMB_CACHE_MAX_BYTES = int(os.environ.get("THUMB_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+THUMB_WORKERS = int(os.environ.get("THUMB_WORKERS", 2))
+THUMB_WAIT = 20
+
+KINDS = ("poster", "sprite")
+
+_lock = threading.Lock()
+_pending = {}        # 缓存路径 -> 正在生成的 Future，避免同一缩略图重复生成
+_cache_bytes = None  # 当前缓存总大小，首次使用时扫描一次
+_executor = None
+
+
+def thumb_key(video_path, sha256=None):
+    """缓存键：有内容哈希时按内容寻址，否则用路径 + 大小 + 修改时间"""
+    if sha256:
+        return sha256
+    st = os.stat(video_path)
+    return hashlib.sha1(f"{os.path.abspath(video_path)}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8")).hexdigest()
+
+
+def cache_path(key, kind="poster"):
+    """缓存文件路径（按键前两位分目录）"""
+    return os.path.join(THUMB_ROOT, key[:2], f"{key}.{kind}.jpg")
+
+
+def _grab_frames(video_path, count):
+    """在视频时长内均匀取 count 个关键帧（只解码关键帧）"""
+    frames = []
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        stream.codec_context.skip_frame = "NONKEY"
+        duration = container.duration or 0
+        for i in range(count):
+            # 封面取 10% 处，避免片头黑屏；预览条在 5%~95% 之间均匀分布
+            pos = 0.1 if count == 1 else 0.05 + 0.9 * i / (count - 1)
+            if duration:
+                container.seek(int(duration * pos), backward=True, any_frame=False)
+            frame = next(container.decode(stream), None)
+            if frame is None:
+                break
+            frames.append(frame)
+    return frames
+
+
+def _encode_jpeg(frames, width, tile=0):
+    """缩放（可选横向拼接）后编码为 JPEG 字节"""
+    first = frames[0]
+    graph = av.filter.Graph()
+    nodes = [
+        graph.add_buffer(width=first.width, height=first.height, format=first.format.name,
+                         time_base=Fraction(1, 25)),
+        graph.add("scale", f"{width}:-2"),
+    ]
+    if tile:
+        nodes.append(graph.add("tile", f"{tile}x1"))
+    nodes += [graph.add("format", "yuvj420p"), graph.add("buffersink")]
+    graph.link_nodes(*nodes).configure()
+    for i, frame in enumerate(frames):
+        frame.pts = i
+        frame.time_base = Fraction(1, 25)
+        graph.push(frame)
+    graph.push(None)
+    image = graph.pull()
+
+    encoder = av.CodecContext.create("mjpeg", "w")
+    encoder.width, encoder.height = image.width, image.height
+    encoder.pix_fmt = "yuvj420p"
+    encoder.time_base = Fraction(1, 25)
+    return b"".join(bytes(p) for p in encoder.encode(image) + encoder.encode(None))
+
+
+def _generate(video_path, path, kind):
+    """生成一张缩略图并写入缓存，失败返回 None"""
+    try:
+        if kind == "sprite":
+            count = THUMB_SPRITE_FRAMES or 5
+            frames = _grab_frames(video_path, count)
+            # 帧数不足时重复最后一帧，保证拼接条宽度固定
+            frames += frames[-1:] * (count - len(frames)) if frames else []
+            data = _encode_jpeg(frames, THUMB_SPRITE_WIDTH, tile=count) if frames else None
+        else:
+            frames = _grab_frames(video_path, 1)
+            data = _encode_jpeg(frames, THUMB_WIDTH) if frames else None
+    except Exception as e:
+        print(f"[THUMB] 生成失败 {video_path}: {e}")
+        return None
+    if not data:
+        return None
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    _account(len(data))
+    return path
+
+
+def _account(added):
+    """累计缓存大小，超过上限时按修改时间（即最近使用时间）淘汰到上限的 90%"""
+    global _cache_bytes
+    with _lock:
+        if _cache_bytes is None:
+            _cache_bytes = sum(size for _, size, _ in _scan())
+        else:
+            _cache_bytes += added
+        if _cache_bytes <= THUMB_CACHE_MAX_BYTES:
+            return
+        target = THUMB_CACHE_MAX_BYTES * 0.9
+        for mtime, size, path in sorted(_scan()):
+            if _cache_bytes <= target:
+                break
+            try:
+                os.remove(path)
+                _cache_bytes -= size
+            except OSError:
+                pass
+
+
+def _scan():
+    """列出缓存文件 (mtime, size, path)"""
+    if not os.path.isdir(THUMB_ROOT):
+        return []
+    entries = []
+    for sub in os.scandir(THUMB_ROOT):
+        if sub.is_dir():
+            for f in os.scandir(sub.path):
+                if f.name.endswith(".jpg"):
+                    st = f.stat()
+                    entries.append((st.st_mtime, st.st_size, f.path))
+    return entries
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix="thumb")
+        return _executor
+
+
+def submit(video_path, sha256=None, kind="poster"):
+    """提交后台生成任务（已缓存或正在生成时直接返回），返回 Future 或 None"""
+    path = cache_path(thumb_key(video_path, sha256), kind)
+    if os.path.exists(path):
+        return None
+    executor = _get_executor()
+    with _lock:
+        future = _pending.get(path)
+        if future is not None:
+            return future
+        future = _pending[path] = executor.submit(_generate, video_path, path, kind)
+    future.add_done_callback(lambda _: _pending.pop(path, None))
+    return future
+
+
+def submit_all(video_path, sha256=None):
+    """上传完成后调用：生成封面，启用预览条时一并生成"""
+    submit(video_path, sha256, "poster")
+    if THUMB_SPRITE_FRAMES:
+        submit(video_path, sha256, "sprite")
+
+
+def get(video_path, sha256=None, kind="poster", timeout=THUMB_WAIT):
+    """取缩略图路径：命中缓存时刷新其使用时间；未命中时现场生成并等待，失败返回 None"""
+    path = cache_path(thumb_key(video_path, sha256), kind)
+    if os.path.exists(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+    future = submit(video_path, sha256, kind)
+    if future is None:
+        return path if os.path.exists(path) else None
+    try:
+        return future.result(timeout=timeout)
+    except Exception:
+        return None
@@ -0,0 +1,361 @@
+"""
+WebRTC 多进程扩展
+----------------
+aiortc 的全部会话跑在一个进程的事件循环上，受 GIL 限制只能用到一个核。
+WEBRTC_WORKERS > 1 时 start_webrtc_server 改为启动本模块：
+
+- 主进程（supervisor）启动 N 个中继工作进程（各自运行完整的 webrtc_server 应用，只监听 127.0.0.1），
+  对外端口上只做信令路由，不处理媒体
+- 每个流 id 第一次出现（发布或观众等待）时分配给当前流最少的工作进程并固定下来，
+  该流的 /webrtc、/view、/viewer/open、/viewer/close 都转发给这个工作进程；
+  Answer 中的 ICE 候选就是工作进程自己的 UDP 端口，媒体直接在客户端与工作进程之间传输
+- 工作进程退出（崩溃）后自动重启；频繁崩溃时重启间隔逐次加倍（最长 WORKER_RESTART_MAX_DELAY 秒）。
+  重启后流仍分配给同一个工作进程，抓取端重新发布即可恢复。汇总查询持续 WORKER_HANG_SECONDS 秒无应答的工作进程视为卡死，
+  强制结束后同样重启；流下线且没有观众等待后移除其分配
+- /streams、/recordings、/connections、/stats、/metrics 汇总各工作进程的结果（连接数上限按每个工作进程计算），
+  /metrics 另含各工作进程的状态与重启次数
+- 工作进程发现主进程已退出（被强制结束）时自行退出
+"""
+
+import os
+import sys
+import time
+import json
+import signal
+import asyncio
+import subprocess
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+import webrtc_server
+
+WEBRTC_WORKERS = int(os.environ.get("WEBRTC_WORKERS", 1))
+# 工作进程端口从该值起连续分配（只监听 127.0.0.1），0 表示从对外端口 + 1 起
+WEBRTC_WORKER_PORT = int(os.environ.get("WEBRTC_WORKER_PORT", 0))
+# 检查工作进程存活、刷新各进程流数的间隔（秒）；崩溃后重启的初始 / 最长等待（秒）；
+# 运行超过多久的工作进程退出后不算频繁崩溃（秒）
+WORKER_CHECK_INTERVAL = 1.0
+WORKER_RESTART_DELAY = 1.0
+WORKER_RESTART_MAX_DELAY = 30.0
+WORKER_STABLE_SECONDS = 30
+# 转发时连接工作进程的超时（秒）；/view 可能长时间等待发布，不限制总时长；
+# 工作进程正在启动（端口还未监听）时转发最多等待多久（秒）
+WORKER_CONNECT_TIMEOUT = 5
+WORKER_START_TIMEOUT = WORKER_RESTART_MAX_DELAY + 10
+# 汇总查询（/streams、/metrics 等）每个工作进程的超时（秒）；连续多久不应答的工作进程视为卡死，强制结束后重启（秒）
+WORKER_QUERY_TIMEOUT = 5
+WORKER_HANG_SECONDS = 15
+# 分配后多久仍既未发布、也没有观众等待的流 id 从 owners 中移除（秒，覆盖转发等待工作进程启动的时间）
+OWNER_GRACE_SECONDS = WORKER_START_TIMEOUT
+
+# 工作进程：[{"index", "port", "proc", "started_at", "restarts", "delay", "streams": 流 id 集合, "assigned": 本轮新分配数,
+#             "unresponsive_since": 汇总查询开始超时的时间（有应答时删除）}]
+workers = []
+# 流 id -> 工作进程序号（第一次出现时分配；流下线且没有观众等待后移除）
+owners = {}
+_owned_at = {}  # 流 id -> 分配时间（time.monotonic()）
+
+routes = web.RouteTableDef()
+
+
+def _spawn(worker):
+    worker["proc"] = subprocess.Popen([sys.executable, os.path.abspath(__file__), "worker", str(worker["port"])])
+    worker["started_at"] = time.monotonic()
+    print(f"[CLUSTER] 工作进程 #{worker['index']} 已启动 (port {worker['port']}, pid {worker['proc'].pid})")
+
+
+def _owner(stream_id):
+    """流 id 所属的工作进程，第一次出现时分配给当前流最少的"""
+    index = owners.get(stream_id)
+    if index is None:
+        worker = min(workers, key=lambda w: (len(w["streams"]) + w["assigned"], w["index"]))
+        worker["assigned"] += 1
+        index = owners[stream_id] = worker["index"]
+        _owned_at[stream_id] = time.monotonic()
+    return workers[index]
+
+
+async def _forward(request, worker, path, payload=None):
+    """把请求转发给工作进程，原样返回其应答。客户端断开时本协程被取消，转发的连接随之关闭。
+    工作进程正在启动 / 重启（连接被拒绝）时最多等待 WORKER_START_TIMEOUT 秒"""
+    headers = {"X-Forwarded-For": webrtc_server._client_ip(request)}
+    url = f"http://127.0.0.1:{worker['port']}{path}"
+    deadline = time.monotonic() + WORKER_START_TIMEOUT
+    try:
+        while True:
+            try:
+                async with request.app["client"].request(request.method, url, json=payload, headers=headers) as resp:
+                    body = await resp.read()
+                    return web.Response(body=body, status=resp.status, content_type=resp.content_type)
+            except aiohttp.ClientConnectorError:
+                # 请求尚未发出，重试是安全的
+                if time.monotonic() >= deadline:
+                    raise
+                await asyncio.sleep(0.1)
+    except aiohttp.ClientError as e:
+        print(f"[CLUSTER] 转发到工作进程 #{worker['index']} 失败: {e}")
+        return web.json_response({"error": "worker unavailable", "worker": worker["index"]}, status=503)
+
+
+async def _gather(client, path):
+    """向全部工作进程发 GET（每个最多 WORKER_QUERY_TIMEOUT 秒），返回 [(工作进程, JSON 或 None)]。
+    超时的工作进程记下开始不应答的时间，由 _supervise 判断是否卡死"""
+    async def fetch(worker):
+        try:
+            async with client.get(f"http://127.0.0.1:{worker['port']}{path}",
+                                  timeout=aiohttp.ClientTimeout(total=WORKER_QUERY_TIMEOUT)) as resp:
+                data = await resp.json()
+        except asyncio.TimeoutError:
+            worker.setdefault("unresponsive_since", time.monotonic())
+            return worker, None
+        except (aiohttp.ClientError, json.JSONDecodeError):
+            return worker, None
+        worker.pop("unresponsive_since", None)
+        return worker, data
+    return await asyncio.gather(*(fetch(worker) for worker in workers))
+
+
+@routes.post("/webrtc")
+async def route_publish(request):
+    """发布：按流 id（默认客户端 IP）转发给所属工作进程"""
+    payload = await webrtc_server._payload(request)
+    stream_id = webrtc_server._stream_id(payload, default=webrtc_server._client_ip(request))
+    if stream_id is None:
+        return web.json_response({"error": "invalid stream"}, status=400)
+    return await _forward(request, _owner(stream_id), "/webrtc", payload)
+
+
+@routes.post("/view")
+async def route_view(request):
+    """观看：转发给流所属的工作进程（流尚未发布时先分配，观众在该工作进程上等待）"""
+    payload = await webrtc_server._payload(request)
+    stream_id = webrtc_server._stream_id(payload)
+    if stream_id is None:
+        if webrtc_server._stream_given(payload):
+            return web.json_response({"error": "invalid stream"}, status=400)
+        # 兼容旧版单路发布：未指定时观看唯一的流
+        live = sorted(s for worker in workers for s in worker["streams"])
+        if len(live) != 1:
+            return web.json_response({"error": "stream required", "streams": live}, status=400)
+        stream_id = payload["stream"] = live[0]
+    return await _forward(request, _owner(stream_id), "/view", payload)
+
+
+@routes.post("/viewer/open")
+async def route_viewer_open(request):
+    payload = await webrtc_server._payload(request)
+    ip = webrtc_server._stream_id(payload)
+    if not ip:
+        return web.json_response({"viewer": True})
+    return await _forward(request, _owner(ip), "/viewer/open", payload)
+
+
+@routes.post("/viewer/close")
+async def route_viewer_close(request):
+    """观众离开：有流 id 时转发给所属工作进程；只有 session 时依次询问各工作进程"""
+    payload = await webrtc_server._payload(request)
+    ip = webrtc_server._stream_id(payload)
+    if ip in owners:
+        return await _forward(request, workers[owners[ip]], "/viewer/close", payload)
+    response = web.json_response({"error": "session not found"}, status=404)
+    for worker in workers:
+        response = await _forward(request, worker, "/viewer/close", payload)
+        if response.status != 404:
+            break
+    return response
+
+
+@routes.get("/streams")
+async def route_streams(request):
+    """全部工作进程上的流（带 worker 序号）"""
+    result = []
+    for worker, data in await _gather(request.app["client"], "/streams"):
+        for stream in (data or {}).get("streams", []):
+            result.append(dict(stream, worker=worker["index"]))
+    return web.json_response({"streams": result})
+
+
+@routes.get("/recordings")
+async def route_recordings(request):
+    result = {}
+    for _, data in await _gather(request.app["client"], "/recordings"):
+        result.update((data or {}).get("recordings", {}))
+    return web.json_response({"recordings": result})
+
+
+@routes.get("/connections")
+async def route_connections(request):
+    """各工作进程的连接数合计（上限按每个工作进程计算）"""
+    total = {"total": 0, "waiting": 0, "by_type": Counter(), "by_state": Counter(), "top_ips": Counter(),
+             "reaped": Counter(), "rejected": Counter()}
+    limits = None
+    for _, data in await _gather(request.app["client"], "/connections"):
+        if data is None:
+            continue
+        total["total"] += data["total"]
+        total["waiting"] += data["waiting"]
+        for key in ("by_type", "by_state", "reaped", "rejected"):
+            total[key].update(data[key])
+        total["top_ips"].update(dict(data["top_ips"]))
+        limits = data["limits"]
+    total["top_ips"] = total["top_ips"].most_common(10)
+    return web.json_response(dict(total, limits=dict(limits or {}, per_worker=True)))
+
+
+@routes.get("/stats")
+async def route_stats(request):
+    """各工作进程的连接质量统计：流与连接带 worker 序号合并，采样开销按工作进程分别列出；
+    ?connection= 时返回找到该连接的工作进程的结果"""
+    path = "/stats?" + request.query_string if request.query_string else "/stats"
+    results = await _gather(request.app["client"], path)
+    pc_id = request.query.get("connection")
+    if pc_id:
+        found = next((dict(data, worker=worker["index"]) for worker, data in results
+                      if data is not None and "error" not in data), None)
+        if found is None:
+            return web.json_response({"error": "connection not found", "connection": pc_id}, status=404)
+        return web.json_response(found)
+    merged = {"streams": [], "connections": [], "collectors": []}
+    for worker, data in results:
+        if data is None:
+            continue
+        merged["streams"] += [dict(stream, worker=worker["index"]) for stream in data["streams"]]
+        merged["connections"] += [dict(conn, worker=worker["index"]) for conn in data["connections"]]
+        merged["collectors"].append(dict(data["collector"], worker=worker["index"]))
+        merged.update(interval=data["interval"], max_samples=data["max_samples"])
+    return web.json_response(merged)
+
+
+@routes.get("/metrics")
+async def route_metrics(request):
+    """各工作进程的观看统计（计数与等待数合计，耗时分布按全部样本计算）以及工作进程状态"""
+    now = time.monotonic()
+    totals = {"views": 0, "timeouts": 0, "rejected": 0, "cancelled": 0, "waiting": 0}
+    wait_samples, ttff_samples = [], []
+    status = []
+    for worker, data in await _gather(request.app["client"], "/metrics?samples=1"):
+        for key in totals:
+            totals[key] += (data or {}).get(key, 0)
+        if data is not None:
+            wait_samples += data.pop("wait_samples", [])
+            ttff_samples += data.pop("ttff_samples", [])
+        status.append({
+            "index": worker["index"], "port": worker["port"], "pid": worker["proc"].pid,
+            "alive": worker["proc"].poll() is None, "restarts": worker["restarts"],
+            "uptime": round(now - worker["started_at"], 1), "streams": len(worker["streams"]),
+            "assigned": sum(1 for index in owners.values() if index == worker["index"]), "metrics": data,
+        })
+    return web.json_response(dict(totals, wait=webrtc_server._summary(wait_samples),
+                                  ttff=webrtc_server._summary(ttff_samples), workers=status))
+
+
+@routes.get("/preview")
+async def route_preview(request):
+    return web.Response(text=webrtc_server.PREVIEW_HTML, content_type="text/html")
+
+
+async def _supervise(app):
+    """重启退出或卡死的工作进程，刷新各工作进程上的流（用于分配新流），并移除已下线流的分配"""
+    while True:
+        await asyncio.sleep(WORKER_CHECK_INTERVAL)
+        now = time.monotonic()
+        for worker in workers:
+            code = worker["proc"].poll()
+            if code is None:
+                if now - worker.get("unresponsive_since", now) >= WORKER_HANG_SECONDS:
+                    print(f"[CLUSTER] 工作进程 #{worker['index']} {WORKER_HANG_SECONDS} 秒无应答，强制结束")
+                    worker["proc"].kill()
+                    worker.pop("unresponsive_since", None)
+                continue
+            if "restart_at" not in worker:
+                # 重启后很快又退出的视为频繁崩溃，重启间隔加倍
+                crashing = worker["restarts"] and now - worker["started_at"] < WORKER_STABLE_SECONDS
+                worker["delay"] = min(worker["delay"] * 2, WORKER_RESTART_MAX_DELAY) if crashing else WORKER_RESTART_DELAY
+                worker["restart_at"] = now + worker["delay"]
+                worker["streams"] = set()
+                print(f"[CLUSTER] 工作进程 #{worker['index']} 已退出 (code {code})，{worker['delay']:.0f} 秒后重启")
+            elif now >= worker["restart_at"]:
+                del worker["restart_at"]
+                worker["restarts"] += 1
+                _spawn(worker)
+        live = {}
+        for worker, data in await _gather(app["client"], "/streams"):
+            if data is not None:
+                worker["streams"] = {stream["stream"] for stream in data.get("streams", [])}
+                worker["assigned"] = 0
+                live[worker["index"]] = worker["streams"] | set(data.get("waiting", []))
+        now = time.monotonic()
+        for stream_id, index in list(owners.items()):
+            # 只按应答了的工作进程判断；刚分配的流可能还在转发途中
+            if index in live and stream_id not in live[index] and now - _owned_at[stream_id] >= OWNER_GRACE_SECONDS:
+                del owners[stream_id], _owned_at[stream_id]
+
+
+async def _on_startup(app):
+    app["client"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0),
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=WORKER_CONNECT_TIMEOUT),
+    )
+    app["supervisor"] = asyncio.ensure_future(_supervise(app))
+
+
+async def _on_shutdown(app):
+    """退出时停止工作进程（各自关闭连接、写完录制与 webrtc_direct 后退出）"""
+    app["supervisor"].cancel()
+    for worker in workers:
+        worker["proc"].terminate()
+    loop = asyncio.get_running_loop()
+    for worker in workers:
+        try:
+            await loop.run_in_executor(None, worker["proc"].wait, 60)
+        except subprocess.TimeoutExpired:
+            worker["proc"].kill()
+    await app["client"].close()
+
+
+def run(port, n=None):
+    """启动 n 个工作进程与对外端口上的路由并阻塞"""
+    n = n or WEBRTC_WORKERS
+    base = WEBRTC_WORKER_PORT or port + 1
+    workers[:] = [{"index": i, "port": base + i, "restarts": 0, "delay": WORKER_RESTART_DELAY, "streams": set(),
+                   "assigned": 0} for i in range(n)]
+    owners.clear()
+    _owned_at.clear()
+    for worker in workers:
+        _spawn(worker)
+    app = web.Application(middlewares=[webrtc_server.cors_middleware, webrtc_server.error_middleware],
+                          client_max_size=webrtc_server.MAX_BODY_SIZE)
+    app.add_routes(routes)
+    app.on_startup.append(_on_startup)
+    app.on_shutdown.append(_on_shutdown)
+    print(f"🚀 启动 WebRTC 路由 (port {port})，{n} 个工作进程 (port {base}-{base + n - 1})")
+    web.run_app(app, host="0.0.0.0", port=port, handler_cancellation=True, print=None)
+
+
+async def _watch_parent(app):
+    parent = os.getppid()
+
+    async def watch():
+        while os.getppid() == parent:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+        print("[CLUSTER] 主进程已退出，工作进程退出")
+        # 与 kill -TERM 相同，由 run_app 正常关闭连接后退出
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    app["watch_parent"] = asyncio.ensure_future(watch())
+
+
+def run_worker(port):
+    """工作进程：只在 127.0.0.1 上运行完整的 webrtc_server 应用"""
+    app = webrtc_server.create_app()
+    app.on_startup.append(_watch_parent)
+    web.run_app(app, host="127.0.0.1", port=port, handler_cancellation=True, print=None)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "worker":
+        run_worker(int(sys.argv[2]))
+    else:
+        print("用法: python webrtc_cluster.py worker <端口>（由 webrtc_server 在 WEBRTC_WORKERS > 1 时启动）")
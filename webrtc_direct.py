@@ -0,0 +1,156 @@
+"""
+WebRTC 直连状态通道
+------------------
+观众进入 / 离开时 webrtc_server 需要更新 folders.webrtc_direct（抓取端通过心跳得知是否需要发布）。
+更新只写入内存（同一 IP 只保留最新值），请求处理不等待；后台线程把一段时间内的更新合并成一批写出：
+
+- 默认通过共享数据库层直接写 SQLite（与 backend 同一个数据库文件），一批一个事务。
+  backend 每次批量写心跳后重新加载客户端配置，最多 HEARTBEAT_FLUSH_INTERVAL 秒后在心跳应答中生效
+- 数据库不可用（文件不存在、锁等待超时等）或 WEBRTC_DIRECT_MODE=http 时，
+  改为 HTTP PATCH backend（复用同一个 keep-alive 连接）
+- 都失败时留在内存中，WEBRTC_DIRECT_RETRY 秒后重试（期间的新值会覆盖旧值）
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from urllib.parse import quote
+
+import requests
+
+import database
+import db_manage
+
+# auto：先写数据库，失败时走 HTTP；http：只走 HTTP（webrtc_server 与 backend 不在同一台机器时）
+WEBRTC_DIRECT_MODE = os.environ.get("WEBRTC_DIRECT_MODE", "auto").lower()
+BACKEND_URL = os.environ.get("BACKEND_URL", "http://127.0.0.1:5000").rstrip("/")
+# 收到更新后再等待多久一起写出（秒），合并同一时刻的多次进入 / 离开；写入失败后的重试间隔（秒）
+WEBRTC_DIRECT_BATCH_DELAY = 0.05
+WEBRTC_DIRECT_RETRY = 5
+WEBRTC_DIRECT_HTTP_TIMEOUT = 2
+
+UPSERT_SQL = (
+    'INSERT INTO folders (ip, upload_enabled, webrtc_direct) VALUES (?, 1, ?) '
+    'ON CONFLICT(ip) DO UPDATE SET webrtc_direct = excluded.webrtc_direct'
+)
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()  # 同一时间只写出一批，避免旧值晚于新值写入
+_pending = {}            # ip -> 待写出的 webrtc_direct
+_in_flight = 0           # 正在写出的条数
+_wakeup = threading.Event()
+_db_path = None
+_http = None
+_started = False
+
+stats = {"updates": 0, "batches": 0, "written_db": 0, "written_http": 0, "failures": 0, "last_error": None}
+
+
+def update(ip, enabled):
+    """登记一次更新（立即返回）"""
+    with _lock:
+        _pending[ip] = bool(enabled)
+        stats["updates"] += 1
+    _wakeup.set()
+
+
+def _write_db(updates):
+    # 数据库文件不存在时不能让 sqlite3 新建一个空库
+    if not os.path.exists(_db_path or db_manage.DB_PATH):
+        raise sqlite3.OperationalError("database not found")
+    db = database.get(_db_path or db_manage.DB_PATH)
+    try:
+        with database.transaction(db):
+            db.executemany(UPSERT_SQL, [(ip, int(enabled)) for ip, enabled in updates.items()])
+    finally:
+        database.release(db)
+
+
+def _write_http(updates):
+    """逐个 PATCH，遇到第一个失败即停止。返回 (未写出的部分, 错误或 None)"""
+    global _http
+    if _http is None:
+        _http = requests.Session()
+    remaining = dict(updates)
+    try:
+        for ip, enabled in updates.items():
+            resp = _http.patch(f"{BACKEND_URL}/api/folders/{quote(ip, safe='')}/webrtc_direct",
+                               json={"webrtc_direct": enabled}, timeout=WEBRTC_DIRECT_HTTP_TIMEOUT)
+            resp.raise_for_status()
+            del remaining[ip]
+    except requests.RequestException as e:
+        return remaining, e
+    return remaining, None
+
+
+def flush():
+    """写出当前积压的更新，返回写出的条数；失败的放回内存（不覆盖期间的新值）"""
+    global _in_flight
+    with _flush_lock:
+        with _lock:
+            updates = dict(_pending)
+            _pending.clear()
+            _in_flight = len(updates)
+        if not updates:
+            return 0
+        try:
+            return _write(updates)
+        finally:
+            with _lock:
+                _in_flight = 0
+
+
+def _write(updates):
+    """写出一批：先写数据库，不可用时走 HTTP"""
+    stats["batches"] += 1
+    if WEBRTC_DIRECT_MODE != "http":
+        try:
+            _write_db(updates)
+            stats["written_db"] += len(updates)
+            return len(updates)
+        except sqlite3.Error as e:
+            stats["last_error"] = f"db: {e}"
+    remaining, error = _write_http(updates)
+    if error is not None:
+        stats["last_error"] = f"http: {error}"
+    stats["written_http"] += len(updates) - len(remaining)
+    if remaining:
+        stats["failures"] += 1
+        with _lock:
+            for ip, enabled in remaining.items():
+                _pending.setdefault(ip, enabled)
+    return len(updates) - len(remaining)
+
+
+def _loop():
+    while True:
+        _wakeup.wait()
+        time.sleep(WEBRTC_DIRECT_BATCH_DELAY)
+        _wakeup.clear()
+        try:
+            flush()
+        except Exception as e:
+            stats["last_error"] = str(e)
+            print(f"[WEBRTC_DIRECT] 写出失败: {e}")
+        with _lock:
+            retry = bool(_pending)
+        if retry and not _wakeup.is_set():
+            print(f"[WEBRTC_DIRECT] 数据库与 backend 都不可用，{WEBRTC_DIRECT_RETRY} 秒后重试: {stats['last_error']}")
+            time.sleep(WEBRTC_DIRECT_RETRY)
+            _wakeup.set()
+
+
+def start(db_path=None):
+    """启动后台写出线程（每个进程一次）。db_path 默认与 backend 相同（db_manage.DB_PATH）"""
+    global _db_path, _started
+    if _started:
+        return
+    _db_path = db_path
+    threading.Thread(target=_loop, name="webrtc-direct", daemon=True).start()
+    _started = True
+
+
+def status():
+    with _lock:
+        return dict(stats, pending=len(_pending), in_flight=_in_flight, mode=WEBRTC_DIRECT_MODE)
@@ -1,51 +1,105 @@
 """
 WebRTC 服务器 - 用于视频直播点看功能
+
+每个抓取端（发布者）按流 id 登记（默认为抓取端 IP），各自使用独立的 MediaRelay；
+观众通过流 id 观看指定抓取端，每个观众单独订阅一路中继轨，关闭时只释放自己的会话。
+发布端尚未上线时观众在该流的 asyncio.Event 上等待，发布后立即唤醒；同时等待的观众数有上限，
+观众断开 HTTP 连接时取消等待。/metrics 返回等待耗时与首帧时间（TTFF）统计。
+开启录制时（RECORD_LIVE 或发布请求的 record 字段）另订阅一路中继视频轨交给 recorder 分段写入 uploads/<流 id>/。
+开启 WEBRTC_FANOUT 时，同一流的观众按编码配置共享一个视频编码器（见 fanout），不再每个观众各编码一次。
+每个连接登记到 lifecycle：协商超时、失败、对端消失与长时间无媒体的连接由后台任务关闭，
+新建连接受每 IP 与总数上限约束（429 / 503），/connections 返回当前连接数。
+qos 在后台定期采样每个连接的 getStats()，/stats 返回按流与按连接的码率、帧率、丢包率、抖动与往返时延。
+
+信令接口由 aiohttp 提供，与 aiortc 运行在同一个事件循环上：请求处理不占用线程，
+等待中的观众只是一个挂起的协程。会话保存在进程内；设置 WEBRTC_WORKERS > 1 时由 webrtc_cluster
+启动多个本服务的工作进程，每个流固定在一个工作进程上，对外端口只做信令路由。
 """
-from flask import Flask, request, jsonify, render_template_string
-from flask_cors import CORS
-from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiohttp import web
+from aiortc import RTCPeerConnection, RTCSessionDescription, MediaStreamTrack
 from aiortc.contrib.media import MediaRelay
 import asyncio
-import threading
-import requests
+import json
+import os
+import secrets
 import time
+from collections import deque
 from datetime import datetime
 
-app = Flask(__name__)
-CORS(app)
-
-# 全局：发布者轨道中继与连接集合
-relay = MediaRelay()
-pcs = set()
-pc_info = {}  # {pc_id: {"type": "publisher/viewer", "ip": "...", "created_at": timestamp, "remote_addr": "..."}}
-published = {"video": None, "audio": None}
-VIEWER_ACTIVE = False
-
-# 全局常驻事件循环（在线程中运行），承载所有 aiortc 会话
-_loop = asyncio.new_event_loop()
-
-def _loop_runner(loop: asyncio.AbstractEventLoop):
-    asyncio.set_event_loop(loop)
-    loop.run_forever()
-
-_loop_thread = threading.Thread(target=_loop_runner, args=(_loop,), daemon=True)
-_loop_thread.start()
-
-
-@app.errorhandler(Exception)
-def handle_exception(err):
+import fanout
+import lifecycle
+import qos
+import recorder
+import webrtc_direct
+
+WEBRTC_PORT = 8080
+# 同时等待发布端上线的观众数上限（等待中的观众只占一个协程与一个 HTTP 连接）
+VIEW_MAX_WAITING = int(os.environ.get("VIEW_MAX_WAITING", 1000))
+# 请求体上限（SDP 通常只有几 KB）
+MAX_BODY_SIZE = 256 * 1024
+# 等待耗时 / 首帧时间各保留最近多少个样本
+METRICS_SAMPLES = 1000
+# 受信任的反向代理地址（逗号分隔）：只有来自这些地址的请求才采信 X-Forwarded-For。
+# 默认为本机，包括 webrtc_cluster 的路由进程
+TRUSTED_PROXIES = {p.strip() for p in os.environ.get("WEBRTC_TRUSTED_PROXIES", "127.0.0.1,::1").split(",") if p.strip()}
+
+# 会话：{pc_id: RTCPeerConnection}，pc_id 为随机串（同时作为观众关闭时使用的 session）
+pcs = {}
+pc_info = {}  # {pc_id: {"type": "publisher/viewer", "ip": "...", "stream": "...", "created_at": timestamp, "remote_addr": "..."}}
+# 发布流注册表：{stream_id: {"publisher": pc_id, "relay": MediaRelay, "tracks": {kind: 源轨}, "viewers": {pc_id},
+#                              "created_at", "recording": 录制任务或 None, "fanout": {编码配置: 共享编码状态}}}
+# 只在事件循环线程中修改
+streams = {}
+# 等待发布的观众：{stream_id: asyncio.Event}，有观众等待时才存在；发布（收到第一条轨）时 set，流下线时 clear
+_publish_events = {}
+_waiting = 0
+
+# 观看统计：计数与最近的等待耗时、首帧时间（秒）
+metrics = {"views": 0, "timeouts": 0, "rejected": 0, "cancelled": 0}
+_wait_samples = deque(maxlen=METRICS_SAMPLES)
+_ttff_samples = deque(maxlen=METRICS_SAMPLES)
+
+routes = web.RouteTableDef()
+JSON_PATHS = ("/webrtc", "/view", "/viewer/open", "/viewer/close", "/streams", "/metrics", "/recordings",
+              "/connections", "/stats")
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """允许跨域访问（预检请求直接应答）"""
+    if request.method == "OPTIONS":
+        response = web.Response()
+    else:
+        response = await handler(request)
+    response.headers["Access-Control-Allow-Origin"] = request.headers.get("Origin", "*")
+    response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+    response.headers["Access-Control-Allow-Headers"] = request.headers.get("Access-Control-Request-Headers", "Content-Type")
+    response.headers["Vary"] = "Origin"
+    return response
+
+
+@web.middleware
+async def error_middleware(request, handler):
     """统一错误为 JSON，便于前端处理。仅针对 webrtc 相关路径。"""
-    path = request.path or ""
-    if path in ("/webrtc", "/view", "/viewer/open", "/viewer/close"):
-        status = getattr(err, 'code', 500)
-        return jsonify({"error": str(err)}), status
-    # 其它路径保持默认（HTML）
-    raise err
-
-def _run_async(coro):
-    """在线程常驻事件循环上同步执行协程，返回结果。"""
-    fut = asyncio.run_coroutine_threadsafe(coro, _loop)
-    return fut.result()
+    try:
+        return await handler(request)
+    except web.HTTPException as err:
+        if request.path not in JSON_PATHS or err.status < 400:
+            raise
+        return web.json_response({"error": err.reason}, status=err.status)
+    except Exception as err:
+        if request.path not in JSON_PATHS:
+            raise
+        return web.json_response({"error": str(err)}, status=500)
+
+
+async def _payload(request):
+    """请求 JSON 对象；不是合法 JSON 对象时返回空 dict"""
+    try:
+        payload = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return {}
+    return payload if isinstance(payload, dict) else {}
 
 
 def _log_connection(level, pc_id, msg, **kwargs):
@@ -59,21 +113,34 @@ def _log_connection(level, pc_id, msg, **kwargs):
     print(f"[{timestamp}] [{level}] [WebRTC-{conn_type.upper()}] PC#{pc_id[:8]} IP={ip} Remote={remote} | {msg} {extra}".strip())
 
 
-def _setup_pc_logging(pc, pc_id, conn_type, ip=None, remote_addr=None):
-    """为 PeerConnection 设置状态监听和日志"""
+def _register_info(pc_id, conn_type, ip=None, remote_addr=None, stream_id=None):
+    """登记会话信息（日志与 /viewer/close 使用）"""
     pc_info[pc_id] = {
         "type": conn_type,
         "ip": ip or "N/A",
+        "stream": stream_id,
         "remote_addr": remote_addr or "N/A",
         "created_at": time.time()
     }
+
+
+def _setup_pc_logging(pc, pc_id, conn_type, ip=None, remote_addr=None, stream_id=None):
+    """为 PeerConnection 设置状态监听和日志，并登记到 lifecycle 与 qos"""
+    if pc_id not in pc_info:
+        _register_info(pc_id, conn_type, ip=ip, remote_addr=remote_addr, stream_id=stream_id)
+    lifecycle.track(pc_id, pc, conn_type, ip or remote_addr)
+    qos.track(pc_id, pc, conn_type, stream_id)
     
     @pc.on("connectionstatechange")
-    def on_connection_state_change():
+    async def on_connection_state_change():
         state = pc.connectionState
         _log_connection("INFO", pc_id, f"连接状态变化: {state}")
+        lifecycle.state_changed(pc_id, state)
         
-        if state == "closed":
+        if state == "failed":
+            await pc.close()
+        elif state == "closed":
+            _forget_pc(pc_id)
             info = pc_info.pop(pc_id, {})
             duration = time.time() - info.get("created_at", time.time())
             _log_connection("INFO", pc_id, f"连接已关闭 | 持续时间: {duration:.2f}秒", 
@@ -90,121 +157,392 @@ def _setup_pc_logging(pc, pc_id, conn_type, ip=None, remote_addr=None):
         _log_connection("DEBUG", pc_id, f"信令状态: {state}")
 
 
-@app.route("/webrtc", methods=["POST"])
-def webrtc_publish():
-    """发布接口：客户端（屏幕抓取端）发送 Offer，服务器保存上行轨并返回 Answer"""
-    payload = request.json or {}
+def _client_ip(request):
+    """客户端 IP（每 IP 连接上限与默认流 id 用）：直连时为对端地址；对端是受信任的代理时，
+    取 X-Forwarded-For 中从右往左第一个不是受信任代理的地址（左侧的条目可由客户端任意填写）"""
+    ip = request.remote
+    if ip not in TRUSTED_PROXIES:
+        return ip
+    for hop in reversed(request.headers.get("X-Forwarded-For", "").split(",")):
+        hop = hop.strip()
+        if hop:
+            ip = hop
+            if hop not in TRUSTED_PROXIES:
+                break
+    return ip
+
+
+def _stream_id(payload, default=None):
+    """请求中的流 id（stream，兼容 ip 字段），不合法时返回 None。
+    流 id 会用作录制的文件夹名，只允许 recorder.NAME_PATTERN 中的字符（不能以点开头），最长 recorder.NAME_MAX_LEN"""
+    stream_id = payload.get("stream") or payload.get("ip") or default
+    if not recorder.valid_name(stream_id) or stream_id == "-":
+        return None
+    return stream_id
+
+
+def _stream_given(payload):
+    """请求是否指定了流 id。"-" 是预览页未带 ?ip= 时的占位，与未指定相同"""
+    return (payload.get("stream") or payload.get("ip")) not in (None, "", "-")
+
+
+def _forget_pc(pc_id):
+    """连接关闭后从注册表移除（事件循环线程中调用）。发布者断开时关闭该流的全部观众"""
+    pcs.pop(pc_id, None)
+    lifecycle.forget(pc_id)
+    qos.forget(pc_id)
+    info = pc_info.get(pc_id, {})
+    stream = streams.get(info.get("stream"))
+    if stream is None:
+        return
+    if info.get("type") == "viewer":
+        stream["viewers"].discard(pc_id)
+    elif stream["publisher"] == pc_id:
+        streams.pop(info["stream"], None)
+        event = _publish_events.get(info["stream"])
+        if event is not None:
+            event.clear()
+        for viewer_id in list(stream["viewers"]):
+            viewer = pcs.get(viewer_id)
+            if viewer:
+                asyncio.ensure_future(viewer.close())
+
+
+async def _close_pc(pc_id):
+    pc = pcs.get(pc_id)
+    if pc is not None:
+        await pc.close()
+        # close() 之后 connectionstatechange 回调会清理注册表，这里再确保一次
+        _forget_pc(pc_id)
+
+
+async def _reap_pc(pc_id, reason):
+    """lifecycle 判定应关闭的连接（协商超时 / 失败 / 断开 / 空闲）"""
+    _log_connection("WARN", pc_id, f"关闭连接: {reason}")
+    await _close_pc(pc_id)
+
+
+def _admit(ip):
+    """连接数超出上限时返回拒绝应答（每 IP 429，总数 503），否则返回 None"""
+    rejection = lifecycle.admit(ip)
+    if rejection is None:
+        return None
+    status, body = rejection
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] [WARN] [LIFECYCLE] IP={ip} | 拒绝新连接: {body['error']}")
+    return web.json_response(body, status=status)
+
+
+@routes.post("/webrtc")
+async def webrtc_publish(request):
+    """发布接口：客户端（屏幕抓取端）发送 Offer，服务器登记上行轨并返回 Answer。
+
+    请求 JSON：{"sdp", "type", "stream": 可选，默认为客户端 IP, "record": 是否在服务端录制，默认 RECORD_LIVE}。
+    同一流 id 重新发布时替换旧的发布者。连接数超出上限时返回 429（每 IP）/ 503（总数）。
+    """
+    payload = await _payload(request)
     offer_sdp = payload.get("sdp")
     offer_type = payload.get("type", "offer")
     if not offer_sdp:
-        return jsonify({"error": "missing sdp"}), 400
+        return web.json_response({"error": "missing sdp"}, status=400)
+    remote_addr = request.remote
+    ip = _client_ip(request)
+    stream_id = _stream_id(payload, default=ip)
+    if stream_id is None:
+        return web.json_response({"error": "invalid stream"}, status=400)
+    record = bool(payload.get("record", recorder.RECORD_LIVE))
+    rejection = _admit(ip)
+    if rejection is not None:
+        return rejection
 
     pc = RTCPeerConnection()
-    pc_id = id(pc)
-    remote_addr = request.remote_addr
-    
-    # 从 SDP 或请求中提取 IP（可选）
-    ip = request.headers.get("X-Forwarded-For", "").split(",")[0].strip() or remote_addr
+    pc_id = secrets.token_hex(8)
     
-    _setup_pc_logging(pc, str(pc_id), "publisher", ip=ip, remote_addr=remote_addr)
-    pcs.add(pc)
-    _log_connection("INFO", str(pc_id), "创建发布者连接")
+    _setup_pc_logging(pc, pc_id, "publisher", ip=ip, remote_addr=remote_addr, stream_id=stream_id)
+    pcs[pc_id] = pc
+    _log_connection("INFO", pc_id, "创建发布者连接", stream=stream_id)
 
     @pc.on("track")
     def on_track(track):
-        _log_connection("INFO", str(pc_id), f"收到发布者媒体轨: kind={track.kind}")
-        if track.kind == "video":
-            published["video"] = relay.subscribe(track)
-            _log_connection("INFO", str(pc_id), "视频轨已发布并订阅")
-        elif track.kind == "audio":
-            published["audio"] = relay.subscribe(track)
-            _log_connection("INFO", str(pc_id), "音频轨已发布并订阅")
-
-    async def handle():
-        _log_connection("INFO", str(pc_id), "开始 SDP 协商")
-        await pc.setRemoteDescription(RTCSessionDescription(sdp=offer_sdp, type=offer_type))
-        answer = await pc.createAnswer()
-        await pc.setLocalDescription(answer)
-        _log_connection("INFO", str(pc_id), "SDP 协商完成，返回 Answer")
-        return pc.localDescription
+        _log_connection("INFO", pc_id, f"收到发布者媒体轨: kind={track.kind}")
+        stream = streams.get(stream_id)
+        if stream is not None and stream["publisher"] == pc_id and track.kind in ("video", "audio"):
+            if track.kind == "video":
+                # 统计中继取走的帧数（qos 帧率）
+                track = MeteredTrack(track)
+                qos.meter(pc_id, track)
+            stream["tracks"][track.kind] = track
+            _log_connection("INFO", pc_id, f"{track.kind} 轨已发布", stream=stream_id)
+            if record and track.kind == "video":
+                # 录制单独订阅一路：编码在 recorder 的工作线程中进行，不拖慢观众
+                stream["recording"] = asyncio.ensure_future(
+                    recorder.record(stream_id, stream["relay"].subscribe(track, buffered=False)))
+            # 唤醒等待该流的观众
+            event = _publish_events.get(stream_id)
+            if event is not None:
+                event.set()
+
+    # 替换同一流 id 的旧发布者（抓取端重连）：旧连接及其观众一并关闭
+    old = streams.get(stream_id)
+    streams[stream_id] = {
+        "publisher": pc_id, "relay": MediaRelay(), "tracks": {}, "viewers": set(), "created_at": time.time(),
+        "recording": None, "fanout": {},
+    }
+    if old is not None:
+        _log_connection("INFO", pc_id, "替换旧发布者", stream=stream_id, old=old["publisher"][:8])
+        for old_id in [old["publisher"], *old["viewers"]]:
+            old_pc = pcs.get(old_id)
+            if old_pc:
+                asyncio.ensure_future(old_pc.close())
+        # 新发布者收到轨之前，等待中的观众继续等待
+        event = _publish_events.get(stream_id)
+        if event is not None:
+            event.clear()
 
     try:
-        local_desc = _run_async(handle())
-        return jsonify({"sdp": local_desc.sdp, "type": local_desc.type})
-    except Exception as e:
-        _log_connection("ERROR", str(pc_id), f"发布协商失败: {e}")
+        _log_connection("INFO", pc_id, "开始 SDP 协商")
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=offer_sdp, type=offer_type))
+        await pc.setLocalDescription(await pc.createAnswer())
+        _log_connection("INFO", pc_id, "SDP 协商完成，返回 Answer")
+    except BaseException as e:
+        # 协商失败或客户端断开（取消）：关闭连接，不阻塞取消
+        _log_connection("ERROR", pc_id, f"发布协商失败: {e!r}")
+        asyncio.ensure_future(_close_pc(pc_id))
         raise
-
-
-@app.route("/view", methods=["POST"])
-def webrtc_view():
-    """观看接口：观众端发送 Offer，服务器把已发布轨添加后返回 Answer"""
-    payload = request.json or {}
+    return web.json_response({"sdp": pc.localDescription.sdp, "type": pc.localDescription.type,
+                              "stream": stream_id, "session": pc_id})
+
+
+def _published(stream_id):
+    """流 id 对应的已发布流（至少收到一条轨），没有时返回 None"""
+    stream = streams.get(stream_id)
+    return stream if stream is not None and stream["tracks"] else None
+
+
+async def _wait_published(stream_id, timeout):
+    """等待流发布，timeout 为 None 时无限等待；超时返回 False。协程被取消（观众断开）时同样清理登记"""
+    global _waiting
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    event = _publish_events.get(stream_id)
+    if event is None:
+        event = _publish_events[stream_id] = asyncio.Event()
+        event.waiters = 0
+    event.waiters += 1
+    _waiting += 1
+    try:
+        # 唤醒后重新检查：set 与观众运行之间发布者可能又断开了
+        while not _published(stream_id):
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+    finally:
+        _waiting -= 1
+        event.waiters -= 1
+        if event.waiters == 0 and _publish_events.get(stream_id) is event:
+            del _publish_events[stream_id]
+
+
+class MeteredTrack(MediaStreamTrack):
+    """透传轨，统计被取走的帧数（qos 帧率）；第一帧被取走（开始发送给观众）时回调一次，用于统计首帧时间"""
+
+    def __init__(self, source, on_first_frame=None):
+        super().__init__()
+        self.kind = source.kind
+        self._source = source
+        self._on_first_frame = on_first_frame
+        self.frames = 0
+
+    async def recv(self):
+        frame = await self._source.recv()
+        self.frames += 1
+        if self._on_first_frame is not None:
+            callback, self._on_first_frame = self._on_first_frame, None
+            callback()
+        return frame
+
+    def stop(self):
+        super().stop()
+        self._source.stop()
+
+
+def _summary(samples):
+    """样本（秒）的数量与 p50 / p95 / 最大值（毫秒）"""
+    values = sorted(samples)
+    if not values:
+        return {"count": 0}
+    pick = lambda q: round(values[min(len(values) - 1, int(len(values) * q))] * 1000, 1)
+    return {"count": len(values), "p50_ms": pick(0.5), "p95_ms": pick(0.95), "max_ms": round(values[-1] * 1000, 1)}
+
+
+@routes.post("/view")
+async def webrtc_view(request):
+    """观看接口：观众端发送 Offer，服务器把指定流的中继轨添加后返回 Answer。
+
+    请求 JSON：{"sdp", "type", "stream": 流 id（抓取端 IP）, "timeout": 等待发布端上线的秒数，<=0 无限等待,
+    "bitrate": 共享编码时希望的视频码率（bps，取不超过它的最高档）}。
+    只有一个流在发布时可省略 stream。返回的 session 用于 /viewer/close。
+    等待的观众超过 VIEW_MAX_WAITING 时返回 503；等待期间客户端断开时请求被取消，不创建连接。
+    连接数超出上限时返回 429（每 IP）/ 503（总数），等待前后各检查一次。
+    """
+    started = time.monotonic()
+    payload = await _payload(request)
     offer_sdp = payload.get("sdp")
     offer_type = payload.get("type", "offer")
-    timeout_s = payload.get("timeout")
     if not offer_sdp:
-        return jsonify({"error": "missing sdp"}), 400
+        return web.json_response({"error": "missing sdp"}, status=400)
+    try:
+        timeout_s = float(payload.get("timeout") or 0)
+    except (TypeError, ValueError):
+        return web.json_response({"error": "invalid timeout"}, status=400)
+    timeout_s = timeout_s if timeout_s > 0 else None
+    try:
+        bitrate = int(payload.get("bitrate") or 0)
+    except (TypeError, ValueError):
+        return web.json_response({"error": "invalid bitrate"}, status=400)
+    # 共享编码的配置；Offer 中没有可共享编码的 codec 时该观众仍单独编码
+    profile = fanout.choose_profile(offer_sdp, bitrate) if fanout.WEBRTC_FANOUT else None
+    stream_id = _stream_id(payload)
+    if stream_id is None:
+        if _stream_given(payload):
+            return web.json_response({"error": "invalid stream"}, status=400)
+        # 兼容旧版单路发布：未指定时观看唯一的流
+        if len(streams) != 1:
+            return web.json_response({"error": "stream required", "streams": sorted(streams)}, status=400)
+        stream_id = next(iter(streams))
+
+    pc_id = secrets.token_hex(8)
+    remote_addr = request.remote
+    ip = _client_ip(request)
+    rejection = _admit(ip)
+    if rejection is not None:
+        return rejection
+
+    # 等待发布端上线：在该流的事件上等待，发布时立即唤醒。等待期间还没有 PeerConnection，
+    # 客户端断开时 aiohttp 取消本协程即可
+    if not _published(stream_id):
+        if _waiting >= VIEW_MAX_WAITING:
+            metrics["rejected"] += 1
+            return web.json_response({"error": "too many waiting viewers", "stream": stream_id}, status=503)
+        _register_info(pc_id, "viewer", ip=ip, remote_addr=remote_addr, stream_id=stream_id)
+        _log_connection("INFO", pc_id, "等待发布端上线...", stream=stream_id)
+        try:
+            published = await _wait_published(stream_id, timeout_s)
+        except asyncio.CancelledError:
+            metrics["cancelled"] += 1
+            _log_connection("INFO", pc_id, "观众已断开，取消等待")
+            pc_info.pop(pc_id, None)
+            raise
+        if not published:
+            metrics["timeouts"] += 1
+            _log_connection("WARN", pc_id, f"等待超时，无发布轨可用 | 等待时长: {time.monotonic() - started:.2f}秒")
+            pc_info.pop(pc_id, None)
+            return web.json_response({"error": "no published tracks", "stream": stream_id}, status=409)
+        _log_connection("INFO", pc_id, f"发布端已上线，等待耗时: {time.monotonic() - started:.2f}秒")
+        rejection = _admit(ip)
+        if rejection is not None:
+            pc_info.pop(pc_id, None)
+            return rejection
+    _wait_samples.append(time.monotonic() - started)
 
     pc = RTCPeerConnection()
-    pc_id = id(pc)
-    remote_addr = request.remote_addr
-    ip = request.headers.get("X-Forwarded-For", "").split(",")[0].strip() or remote_addr
-    
-    _setup_pc_logging(pc, str(pc_id), "viewer", ip=ip, remote_addr=remote_addr)
-    pcs.add(pc)
-    _log_connection("INFO", str(pc_id), "创建观众连接")
-
-    async def handle():
-        # 等待发布端上线（timeout<=0 表示无限等待）
-        if not (published["video"] or published["audio"]):
-            _log_connection("INFO", str(pc_id), "等待发布端上线...")
-            loop = asyncio.get_running_loop()
-            if timeout_s is None or float(timeout_s) <= 0:
-                # 无限等待，直至有发布轨
-                wait_start = time.time()
-                while not (published["video"] or published["audio"]):
-                    await asyncio.sleep(0.2)
-                wait_duration = time.time() - wait_start
-                _log_connection("INFO", str(pc_id), f"发布端已上线，等待耗时: {wait_duration:.2f}秒")
-            else:
-                deadline = loop.time() + float(timeout_s)
-                wait_start = time.time()
-                while not (published["video"] or published["audio"]) and loop.time() < deadline:
-                    await asyncio.sleep(0.2)
-                if not (published["video"] or published["audio"]):
-                    wait_duration = time.time() - wait_start
-                    _log_connection("WARN", str(pc_id), f"等待超时，无发布轨可用 | 等待时长: {wait_duration:.2f}秒")
-                    return None
-                wait_duration = time.time() - wait_start
-                _log_connection("INFO", str(pc_id), f"发布端已上线，等待耗时: {wait_duration:.2f}秒")
-
-        # 将已发布轨添加到观众连接
-        tracks_added = []
-        if published["video"]:
-            pc.addTrack(published["video"])
-            tracks_added.append("video")
-        if published["audio"]:
-            pc.addTrack(published["audio"])
-            tracks_added.append("audio")
-        _log_connection("INFO", str(pc_id), f"已添加媒体轨: {', '.join(tracks_added)}")
-
-        _log_connection("INFO", str(pc_id), "开始 SDP 协商")
-        await pc.setRemoteDescription(RTCSessionDescription(sdp=offer_sdp, type=offer_type))
-        answer = await pc.createAnswer()
-        await pc.setLocalDescription(answer)
-        _log_connection("INFO", str(pc_id), "SDP 协商完成，返回 Answer")
-        return pc.localDescription
+    _setup_pc_logging(pc, pc_id, "viewer", ip=ip, remote_addr=remote_addr, stream_id=stream_id)
+    pcs[pc_id] = pc
+    _log_connection("INFO", pc_id, "创建观众连接", stream=stream_id)
+
+    def first_frame():
+        ttff = time.monotonic() - started
+        _ttff_samples.append(ttff)
+        _log_connection("INFO", pc_id, f"首帧已发送，TTFF: {ttff * 1000:.0f}ms", stream=stream_id)
 
     try:
-        local_desc = _run_async(handle())
-        if local_desc is None:
-            _log_connection("ERROR", str(pc_id), "协商失败: 无发布轨可用")
-            return jsonify({"error": "no published tracks"}), 409
-        return jsonify({"sdp": local_desc.sdp, "type": local_desc.type})
-    except Exception as e:
-        _log_connection("ERROR", str(pc_id), f"观看协商失败: {e}")
+        # 每个观众单独订阅一路中继轨（共用同一个中继轨时各观众会互相抢帧）；
+        # 不缓冲：观众消费慢时丢弃旧帧，延迟不累积
+        stream = _published(stream_id)
+        tracks = stream["tracks"]
+        timed = "video" if "video" in tracks else next(iter(tracks))
+        for kind, track in tracks.items():
+            if kind == "video" and profile is not None:
+                relayed = fanout.subscribe(stream, track, profile)
+            else:
+                relayed = stream["relay"].subscribe(track, buffered=False)
+            sent = MeteredTrack(relayed, first_frame) if kind == timed else relayed
+            if kind == "video":
+                qos.meter(pc_id, sent)
+            sender = pc.addTrack(sent)
+            if isinstance(relayed, fanout.PacketTrack):
+                fanout.attach(sender, relayed)
+                transceiver = next(t for t in pc.getTransceivers() if t.sender is sender)
+                transceiver.setCodecPreferences(fanout.codec_preferences(profile[0]))
+        stream["viewers"].add(pc_id)
+        _log_connection("INFO", pc_id, f"已添加媒体轨: {', '.join(tracks)}", stream=stream_id,
+                        fanout=f"{profile[0]}@{profile[1]}" if profile else "off")
+
+        _log_connection("INFO", pc_id, "开始 SDP 协商")
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=offer_sdp, type=offer_type))
+        await pc.setLocalDescription(await pc.createAnswer())
+        _log_connection("INFO", pc_id, "SDP 协商完成，返回 Answer")
+    except BaseException as e:
+        _log_connection("ERROR", pc_id, f"观看协商失败: {e!r}")
+        asyncio.ensure_future(_close_pc(pc_id))
         raise
+    metrics["views"] += 1
+    return web.json_response({"sdp": pc.localDescription.sdp, "type": pc.localDescription.type,
+                              "stream": stream_id, "session": pc_id})
+
+
+@routes.get("/streams")
+async def list_streams(request):
+    """当前发布中的流及其观众数、共享编码配置；waiting 为有观众在等待发布的流 id"""
+    now = time.time()
+    return web.json_response({"streams": [
+        {"stream": stream_id, "tracks": sorted(stream["tracks"]), "viewers": len(stream["viewers"]),
+         "uptime": round(now - stream["created_at"], 1), "recording": stream["recording"] is not None,
+         "fanout": fanout.status(stream)}
+        for stream_id, stream in streams.items()
+    ], "waiting": sorted(_publish_events)})
+
+
+@routes.get("/recordings")
+async def list_recordings(request):
+    """正在录制的流：已写分段数、收到 / 丢弃的帧数与待编码帧数"""
+    return web.json_response({"recordings": recorder.status()})
+
+
+@routes.get("/connections")
+async def list_connections(request):
+    """当前连接数（按类型 / 状态 / 来源 IP）、上限，以及被生命周期管理关闭 / 因上限拒绝的累计数"""
+    return web.json_response(dict(lifecycle.counts(), waiting=_waiting))
+
+
+@routes.get("/stats")
+async def connection_stats(request):
+    """连接质量：按流汇总与各连接最近一个采样间隔 / 整个缓冲区的码率、帧率、丢包率、抖动、往返时延，以及采样开销。
+    ?stream= 只返回该流；?connection=<session> 只返回该连接，另含每个采样间隔的数值"""
+    pc_id = request.query.get("connection")
+    if pc_id:
+        result = qos.summary(pc_id, history=True)
+        if result is None:
+            return web.json_response({"error": "connection not found", "connection": pc_id}, status=404)
+        return web.json_response(result)
+    return web.json_response(qos.status(request.query.get("stream")))
+
+
+@routes.get("/metrics")
+async def view_metrics(request):
+    """观看统计：当前等待数、计数，/view 到加入（wait）与到首帧发出（ttff）的耗时分布，webrtc_direct 写出情况。
+    带 ?samples=1 时另返回原始样本（秒），供 webrtc_cluster 汇总多个工作进程"""
+    result = dict(
+        metrics, waiting=_waiting, max_waiting=VIEW_MAX_WAITING,
+        wait=_summary(_wait_samples), ttff=_summary(_ttff_samples), webrtc_direct=webrtc_direct.status(),
+    )
+    if request.query.get("samples"):
+        result.update(wait_samples=list(_wait_samples), ttff_samples=list(_ttff_samples))
+    return web.json_response(result)
 
 
 PREVIEW_HTML = """
@@ -260,7 +598,8 @@ async function setupViewer(retryCount = 0) {
     const resp = await fetch('/view', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ sdp: pc.localDescription.sdp, type: pc.localDescription.type, timeout: 0 })
+      // 未带 ?ip= 时不指定流，观看唯一在发布的流
+      body: JSON.stringify({ sdp: pc.localDescription.sdp, type: pc.localDescription.type, stream: ip === '-' ? undefined : ip, timeout: 0 })
     });
 
     const answer = await resp.json();
@@ -268,12 +607,12 @@ async function setupViewer(retryCount = 0) {
 
     await pc.setRemoteDescription(answer);
 
-    // 离开页面时关闭连接
+    // 离开页面时只关闭本观众的会话
     const release = () => {
       fetch('/viewer/close', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ ip }),
+        body: JSON.stringify({ ip, session: answer.session }),
         keepalive: true
       }).catch(() => {});
       if (pc) pc.close();
@@ -300,98 +639,101 @@ setupViewer();
 """
 
 
-@app.route('/preview')
-def preview():
-    return render_template_string(PREVIEW_HTML)
+@routes.get("/preview")
+async def preview(request):
+    return web.Response(text=PREVIEW_HTML, content_type="text/html")
+
+
+def _set_webrtc_direct(ip, enabled, tag):
+    """更新该抓取端的 webrtc_direct（抓取端通过心跳得知是否需要发布）。
+    只登记到 webrtc_direct 状态通道，由其后台线程批量写出，不等待数据库或 backend"""
+    webrtc_direct.update(ip, enabled)
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{timestamp}] [INFO] [{tag}] IP={ip} | webrtc_direct -> {int(enabled)}")
+
 
-@app.route('/viewer/open', methods=['POST'])
-def viewer_open():
-    global VIEWER_ACTIVE
-    VIEWER_ACTIVE = True
+@routes.post("/viewer/open")
+async def viewer_open(request):
     # 从请求中获取 IP，更新后端 webrtc_direct=1
-    payload = request.json or {}
-    ip = payload.get("ip")
-    if ip and ip != '-':
-        try:
-            requests.patch(
-                f"http://127.0.0.1:5000/api/folders/{ip}/webrtc_direct",
-                json={"webrtc_direct": True},
-                timeout=2
-            )
-        except Exception as e:
-            print(f"[viewer/open] 更新 webrtc_direct 失败: {e}")
-    return jsonify({"viewer": True})
-
-
-@app.route('/viewer/close', methods=['POST'])
-def viewer_close():
-    global VIEWER_ACTIVE, published
-    payload = request.json or {}
-    ip = payload.get("ip", "N/A")
-    remote_addr = request.remote_addr
+    payload = await _payload(request)
+    ip = _stream_id(payload)
+    if ip:
+        _set_webrtc_direct(ip, True, "VIEWER_OPEN")
+    return web.json_response({"viewer": True})
+
+
+@routes.post("/viewer/close")
+async def viewer_close(request):
+    """观众离开：只关闭该观众的会话（session）；未传 session 时关闭该流的全部观众。
+    流上已没有观众时关闭发布者，并通知抓取端停止发布（webrtc_direct=0）"""
+    payload = await _payload(request)
+    ip = _stream_id(payload)
+    session_id = payload.get("session")
+    remote_addr = request.remote
     
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] [INFO] [VIEWER_CLOSE] IP={ip} Remote={remote_addr} | 开始关闭所有连接")
-    
-    VIEWER_ACTIVE = False
-    
-    # 从请求中获取 IP，更新后端 webrtc_direct=0
-    if ip and ip != '-' and ip != 'N/A':
-        try:
-            requests.patch(
-                f"http://127.0.0.1:5000/api/folders/{ip}/webrtc_direct",
-                json={"webrtc_direct": False},
-                timeout=2
-            )
-            print(f"[{timestamp}] [INFO] [VIEWER_CLOSE] IP={ip} | webrtc_direct 已更新为 0")
-        except Exception as e:
-            print(f"[{timestamp}] [ERROR] [VIEWER_CLOSE] IP={ip} | 更新 webrtc_direct 失败: {e}")
-    
-    # 关闭所有连接并清空发布轨
-    closed_count = 0
-    publisher_count = 0
-    viewer_count = 0
-    
-    for pc in list(pcs):
-        pc_id = str(id(pc))
-        info = pc_info.get(pc_id, {})
-        conn_type = info.get("type", "unknown")
-        
-        if conn_type == "publisher":
-            publisher_count += 1
-        elif conn_type == "viewer":
-            viewer_count += 1
-        
-        try:
-            current_state = pc.connectionState if hasattr(pc, 'connectionState') else "unknown"
-            _log_connection("INFO", pc_id, f"主动关闭连接 | 当前状态: {current_state}")
-            _run_async(pc.close())
-            closed_count += 1
-        except Exception as e:
-            _log_connection("ERROR", pc_id, f"关闭连接时出错: {e}")
-        finally:
-            pcs.discard(pc)
-            pc_info.pop(pc_id, None)
-    
-    # 记录发布轨状态
-    had_video = published["video"] is not None
-    had_audio = published["audio"] is not None
-    
-    published = {"video": None, "audio": None}
-    
+    print(f"[{timestamp}] [INFO] [VIEWER_CLOSE] IP={ip} Remote={remote_addr} session={session_id} | 关闭观众连接")
+
+    if session_id:
+        info = pc_info.get(session_id, {})
+        if info.get("type") != "viewer":
+            return web.json_response({"error": "session not found"}, status=404)
+        stream_id = info.get("stream")
+        targets = [session_id]
+    else:
+        stream_id = ip
+        targets = list(streams[stream_id]["viewers"]) if stream_id in streams else []
+    for pc_id in targets:
+        _log_connection("INFO", pc_id, "主动关闭连接")
+        await _close_pc(pc_id)
+    stream = streams.get(stream_id)
+    if stream is not None and not stream["viewers"]:
+        _log_connection("INFO", stream["publisher"], "流上已无观众，关闭发布者", stream=stream_id)
+        await _close_pc(stream["publisher"])
+
+    # 没有观众了：通知抓取端停止发布
+    if stream_id and stream_id not in streams:
+        _set_webrtc_direct(stream_id, False, "VIEWER_CLOSE")
+
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] [INFO] [VIEWER_CLOSE] IP={ip} | 关闭完成:")
-    print(f"  - 关闭连接数: {closed_count} (发布者: {publisher_count}, 观众: {viewer_count})")
-    print(f"  - 发布轨清理: video={'已清空' if had_video else '无'}, audio={'已清空' if had_audio else '无'}")
-    print(f"  - 剩余连接数: {len(pcs)}")
-    
-    return jsonify({"viewer": False, "closed": closed_count})
+    print(f"[{timestamp}] [INFO] [VIEWER_CLOSE] stream={stream_id} | 关闭观众 {len(targets)} 个，剩余连接数: {len(pcs)}")
+    return web.json_response({"viewer": False, "stream": stream_id, "closed": len(targets)})
+
 
-def start_webrtc_server():
-    """启动 WebRTC 服务器"""
-    print("🚀 启动 WebRTC 服务器 (port 8080)")
-    app.run(host="0.0.0.0", port=8080, debug=False)
+async def _on_shutdown(app):
+    """退出时关闭全部 PeerConnection"""
+    app["lifecycle"].cancel()
+    app["qos"].cancel()
+    await asyncio.gather(*(pc.close() for pc in list(pcs.values())), return_exceptions=True)
+    # 发布端关闭后录制任务结束，等工作线程写完最后一段；写出尚未写出的 webrtc_direct
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, recorder.join_all)
+    await loop.run_in_executor(None, webrtc_direct.flush)
+
+
+async def _on_startup(app):
+    webrtc_direct.start()
+    app["lifecycle"] = asyncio.ensure_future(lifecycle.run(_reap_pc))
+    app["qos"] = asyncio.ensure_future(qos.run())
+
+
+def create_app():
+    app = web.Application(middlewares=[cors_middleware, error_middleware], client_max_size=MAX_BODY_SIZE)
+    app.add_routes(routes)
+    app.on_startup.append(_on_startup)
+    app.on_shutdown.append(_on_shutdown)
+    return app
+
+
+def start_webrtc_server(port=WEBRTC_PORT):
+    """启动 WebRTC 服务器并阻塞。会话与发布轨保存在进程内；WEBRTC_WORKERS > 1 时由 webrtc_cluster
+    启动多个工作进程，按流 id 路由。客户端断开时取消对应的请求协程（handler_cancellation），等待中的观众随之释放"""
+    import webrtc_cluster  # webrtc_cluster 引用本模块，在这里导入避免循环导入
+    if webrtc_cluster.WEBRTC_WORKERS > 1:
+        webrtc_cluster.run(port)
+        return
+    print(f"🚀 启动 WebRTC 服务器 (port {port})")
+    web.run_app(create_app(), host="0.0.0.0", port=port, handler_cancellation=True, print=None)
 
 if __name__ == "__main__":
     start_webrtc_server()
-